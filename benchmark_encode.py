@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+广播消息编码微基准
+对比"每个订阅者编码一次"与"编码一次、所有连接复用"在不同订阅者数量下的耗时，
+消息内容模拟 WebSocketAgent 发出的 step / log 消息。
+
+用法: python benchmark_encode.py [每组消息条数]
+"""
+
+import json
+import sys
+import time
+
+from run_browser_use import encode_message, orjson
+
+SUBSCRIBER_COUNTS = [1, 5, 10, 50, 100]
+
+def build_messages():
+    """构造与 WebSocketAgent 一致的 step / log 消息"""
+    step_data = {
+        "step": 3,
+        "action": "click_element_by_index",
+        "result": "🖱️ Clicked button with index 12: 百度一下"
+    }
+    log_data = {
+        "level": "INFO",
+        "content": "📍 Step 3: Evaluating page with 48 interactive elements on: https://www.baidu.com/",
+        "context": "agent_log"
+    }
+    return {
+        "step": {
+            "type": "step",
+            "message": json.dumps(step_data, ensure_ascii=False),
+            "agent_id": "task_agent_1723456789",
+            "timestamp": time.time()
+        },
+        "log": {
+            "type": "log",
+            "message": json.dumps(log_data, ensure_ascii=False),
+            "agent_id": "task_agent_1723456789",
+            "timestamp": time.time()
+        },
+    }
+
+def per_subscriber(message_data, subscribers):
+    frames = []
+    for _ in range(subscribers):
+        frames.append(json.dumps(message_data, ensure_ascii=False))
+    return frames
+
+def encode_once(message_data, subscribers):
+    frame = encode_message(message_data)
+    return [frame] * subscribers
+
+def measure(func, message_data, subscribers, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(message_data, subscribers)
+    return (time.perf_counter() - start) / iterations * 1e6  # 微秒/条
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    backend = "orjson" if orjson is not None else "json"
+    print(f"📊 广播编码基准（每组 {iterations} 条，共享编码后端: {backend}）")
+    print("=" * 64)
+    print(f"{'消息':<6}{'订阅者':>8}{'逐个编码(us)':>16}{'编码一次(us)':>16}{'加速比':>10}")
+    for name, message_data in build_messages().items():
+        for subscribers in SUBSCRIBER_COUNTS:
+            baseline = measure(per_subscriber, message_data, subscribers, iterations)
+            shared = measure(encode_once, message_data, subscribers, iterations)
+            print(f"{name:<6}{subscribers:>8}{baseline:>16.2f}{shared:>16.2f}{baseline / shared:>9.1f}x")
+    print("=" * 64)
+
+if __name__ == "__main__":
+    main()
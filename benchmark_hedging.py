@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM后端对冲/熔断基准
+在本地启动长尾延迟的假 Ollama 和假 OpenAI 兼容服务（/v1/chat/completions，也支持 DeepSeek 的
+tool_calls 输出），直接调用 run_browser_use 的 ResilientChatModel，对比三种情况下每步的延迟：
+  1. 只用 Ollama
+  2. Ollama + OpenAI 兼容备用后端，开启对冲（主后端超过 p95 未返回时同时请求备用后端）
+  3. Ollama 不可用：故障转移到备用后端，连续失败后熔断，后续请求直接走备用后端
+
+用法: python benchmark_hedging.py --steps 200 --concurrency 4 --llm-latency-ms 200 --tail-ratio 0.03 --tail-ms 3000
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from typing import Any, Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from pydantic import BaseModel
+
+import run_browser_use as server
+from benchmark_load import StubOllama, summarize
+from browser_use.llm.messages import UserMessage
+
+class StepOutput(BaseModel):
+    thinking: str
+    evaluation_previous_goal: str
+    memory: str
+    next_goal: str
+    action: List[Dict[str, Any]]
+
+class TailStubOllama(StubOllama):
+    """大部分请求按 latency_ms 返回，tail_ratio 比例的请求耗时 tail_ms，模拟排队饱和的本地 Ollama"""
+
+    def __init__(self, latency_ms: float, tail_ratio: float, tail_ms: float):
+        super().__init__(steps=1000000, latency_ms=latency_ms, jitter=0.2)
+        self.tail_ratio = tail_ratio
+        self.tail_ms = tail_ms
+
+    async def _sleep(self):
+        if random.random() < self.tail_ratio:
+            await asyncio.sleep(self.tail_ms / 1000)
+        else:
+            await super()._sleep()
+
+class StubOpenAI:
+    """OpenAI 兼容的 /chat/completions：请求带 tools 时按 DeepSeek 的方式返回 tool_calls"""
+
+    def __init__(self, latency_ms: float):
+        self.latency_ms = latency_ms
+        self.stats = {"chat": 0}
+        self.app = FastAPI()
+        self.app.post("/v1/chat/completions")(self.chat)
+        self.app.post("/chat/completions")(self.chat)
+
+    async def chat(self, request: Request):
+        payload = await request.json()
+        self.stats["chat"] += 1
+        await asyncio.sleep(self.latency_ms * random.uniform(0.8, 1.2) / 1000)
+        content = json.dumps({
+            "thinking": "备用后端输出",
+            "evaluation_previous_goal": "Success",
+            "memory": "",
+            "next_goal": "继续",
+            "action": [{"wait": {"seconds": 0}}]
+        }, ensure_ascii=False)
+        if payload.get("tools"):
+            message = {"role": "assistant", "content": None, "tool_calls": [{
+                "id": "call_stub", "type": "function",
+                "function": {"name": payload["tools"][0]["function"]["name"], "arguments": content}
+            }]}
+        else:
+            message = {"role": "assistant", "content": content}
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": len(content) // 4, "total_tokens": 100 + len(content) // 4}
+        }
+
+def start_http_stubs(apps):
+    ready = threading.Event()
+
+    async def run():
+        servers = [uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+                   for app, port in apps]
+        tasks = [asyncio.create_task(stub_server.serve()) for stub_server in servers]
+        while not all(stub_server.started for stub_server in servers):
+            await asyncio.sleep(0.05)
+        ready.set()
+        await asyncio.gather(*tasks)
+
+    threading.Thread(target=lambda: asyncio.run(run()), daemon=True).start()
+    ready.wait(30)
+
+def build_backends(args, hedge: bool, fallbacks: List[str]) -> server.LLMBackendRegistry:
+    config = dict(server.LLM_BACKENDS_CONFIG)
+    config.update(
+        backends={args.backend_type: {
+            "type": args.backend_type,
+            "base_url": f"http://127.0.0.1:{args.openai_port}/v1",
+            "api_key": "stub",
+            "model": "stub-model",
+            "timeout": 30,
+        }},
+        fallbacks=fallbacks,
+        hedge=hedge,
+        hedge_min_samples=args.hedge_min_samples,
+        hedge_min_delay=args.hedge_min_delay,
+    )
+    registry = server.LLMClientRegistry(**server.LLM_REGISTRY_CONFIG)
+    return server.LLMBackendRegistry(registry, args.ollama_timeout, **config)
+
+async def run_case(args, name: str, backends: server.LLMBackendRegistry, ollama_port: int) -> Dict[str, Any]:
+    llm = backends.build("ollama", f"http://127.0.0.1:{ollama_port}", "qwen2.5:7b")
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one_step(index: int):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await llm.ainvoke([UserMessage(content=f"[bench-{index}] 基准步骤")], StepOutput)
+                latencies.append((time.perf_counter() - started) * 1000)
+            except Exception:
+                errors += 1
+
+    # 预热：积累主后端的延迟样本，对冲才会生效
+    await asyncio.gather(*(one_step(i) for i in range(args.hedge_min_samples)))
+    latencies.clear()
+    started = time.perf_counter()
+    await asyncio.gather(*(one_step(i) for i in range(args.steps)))
+    return {"name": name, "latencies": latencies, "errors": errors, "wall": time.perf_counter() - started,
+            "backends": backends.get_stats()["backends"]}
+
+def report(results: List[Dict[str, Any]]):
+    print("=" * 96)
+    for result in results:
+        print(f"{result['name']}")
+        print(f"  每步延迟(ms)  {summarize(result['latencies'])}  失败 {result['errors']}  总耗时 {result['wall']:.1f}s")
+        for backend, stats in result["backends"].items():
+            print(f"  {backend:<28} state={stats['state']:<9} calls={stats['calls']:<5} ok={stats['successes']:<5} "
+                  f"fail={stats['failures']:<4} timeout={stats['timeouts']:<4} rejected={stats['rejected']:<5} "
+                  f"hedged={stats['hedged']:<4} hedge_wins={stats['hedge_wins']:<4} p95={stats['p95_ms']}ms")
+    print("=" * 96)
+
+async def run_all(args):
+    ollama = f"http://127.0.0.1:{args.ollama_port}"
+    results = [
+        await run_case(args, "1. 只用 Ollama", build_backends(args, hedge=False, fallbacks=[]), args.ollama_port),
+        await run_case(args, f"2. Ollama + {args.backend_type} 备用，开启对冲",
+                       build_backends(args, hedge=True, fallbacks=[args.backend_type]), args.ollama_port),
+        # 没有服务监听的端口：连接失败 -> 故障转移 -> 熔断
+        await run_case(args, f"3. Ollama 不可用，故障转移到 {args.backend_type}",
+                       build_backends(args, hedge=True, fallbacks=[args.backend_type]), args.dead_port),
+    ]
+    print(f"📊 LLM后端对冲基准：{args.steps} 步，并发 {args.concurrency}，Ollama {args.llm_latency_ms}ms "
+          f"（{args.tail_ratio:.0%} 的请求 {args.tail_ms}ms），备用后端 {args.openai_latency_ms}ms，主后端 {ollama}")
+    report(results)
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM后端对冲/熔断基准")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--llm-latency-ms", type=float, default=200)
+    parser.add_argument("--tail-ratio", type=float, default=0.03, help="慢请求比例（对冲在p95触发，高于5%%时p95本身就是慢请求）")
+    parser.add_argument("--tail-ms", type=float, default=3000, help="慢请求耗时")
+    parser.add_argument("--openai-latency-ms", type=float, default=400)
+    parser.add_argument("--backend-type", choices=["openai", "deepseek"], default="openai")
+    parser.add_argument("--hedge-min-samples", type=int, default=20)
+    parser.add_argument("--hedge-min-delay", type=float, default=0.2)
+    parser.add_argument("--ollama-timeout", type=float, default=10)
+    parser.add_argument("--ollama-port", type=int, default=18434)
+    parser.add_argument("--openai-port", type=int, default=18435)
+    parser.add_argument("--dead-port", type=int, default=18439)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    server.debug = lambda msg: None
+    start_http_stubs([
+        (TailStubOllama(args.llm_latency_ms, args.tail_ratio, args.tail_ms).app, args.ollama_port),
+        (StubOpenAI(args.openai_latency_ms).app, args.openai_port),
+    ])
+    asyncio.run(run_all(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
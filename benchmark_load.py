@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线压测
+在本地替身上启动 run_browser_use.app：假 Ollama HTTP 服务（按脚本返回Agent输出，延迟可配置）
+和假 CDP 目标（/json/version + WebSocket），不需要真实的 Ollama(11434) 和 Chrome(9222)。
+并发提交 N 个 /run_task，统计提交/完成延迟的 p50/p95/p99、吞吐、服务端事件循环延迟
+以及全局 WebSocket（7789 协议）广播的开销，API 层的性能回退可以直接体现为数字。
+
+用法: python benchmark_load.py --tasks 50 --concurrency 10 --steps 3 --llm-latency-ms 200 --subscribers 5
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+from typing import Any, Dict, List
+
+import httpx
+import uvicorn
+import websockets
+from fastapi import FastAPI, Request
+
+import run_browser_use as server
+from browser_use import BrowserSession
+from browser_use.browser.views import BrowserStateSummary, TabInfo
+from browser_use.dom.views import DOMElementNode
+
+STUB_PAGE_URL = "http://stub.local/"
+TASK_MARKER = re.compile(r"\[bench-(\d+)\]")
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+def summarize(values: List[float]) -> str:
+    if not values:
+        return "无数据"
+    return (f"p50={percentile(values, 0.50):8.1f}  p95={percentile(values, 0.95):8.1f}  "
+            f"p99={percentile(values, 0.99):8.1f}  max={max(values):8.1f}")
+
+# ========== 假 Ollama ==========
+
+class StubOllama:
+    """按任务计数返回脚本化的Agent输出：前 steps-1 步执行 wait(0)，最后一步 done"""
+
+    def __init__(self, steps: int, latency_ms: float, jitter: float):
+        self.steps = steps
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.calls: Dict[str, int] = {}
+        self.stats = {"chat": 0, "generate": 0}
+        self.installed = ["qwen2.5:7b"]  # /api/tags 列出的模型（看门狗降级前会检查目标模型是否已安装）
+        self.app = FastAPI()
+        self.app.post("/api/chat")(self.chat)
+        self.app.post("/api/generate")(self.generate)
+        self.app.get("/api/tags")(self.tags)
+
+    async def _sleep(self):
+        delay = self.latency_ms * (1 + self.jitter * random.uniform(-1, 1)) / 1000
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _next_output(self, key: str) -> Dict[str, Any]:
+        step = self.calls.get(key, 0) + 1
+        self.calls[key] = step
+        if step >= self.steps:
+            action = {"done": {"text": f"压测任务 {key} 完成", "success": True}}
+        else:
+            action = {"wait": {"seconds": 0}}
+        return {
+            "thinking": "压测脚本输出",
+            "evaluation_previous_goal": "Success",
+            "memory": f"第 {step} 步",
+            "next_goal": "继续",
+            "action": [action]
+        }
+
+    async def chat(self, request: Request):
+        body = await request.body()
+        payload = json.loads(body)
+        self.stats["chat"] += 1
+        marker = TASK_MARKER.search(body.decode("utf-8", "ignore"))
+        content = json.dumps(self._next_output(marker.group(1) if marker else "unknown"), ensure_ascii=False)
+        await self._sleep()
+        return {
+            "model": payload.get("model"),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": len(body) // 4,
+            "eval_count": len(content) // 4
+        }
+
+    async def generate(self, request: Request):
+        payload = await request.json()
+        self.stats["generate"] += 1
+        return {
+            "model": payload.get("model"),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "response": "",
+            "done": True
+        }
+
+    async def tags(self):
+        return {"models": [{"name": model, "model": model, "size": 0} for model in self.installed]}
+
+# ========== 假 CDP 目标 ==========
+
+class StubCDPTarget:
+    """提供 /json/version 发现接口和一个对所有CDP命令都立即（或按延迟）应答的WebSocket"""
+
+    def __init__(self, port: int, latency_ms: float):
+        self.port = port
+        self.latency_ms = latency_ms
+        self.stats = {"connections": 0, "contexts": 0, "commands": 0}
+
+    def process_request(self, connection, request):
+        if request.path.startswith("/json/version"):
+            return connection.respond(HTTPStatus.OK, json.dumps({
+                "Browser": "StubCDP/1.0",
+                "Protocol-Version": "1.3",
+                "webSocketDebuggerUrl": f"ws://127.0.0.1:{self.port}/devtools/browser/stub"
+            }))
+        return None
+
+    def _result(self, method: str) -> Dict[str, Any]:
+        if method == "Browser.getVersion":
+            return {"protocolVersion": "1.3", "product": "StubCDP/1.0", "userAgent": "StubCDP", "jsVersion": "0"}
+        if method == "Target.createBrowserContext":
+            self.stats["contexts"] += 1
+            return {"browserContextId": f"stub-context-{self.stats['contexts']}"}
+        if method == "Runtime.evaluate":
+            return {"result": {"type": "object", "value": {"url": STUB_PAGE_URL, "elements": 0}}}
+        return {}
+
+    async def handler(self, websocket):
+        self.stats["connections"] += 1
+        async for raw in websocket:
+            command = json.loads(raw)
+            self.stats["commands"] += 1
+            if self.latency_ms > 0:
+                await asyncio.sleep(self.latency_ms / 1000)
+            await websocket.send(json.dumps({"id": command.get("id"), "result": self._result(command.get("method", ""))}))
+
+    async def serve(self):
+        return await websockets.serve(self.handler, "127.0.0.1", self.port, process_request=self.process_request)
+
+class StubBrowser:
+    """一条到假 CDP 目标的WebSocket连接，new_context() 对应 Target.createBrowserContext"""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.lock = asyncio.Lock()
+        self.seq = 0
+        # 与connect_over_cdp一样带一个默认上下文
+        self.contexts = [StubContext(self, "default")]
+
+    async def cdp(self, method: str, params: Dict[str, Any] = None) -> Dict[str, Any]:
+        async with self.lock:
+            self.seq += 1
+            await self.ws.send(json.dumps({"id": self.seq, "method": method, "params": params or {}}))
+            return json.loads(await self.ws.recv()).get("result", {})
+
+    def is_connected(self) -> bool:
+        return self.ws.state.name == "OPEN"
+
+    async def new_context(self, **kwargs):
+        result = await self.cdp("Target.createBrowserContext")
+        context = StubContext(self, result["browserContextId"])
+        self.contexts.append(context)
+        return context
+
+    async def close(self):
+        await self.ws.close()
+
+class StubContext:
+    """上下文里BrowserSession初始化（视口、标签页焦点监听）会用到的那部分playwright接口，开标签页和注入脚本走CDP往返"""
+
+    def __init__(self, browser: StubBrowser, context_id: str):
+        self.browser = browser
+        self.context_id = context_id
+        self.pages: List[StubPage] = []
+
+    async def new_page(self):
+        await self.browser.cdp("Target.createTarget", {"url": "about:blank", "browserContextId": self.context_id})
+        page = StubPage(self)
+        self.pages.append(page)
+        return page
+
+    async def expose_binding(self, name, callback):
+        await self.browser.cdp("Runtime.addBinding", {"name": name})
+
+    async def add_init_script(self, script):
+        await self.browser.cdp("Page.addScriptToEvaluateOnNewDocument", {"source": script})
+
+    def set_default_timeout(self, timeout):
+        pass
+
+    def set_default_navigation_timeout(self, timeout):
+        pass
+
+    async def set_extra_http_headers(self, headers):
+        pass
+
+    async def set_geolocation(self, geolocation):
+        pass
+
+    async def grant_permissions(self, permissions):
+        pass
+
+    async def close(self):
+        self.pages.clear()
+        if self in self.browser.contexts:
+            self.browser.contexts.remove(self)
+        await self.browser.cdp("Target.disposeBrowserContext", {"browserContextId": self.context_id})
+
+class StubBrowserSession(BrowserSession):
+    """
+    只替换到 Chrome 的 CDP 连接：start()/setup_playwright/上下文初始化/健康检查都走 browser_use 自己的实现，
+    连接、上下文创建/销毁和每步状态采集是到假 CDP 目标的真实往返，测到的是服务端自身的开销
+    （包括 start() 注册的 atexit 回调和会话 logger 这类按会话累积的对象）
+    """
+
+    async def _cdp(self, method: str, params: Dict[str, Any] = None) -> Dict[str, Any]:
+        return await self.browser.cdp(method, params)
+
+    async def setup_browser_via_cdp_url(self) -> None:
+        if self.browser or self.browser_context or not self.cdp_url:
+            return
+        self.logger.info(f"🌎 Connecting to existing chromium-based browser via CDP: {self.cdp_url} -> (remote browser)")
+        async with httpx.AsyncClient() as client:
+            version = (await client.get(f"{self.cdp_url.rstrip('/')}/json/version")).json()
+        self.browser = StubBrowser(await websockets.connect(version["webSocketDebuggerUrl"]))
+        await self._cdp("Browser.getVersion")
+        self._set_browser_keep_alive(True)
+
+    async def get_browser_state_with_recovery(self, cache_clickable_elements_hashes: bool = True, include_screenshot: bool = False):
+        await self._cdp("Runtime.evaluate", {"expression": "document.documentElement.outerHTML"})
+        return BrowserStateSummary(
+            element_tree=DOMElementNode(tag_name="body", xpath="/body", attributes={}, children=[], is_visible=True, parent=None),
+            selector_map={},
+            url=STUB_PAGE_URL,
+            title="Stub Page",
+            tabs=[TabInfo(page_id=0, url=STUB_PAGE_URL, title="Stub Page")]
+        )
+
+    async def get_current_page(self):
+        return self.agent_current_page
+
+    async def get_selector_map(self):
+        return {}
+
+    async def remove_highlights(self):
+        pass
+
+class StubPage:
+    url = STUB_PAGE_URL
+
+    def __init__(self, context: StubContext = None):
+        self.context = context
+
+    def is_closed(self):
+        return False
+
+    async def goto(self, url, **kwargs):
+        pass
+
+    async def evaluate(self, expression, arg=None):
+        await self.context.browser.cdp("Runtime.evaluate", {"expression": expression})
+        return True
+
+    async def set_viewport_size(self, viewport):
+        pass
+
+# ========== 服务端测量 ==========
+
+class LoopLagSampler:
+    """周期性sleep，实际唤醒时间与预期之差即事件循环延迟"""
+
+    def __init__(self, interval_ms: float = 10):
+        self.interval = interval_ms / 1000
+        self.samples: List[float] = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append((loop.time() - expected) * 1000)
+
+dispatch_stats = {"calls": 0, "seconds": 0.0}
+
+def instrument_dispatch():
+    # 统计全局WebSocket每条广播在服务端编码+入队的耗时
+    original = server.websocket_manager.dispatch_global
+
+    def timed_dispatch(message_data):
+        started = time.perf_counter()
+        original(message_data)
+        dispatch_stats["seconds"] += time.perf_counter() - started
+        dispatch_stats["calls"] += 1
+
+    server.websocket_manager.dispatch_global = timed_dispatch
+
+def start_stubs(args, stub_ollama: StubOllama, *stub_cdps: StubCDPTarget):
+    ready = threading.Event()
+
+    async def run():
+        for stub_cdp in stub_cdps:
+            await stub_cdp.serve()
+        config = uvicorn.Config(stub_ollama.app, host="127.0.0.1", port=args.ollama_port, log_level="warning", access_log=False)
+        stub_server = uvicorn.Server(config)
+        stub_task = asyncio.create_task(stub_server.serve())
+        while not stub_server.started:
+            await asyncio.sleep(0.05)
+        ready.set()
+        await stub_task
+
+    threading.Thread(target=lambda: asyncio.run(run()), daemon=True).start()
+    ready.wait(30)
+
+# ========== 负载端 ==========
+
+async def ws_subscriber(port: int, results: Dict[str, Any], stop: asyncio.Event):
+    # 全局WebSocket与HTTP接口同端口（/ws），协议与7789端口相同
+    async with websockets.connect(f"ws://127.0.0.1:{port}/ws", max_size=None) as websocket:
+        while not stop.is_set():
+            try:
+                raw = await asyncio.wait_for(websocket.recv(), timeout=0.2)
+            except asyncio.TimeoutError:
+                continue
+            received = time.time()
+            results["bytes"] += len(raw)
+            frame = json.loads(raw)
+            messages = frame["messages"] if frame.get("type") == "batch" else [frame]
+            for message in messages:
+                results["messages"] += 1
+                if isinstance(message.get("timestamp"), (int, float)):
+                    results["delays"].append((received - message["timestamp"]) * 1000)
+
+async def drive_load(args) -> Dict[str, Any]:
+    base_url = f"http://127.0.0.1:{args.port}"
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    submit_latencies, complete_latencies, statuses = [], [], {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    stop = asyncio.Event()
+    ws_results = [{"messages": 0, "bytes": 0, "delays": []} for _ in range(args.subscribers)]
+    subscribers = [asyncio.create_task(ws_subscriber(args.port, result, stop)) for result in ws_results]
+    await asyncio.sleep(0.2)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.task_timeout, limits=limits) as client:
+        async def one_task(index: int):
+            async with semaphore:
+                # 不指定cdp_url，由Chrome节点注册表分配
+                payload = {
+                    "model": args.model,
+                    "host": f"http://127.0.0.1:{args.ollama_port}",
+                    "task": f"[bench-{index}] 打开测试页面并完成压测任务",
+                    "max_steps": args.steps + 2
+                }
+                started = time.perf_counter()
+                response = await client.post("/run_task", json=payload)
+                submit_latencies.append((time.perf_counter() - started) * 1000)
+                task_id = response.json().get("task_id")
+                if not task_id:
+                    statuses["rejected"] = statuses.get("rejected", 0) + 1
+                    return
+                deadline = started + args.task_timeout
+                status = "unknown"
+                while time.perf_counter() < deadline:
+                    await asyncio.sleep(args.poll_ms / 1000)
+                    status = (await client.get(f"/task_status/{task_id}")).json().get("status")
+                    if status in server.TASK_TERMINAL_STATES:
+                        break
+                complete_latencies.append((time.perf_counter() - started) * 1000)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        wall_started = time.perf_counter()
+        await asyncio.gather(*(one_task(i) for i in range(args.tasks)))
+        wall = time.perf_counter() - wall_started
+        health = (await client.get("/health")).json()
+
+    await asyncio.sleep(0.3)
+    stop.set()
+    await asyncio.gather(*subscribers, return_exceptions=True)
+    return {
+        "wall": wall,
+        "submit": submit_latencies,
+        "complete": complete_latencies,
+        "statuses": statuses,
+        "ws": ws_results,
+        "health": health
+    }
+
+# ========== 入口 ==========
+
+def report(args, results: Dict[str, Any], lag: LoopLagSampler, stub_ollama: StubOllama, stub_cdps: List[StubCDPTarget]):
+    completed = results["statuses"].get("completed", 0)
+    print("=" * 72)
+    print(f"📊 离线压测：{args.tasks} 个任务，并发 {args.concurrency}，每任务 {args.steps} 步，"
+          f"LLM延迟 {args.llm_latency_ms}ms，CDP延迟 {args.cdp_latency_ms}ms，订阅者 {args.subscribers}，"
+          f"Chrome节点 {args.cdp_nodes}×{args.node_capacity}")
+    print("=" * 72)
+    print(f"任务状态        {results['statuses']}")
+    print(f"吞吐            {completed / results['wall']:.2f} 任务/秒（总耗时 {results['wall']:.2f}s）")
+    print(f"提交延迟(ms)    {summarize(results['submit'])}")
+    print(f"完成延迟(ms)    {summarize(results['complete'])}")
+    print(f"事件循环延迟(ms) {summarize(lag.samples)}  样本 {len(lag.samples)}")
+    delays = [d for result in results["ws"] for d in result["delays"]]
+    messages = sum(result["messages"] for result in results["ws"])
+    total_bytes = sum(result["bytes"] for result in results["ws"])
+    per_dispatch = dispatch_stats["seconds"] / dispatch_stats["calls"] * 1e6 if dispatch_stats["calls"] else 0.0
+    print(f"WS送达延迟(ms)  {summarize(delays)}")
+    print(f"WS广播          {dispatch_stats['calls']} 条，服务端分发 {per_dispatch:.1f}us/条，"
+          f"订阅者共收到 {messages} 条 / {total_bytes / 1024:.1f} KiB")
+    print(f"服务端广播统计  {results['health'].get('broadcast')}")
+    print(f"假Ollama调用    {stub_ollama.stats}")
+    for stub_cdp in stub_cdps:
+        print(f"假CDP :{stub_cdp.port}     {stub_cdp.stats}")
+    print(f"Chrome节点      {results['health'].get('chrome_nodes')}")
+    print(f"浏览器上下文    {results['health'].get('browser_pool')}")
+    print("=" * 72)
+
+async def run_server(args, lag: LoopLagSampler) -> Dict[str, Any]:
+    config = uvicorn.Config(server.app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+    api_server = uvicorn.Server(config)
+    server_task = asyncio.create_task(api_server.serve())
+    lag_task = asyncio.create_task(lag.run())
+    while not api_server.started:
+        await asyncio.sleep(0.05)
+    # 负载端跑在独立线程的事件循环里，不占用被测服务的事件循环
+    results = await asyncio.to_thread(asyncio.run, drive_load(args))
+    lag_task.cancel()
+    api_server.should_exit = True
+    await server_task
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="run_browser_use 离线压测")
+    parser.add_argument("--tasks", type=int, default=50, help="任务总数")
+    parser.add_argument("--concurrency", type=int, default=10, help="并发提交的任务数")
+    parser.add_argument("--steps", type=int, default=3, help="每个任务的Agent步数")
+    parser.add_argument("--llm-latency-ms", type=float, default=200, help="假Ollama每次响应的延迟")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="LLM延迟的相对抖动")
+    parser.add_argument("--cdp-latency-ms", type=float, default=5, help="假CDP每条命令的延迟")
+    parser.add_argument("--subscribers", type=int, default=5, help="全局WebSocket订阅者数量")
+    parser.add_argument("--model", default="qwen2.5:7b")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--ollama-port", type=int, default=18434)
+    parser.add_argument("--cdp-port", type=int, default=19222, help="第一个假CDP节点的端口，其余节点依次加1")
+    parser.add_argument("--cdp-nodes", type=int, default=1, help="假CDP节点数量")
+    parser.add_argument("--node-capacity", type=int, default=2, help="每个节点同时运行的Agent上限")
+    parser.add_argument("--poll-ms", type=float, default=100, help="轮询 /task_status 的间隔")
+    parser.add_argument("--task-timeout", type=float, default=300)
+    parser.add_argument("--no-log-broadcast", action="store_true", help="不像生产入口那样把stdout和日志广播到WebSocket")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    logging.getLogger("browser_use").setLevel(args.log_level)
+    server.BrowserSession = StubBrowserSession
+    instrument_dispatch()
+
+    stub_ollama = StubOllama(args.steps, args.llm_latency_ms, args.llm_jitter)
+    stub_cdps = [StubCDPTarget(args.cdp_port + i, args.cdp_latency_ms) for i in range(args.cdp_nodes)]
+    start_stubs(args, stub_ollama, *stub_cdps)
+    # 用假CDP节点替换默认注册的本机Chrome；全局和Ollama上限放开，让节点容量成为瓶颈
+    for cdp_url in list(server.chrome_nodes.nodes):
+        server.chrome_nodes.remove(cdp_url)
+    for stub_cdp in stub_cdps:
+        server.chrome_nodes.register(f"http://127.0.0.1:{stub_cdp.port}", args.node_capacity)
+    server.agent_scheduler.max_concurrency = args.cdp_nodes * args.node_capacity
+    server.agent_scheduler.per_llm_host_limit = args.cdp_nodes * args.node_capacity
+
+    if not args.no_log_broadcast:
+        server.logging_pipeline.start()
+
+    lag = LoopLagSampler()
+    try:
+        results = asyncio.run(run_server(args, lag))
+    finally:
+        server.logging_pipeline.stop()
+    report(args, results, lag, stub_ollama, stub_cdps)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Agent输出捕获与日志管道基准
+1. 多个Agent并发输出（print 和 logging 各一半），对比旧的"每个Agent重定向一次stdout"方式和
+   按上下文归属的 TeeLoggerStream / BroadcastingHandler：统计每行的捕获开销和归属错误的行数。
+2. 日志密集的运行（browser_use 的 INFO/DEBUG、httpx 的请求日志混在一起），对比在事件循环上
+   同步格式化、写文件、广播，和经 LoggingPipeline 入队后由后台线程处理：统计事件循环上每条
+   记录的耗时、全部落盘的总耗时、写入/过滤/限流的条数。
+
+用法: python benchmark_logging.py [并发Agent数，默认20] [每个Agent输出行数，默认2000]
+"""
+
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import run_browser_use as server
+
+# 改造前的实现：进程级重定向，每次写入都flush，字符串拼接缓冲
+class LegacyTeeLoggerStream:
+    def __init__(self, original_stream, agent_id=None):
+        self.original_stream = original_stream
+        self.agent_id = agent_id
+        self._buffer = ""
+
+    def write(self, message):
+        self.original_stream.write(message)
+        self.original_stream.flush()
+        self._buffer += message
+        if "\n" in self._buffer:
+            lines = self._buffer.split("\n")
+            for line in lines[:-1]:
+                if line.strip():
+                    server.broadcast_log_message(line.strip(), agent_id=self.agent_id)
+            self._buffer = lines[-1]
+
+    def flush(self):
+        self.original_stream.flush()
+
+# 改造前的广播handler：不知道记录来自哪个agent
+class LegacyBroadcastingHandler(logging.Handler):
+    def emit(self, record):
+        server.broadcast_log_message(self.format(record), message_type="log", agent_id=None)
+
+def install_recorder():
+    """记录每条广播消息的归属，替换掉真正的广播（只测捕获本身）"""
+    captured = []
+    server.broadcast_log_message = lambda message, message_type="log", agent_id=None, **extra: \
+        captured.append((agent_id, message))
+    return captured
+
+async def emit_lines(agent_id: str, lines: int, bench_logger: logging.Logger):
+    for i in range(lines):
+        if i % 2:
+            print(f"{agent_id} 第 {i} 行输出")
+        else:
+            bench_logger.info(f"{agent_id} 第 {i} 行日志")
+        if i % 50 == 0:
+            await asyncio.sleep(0)
+
+async def legacy_agent(agent_id, lines, bench_logger, devnull):
+    with contextlib.redirect_stdout(LegacyTeeLoggerStream(devnull, agent_id)):
+        await emit_lines(agent_id, lines, bench_logger)
+
+async def context_agent(agent_id, lines, bench_logger, devnull):
+    with server.agent_log_context(agent_id):
+        await emit_lines(agent_id, lines, bench_logger)
+
+def run_case(name, agent_func, handler, stdout, agents, lines, devnull):
+    captured = install_recorder()
+    bench_logger = logging.getLogger("benchmark_logging")
+    bench_logger.handlers.clear()
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+    bench_logger.addHandler(handler)
+    bench_logger.setLevel(logging.INFO)
+    bench_logger.propagate = False
+
+    async def main():
+        await asyncio.gather(*(agent_func(f"agent_{n}", lines, bench_logger, devnull) for n in range(agents)))
+
+    original_stdout = sys.stdout
+    sys.stdout = stdout
+    started = time.perf_counter()
+    try:
+        asyncio.run(main())
+    finally:
+        sys.stdout = original_stdout
+    elapsed = time.perf_counter() - started
+    total = agents * lines
+    wrong = sum(1 for agent_id, message in captured if agent_id is None or f"{agent_id} 第 " not in message)
+    print(f"{name:<14}{len(captured):>10}{wrong:>12}{elapsed / total * 1e6:>14.2f}")
+
+# 模拟一次日志密集的运行：browser_use 的步骤INFO、DOM的DEBUG/INFO和httpx请求日志交替输出
+HEAVY_LOGGERS = [
+    ("browser_use.agent.service", logging.INFO, "📍 Step {i}: Evaluating page with 48 interactive elements"),
+    ("browser_use.dom.service", logging.DEBUG, "DOM树构建完成，节点 {i}"),
+    ("browser_use.dom.service", logging.INFO, "🔍 可交互元素 {i}"),
+    ("httpx", logging.INFO, 'HTTP Request: POST http://127.0.0.1:11434/api/chat "HTTP/1.1 200 OK" {i}'),
+]
+
+async def emit_heavy(agent_id: str, records: int):
+    loggers = [(logging.getLogger(name), level, template) for name, level, template in HEAVY_LOGGERS]
+    with server.agent_log_context(agent_id):
+        for i in range(records):
+            bench_logger, level, template = loggers[i % len(loggers)]
+            bench_logger.log(level, template.format(i=i))
+            if i % 50 == 0:
+                await asyncio.sleep(0)
+
+def count_lines(path: str) -> int:
+    with open(path, encoding="utf-8") as f:
+        return sum(1 for _ in f)
+
+def run_heavy_case(name, pipeline, agents, records, log_dir):
+    captured = install_recorder()
+    log_file = os.path.join(log_dir, f"{name}.log")
+    formatter = logging.Formatter(server.LOGGING_CONFIG["log_format"])
+    handlers = [server.BroadcastingHandler(), logging.FileHandler(log_file, encoding="utf-8")]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    if pipeline is None:
+        # 改造前：所有logger直接挂同步handler，在事件循环上格式化、写文件、广播
+        server.attach_handler_to_all_loggers(*handlers, level=logging.DEBUG)
+    else:
+        pipeline.start(*handlers)
+
+    async def run_agents():
+        await asyncio.gather(*(emit_heavy(f"agent_{n}", records) for n in range(agents)))
+
+    started = time.perf_counter()
+    asyncio.run(run_agents())
+    on_loop = time.perf_counter() - started
+    if pipeline is not None:
+        pipeline.stop()
+    else:
+        for handler in handlers:
+            handler.close()
+    drained = time.perf_counter() - started
+    stats = pipeline.get_stats() if pipeline is not None else {}
+    print(f"{name:<12}{on_loop / (agents * records) * 1e6:>12.2f}{drained:>10.2f}{count_lines(log_file):>10}"
+          f"{len(captured):>10}{stats.get('filtered_by_level', 0):>10}{sum(stats.get('rate_limited', {}).values()):>10}"
+          f"{stats.get('dropped_queue_full', 0):>10}")
+
+def main():
+    agents = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    lines = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    print(f"📊 Agent输出捕获基准（{agents} 个Agent并发，每个 {lines} 行）")
+    print("=" * 50)
+    print(f"{'方式':<14}{'捕获行数':>10}{'归属错误':>12}{'每行(us)':>14}")
+    with open(os.devnull, "w") as devnull:
+        # 并发重定向互相覆盖时有些行会落回进程的stdout，这里指向devnull
+        run_case("stdout重定向", legacy_agent, LegacyBroadcastingHandler(), devnull, agents, lines, devnull)
+        run_case("上下文归属", context_agent, server.BroadcastingHandler(), server.TeeLoggerStream(devnull),
+                 agents, lines, devnull)
+    print("=" * 50)
+
+    print(f"\n📊 日志密集运行（{agents} 个Agent并发，每个 {lines} 条记录）")
+    print("=" * 84)
+    print(f"{'方式':<12}{'循环上(us)':>12}{'总耗时(s)':>10}{'写入文件':>10}{'广播':>10}{'级别过滤':>10}{'限流':>10}{'队列丢弃':>10}")
+    with tempfile.TemporaryDirectory() as log_dir:
+        run_heavy_case("同步handler", None, agents, lines, log_dir)
+        unfiltered = {**server.LOGGING_CONFIG, "level": "DEBUG", "logger_levels": {},
+                      "rate_limits": {}, "rate_limit_default": 0}
+        run_heavy_case("队列(不过滤)", server.LoggingPipeline(**unfiltered), agents, lines, log_dir)
+        run_heavy_case("队列管道", server.LoggingPipeline(**server.LOGGING_CONFIG), agents, lines, log_dir)
+    print("=" * 84)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Agent创建/移除内存基准
+通过 agent_manager.create_agent / remove_agent 反复创建和移除Agent（使用 benchmark_load 中的
+假 Ollama 和假 CDP 目标），每隔一段打印 RSS、gc跟踪的对象数、类型对象数、存活的 BrowserSession 数和 atexit 回调数，
+确认长时间运行后内存和对象数保持平稳；存活会话数或 atexit 回调数比预热后多则以非零状态退出。
+
+用法: python benchmark_memory.py [循环次数，默认10000] [采样间隔，默认1000]
+"""
+
+import argparse
+import asyncio
+import atexit
+import gc
+import logging
+import os
+import sys
+import time
+
+import run_browser_use as server
+from browser_use import BrowserSession
+from benchmark_load import StubBrowserSession, StubCDPTarget, StubOllama, start_stubs
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+WARMUP_CYCLES = 500
+
+def rss_mb() -> float:
+    if psutil is not None:
+        return psutil.Process(os.getpid()).memory_info().rss / 1024 / 1024
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+def snapshot():
+    gc.collect()
+    objects = gc.get_objects()
+    return {
+        "rss_mb": rss_mb(),
+        "objects": len(objects),
+        "types": sum(1 for obj in objects if isinstance(obj, type)),
+        "sessions": sum(1 for obj in objects if isinstance(obj, BrowserSession)),
+        "atexit": atexit._ncallbacks(),
+    }
+
+async def run_cycles(args):
+    request = server.AgentRequest(
+        cdp_url=f"http://127.0.0.1:{args.cdp_port}",
+        model="qwen2.5:7b",
+        host=f"http://127.0.0.1:{args.ollama_port}",
+        task="内存基准任务"
+    )
+
+    async def cycle(i: int):
+        agent_id = f"bench_agent_{i}"
+        await server.agent_manager.create_agent(agent_id, request)
+        await server.agent_manager.remove_agent(agent_id)
+
+    for i in range(WARMUP_CYCLES):
+        await cycle(i)
+    baseline = snapshot()
+    print(f"{'循环':>8}{'RSS(MB)':>12}{'对象数':>12}{'类型数':>10}{'存活会话':>10}{'atexit':>8}{'活跃Agent':>12}{'耗时(s)':>10}")
+    print(f"{0:>8}{baseline['rss_mb']:>12.1f}{baseline['objects']:>12}{baseline['types']:>10}{baseline['sessions']:>10}{baseline['atexit']:>8}"
+          f"{len(server.agent_manager.active_agents):>12}{0:>10.1f}")
+    started = time.perf_counter()
+    samples = [baseline]
+    for i in range(1, args.cycles + 1):
+        await cycle(WARMUP_CYCLES + i)
+        if i % args.interval == 0:
+            current = snapshot()
+            samples.append(current)
+            print(f"{i:>8}{current['rss_mb']:>12.1f}{current['objects']:>12}{current['types']:>10}{current['sessions']:>10}{current['atexit']:>8}"
+                  f"{len(server.agent_manager.active_agents):>12}{time.perf_counter() - started:>10.1f}")
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description="Agent创建/移除内存基准")
+    parser.add_argument("cycles", type=int, nargs="?", default=10000)
+    parser.add_argument("interval", type=int, nargs="?", default=1000)
+    parser.add_argument("--ollama-port", type=int, default=18434)
+    parser.add_argument("--cdp-port", type=int, default=19222)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    server.BrowserSession = StubBrowserSession
+    # 只看内存，屏蔽每次创建/移除打印的调试输出
+    server.debug = lambda msg: None
+
+    stub_args = argparse.Namespace(ollama_port=args.ollama_port)
+    start_stubs(stub_args, StubOllama(steps=1, latency_ms=0, jitter=0), StubCDPTarget(args.cdp_port, latency_ms=0))
+
+    print(f"📊 Agent创建/移除内存基准（{args.cycles} 次，预热 {WARMUP_CYCLES} 次）")
+    print("=" * 64)
+    samples = asyncio.run(run_cycles(args))
+    print("=" * 64)
+    # 第一个采样区间内pydantic/browser_use的内部缓存还在填充，稳定性看之后的变化
+    for label, first in (("预热后", samples[0]), ("首个采样点后", samples[min(1, len(samples) - 1)])):
+        final = samples[-1]
+        print(f"{label} RSS 增长: {final['rss_mb'] - first['rss_mb']:+.1f} MB，"
+              f"对象数增长: {final['objects'] - first['objects']:+d}，"
+              f"类型数增长: {final['types'] - first['types']:+d}")
+    # Agent全部移除后只应剩下会话池里每个CDP连接共用的那个会话
+    # BrowserSession.start()每次都会注册一个持有会话的atexit回调，回调数增长同样意味着会话泄漏
+    leaked = samples[-1]["sessions"] - samples[0]["sessions"]
+    callbacks = samples[-1]["atexit"] - samples[0]["atexit"]
+    if leaked > 0 or callbacks > 0:
+        print(f"❌ 移除Agent后仍有 {leaked} 个 BrowserSession 存活，atexit 回调增长 {callbacks} 个")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,17 +3,48 @@ import asyncio
 import json
 import sys
 import threading
+import time
+import heapq
+import itertools
 import logging
+import logging.handlers
+import queue
 import contextlib
-import websockets
-from typing import List, Dict, Any
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
-from pydantic import BaseModel
+import contextvars
+import hashlib
+import math
+import re
+import shutil
+import socket
+import tempfile
+import uuid
+from collections import deque, OrderedDict
+from typing import List, Dict, Any, Optional
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, field_validator
 from dotenv import load_dotenv
 from browser_use import Agent, BrowserSession
-from browser_use.llm import ChatOllama
+from browser_use.llm import ChatOllama, ChatOpenAI
+from browser_use.llm.base import BaseChatModel
+from browser_use.llm.deepseek.chat import ChatDeepSeek
+from browser_use.llm.exceptions import ModelProviderError
+from browser_use.llm.ollama.serializer import OllamaMessageSerializer
+from browser_use.llm.views import ChatInvokeCompletion, ChatInvokeUsage
+from ollama import AsyncClient as OllamaAsyncClient
+import httpx
 import uvicorn
 
+try:
+    import orjson  # 可选：安装后使用更快的JSON编码
+except ImportError:
+    orjson = None
+
+try:
+    import psutil  # 可选：托管Chrome进程树的内存/CPU统计；未安装时只统计主进程
+except ImportError:
+    psutil = None
+
 # 超时配置常量
 TASK_CONFIG = {
     "task_timeout": 1800,  # 任务总超时时间（秒）- 30分钟
@@ -21,306 +52,3163 @@ TASK_CONFIG = {
     "short_task_timeout": 600  # 短任务超时时间（秒）- 10分钟
 }
 
-AGENT_CONFIG = {
-    "max_steps": 100,  # 最大执行步数
-    "step_timeout": 60,  # 单步超时时间（秒）
-}
+# 模型路由：请求中没有显式指定的 model / max_steps / timeout 按任务分档决定。
+# 依次看请求指定的档位、templates中的正则、同模板任务的历史平均步数，最后按长度和关键词判断
+MODEL_ROUTER_CONFIG = {
+    "enabled": os.getenv("MODEL_ROUTER_ENABLED", "true").lower() == "true",
+    # 各档位的模型默认都是AgentRequest的默认模型（部署只拉取了qwen2.5:7b），需要分档换模型时先拉取再通过环境变量指定
+    "tiers": {
+        "short": {"model": os.getenv("MODEL_ROUTER_SHORT_MODEL", "qwen2.5:7b"), "max_steps": 15,
+                  "timeout": TASK_CONFIG["short_task_timeout"]},
+        "default": {"model": os.getenv("MODEL_ROUTER_DEFAULT_MODEL", "qwen2.5:7b"), "max_steps": 40,
+                    "timeout": TASK_CONFIG["task_timeout"]},
+        "long": {"model": os.getenv("MODEL_ROUTER_LONG_MODEL", "qwen2.5:7b"), "max_steps": 100,
+                 "timeout": TASK_CONFIG["long_task_timeout"]},
+    },
+    "templates": [],  # [(正则, 档位)]，如 [(r"^打开\S+$", "short")]
+    "short_keywords": ["打开", "访问", "open", "go to", "visit", "navigate"],
+    "long_keywords": ["登录", "登陆", "注册", "填写", "表单", "提交", "下单", "预订", "日历", "然后", "之后",
+                      "log in", "login", "sign in", "sign up", "fill", "form", "submit", "checkout", "calendar", "then"],
+    "short_max_chars": 40,  # 命中短任务关键词、只有一个子句且不超过该长度才算短任务
+    "long_min_chars": 200,  # 超过该长度算长任务
+    "long_min_clauses": 3,  # 按标点和"然后/并/and/then"等连接词切分出的子句数达到该值算长任务
+    "history_min_samples": 3,  # 同模板至少有这么多次完成记录才按历史步数分档
+    "history_window": 20,  # 每个模板保留最近N次完成任务的步数
+    "short_max_history_steps": 5,  # 历史平均步数不超过该值 -> short
+    "long_min_history_steps": 20,  # 历史平均步数不低于该值 -> long
+    "max_templates": 1000,  # 记录历史步数的模板数上限（按最近使用淘汰）
+}
+
+AGENT_CONFIG = {
+    "max_steps": 100,  # 最大执行步数
+    "step_timeout": 60,  # 单步超时时间（秒）
+}
+
+# 步骤看门狗：单步超时后重试，连续超时换更快的模型，仍然超时或长时间没有进度就直接失败，尽快让出调度槽位
+WATCHDOG_CONFIG = {
+    "stall_timeout": 180,  # 超过该时长（秒）没有任何进度（步骤开始/结束、状态采集、LLM返回、动作完成）判定为卡死
+    "check_interval": 5,  # 卡死检查间隔（秒）
+    "downgrade_after": 2,  # 连续N步超时（且超时发生在LLM阶段）后换用更快的模型
+    "fail_after": 3,  # 连续N步超时后直接失败（不超过browser_use的max_failures，否则会先被它静默停止）
+    # 模型降级表：当前模型 -> 更快的模型，默认不降级；如 "qwen2.5:14b=qwen2.5:7b,qwen2.5:7b=qwen2.5:3b"
+    # 目标模型不在Ollama的 /api/tags 里（未安装）时不降级，继续用当前模型
+    "fallback_models": dict(map(str.strip, pair.split("=", 1))
+                            for pair in os.getenv("WATCHDOG_FALLBACK_MODELS", "").split(",") if "=" in pair),
+}
+
+# 全局WebSocket广播配置
+BROADCAST_CONFIG = {
+    "client_queue_size": 1000,  # 每个客户端的发送队列上限（条）
+    "drop_policy": "drop_oldest",  # 队列满时的策略：drop_oldest 丢弃最旧 / drop_newest 丢弃最新
+    "legacy_port": 7789,  # 兼容旧客户端：同一个uvicorn进程同时监听该端口，ws://host:7789/ 协议不变
+}
+
+# WebSocket批量推送配置（客户端连接时通过 ?batch_ms=&batch_size= 协商，默认关闭）
+BATCH_CONFIG = {
+    "default_batch_ms": 200,  # 只指定batch_size时使用的时间窗口（毫秒）
+    "default_batch_size": 100,  # 只指定batch_ms时使用的每批最大条数
+    "max_batch_ms": 5000,
+    "max_batch_size": 1000,
+}
+
+# Agent并发调度配置
+SCHEDULER_CONFIG = {
+    "max_concurrency": 4,  # 同时运行的Agent上限
+    "per_cdp_url_limit": 2,  # 每个Chrome（cdp_url）同时运行的Agent上限
+    "per_llm_host_limit": 2,  # 每个LLM后端同时运行的Agent上限（Ollama按host，其它后端按后端名）
+    "max_queue_size": 100,  # 等待队列上限，超过后直接拒绝
+}
+
+# 任务记录配置
+TASK_STORE_CONFIG = {
+    "max_records": 1000,  # 最多保留的任务记录数（只淘汰已结束的任务）
+    "retention_seconds": 24 * 3600,  # 已结束任务的保留时长（秒）
+    "persist_path": "task_records.jsonl",  # 任务记录持久化文件（追加写的JSONL），None表示只保存在内存
+}
+
+# BrowserSession池配置（每个cdp_url一条共享CDP连接，每个Agent一个独立的浏览器上下文）
+BROWSER_POOL_CONFIG = {
+    "idle_ttl": 300,  # 没有Agent使用的共享CDP连接保留时间（秒）
+    "close_timeout": 5,  # 销毁Agent浏览器上下文的超时（秒）
+}
+
+# Chrome节点注册表：cdp_url留空的请求分配到负载最低的健康节点
+CHROME_NODES_CONFIG = {
+    # 逗号分隔的 cdp_url[=容量]，如 "http://10.0.0.2:9222=4,http://10.0.0.3:9222"
+    "nodes": os.getenv("CHROME_NODES", "http://127.0.0.1:9222"),
+    "default_capacity": 2,  # 未指定容量的节点同时运行的Agent上限（即该cdp_url的调度上限）
+    "health_interval": 10,  # /json/version 健康检查间隔（秒）
+    "health_timeout": 3,  # 健康检查超时（秒）
+    "drain_after": 2,  # 连续N次健康检查失败后摘除，恢复后自动重新加入
+}
+
+# 托管的本地无头Chrome：按排队情况启动/关闭，崩溃自动重启，跑满N个任务或内存超限后回收
+CHROME_SUPERVISOR_CONFIG = {
+    "enabled": os.getenv("CHROME_SUPERVISOR_ENABLED", "false").lower() == "true",
+    "chrome_path": os.getenv("CHROME_PATH", ""),  # 留空时在PATH中查找 google-chrome / chromium
+    "base_port": 9300,  # 托管Chrome的调试端口从这里开始依次分配
+    "min_processes": 1,  # 常驻进程数
+    "max_processes": 4,  # 进程数上限
+    "capacity": 2,  # 每个进程同时运行的Agent数（注册为Chrome节点容量）
+    "recycle_after_tasks": 50,  # 分配过N个任务后回收
+    "max_rss_mb": 1536,  # 进程树内存超过该值（MB）后回收
+    "idle_shutdown": 300,  # 多出min_processes的进程空闲多久（秒）后关闭
+    "check_interval": 5,  # 巡检间隔（秒），有新任务提交时会提前巡检
+    "startup_timeout": 20,  # 等待 /json/version 可用的时间（秒）
+    "extra_args": os.getenv("CHROME_EXTRA_ARGS", "").split(),
+}
+CHROME_EXECUTABLES = ("google-chrome", "google-chrome-stable", "chromium", "chromium-browser", "chrome")
+
+# LLM实例缓存配置
+LLM_REGISTRY_CONFIG = {
+    "max_instances": 32,  # 缓存的LLM实例上限（按最近使用淘汰）
+    "idle_ttl": 1800,  # 实例闲置超过该时长（秒）后淘汰
+    "max_connections_per_host": 8,  # 每个Ollama服务共享的HTTP连接池大小
+    "request_timeout": 120,  # 单次请求超时（秒）
+    "keep_alive": "30m",  # 预热时让Ollama把模型常驻内存的时长
+    "warmup_timeout": 180,  # 模型预热超时（秒）
+}
+
+# LLM后端：Ollama（按host）之外的OpenAI兼容/DeepSeek后端，配置了api_key才启用。
+# 每个后端独立超时和熔断；fallbacks中的后端依次作为备用，开启对冲时主后端超过p95延迟仍未返回就同时请求下一个后端
+LLM_BACKENDS_CONFIG = {
+    "backends": {
+        "openai": {
+            "type": "openai",
+            "base_url": os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+            "api_key": os.getenv("OPENAI_API_KEY", ""),
+            "model": os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+            "timeout": 60,
+        },
+        "deepseek": {
+            "type": "deepseek",
+            "base_url": os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com"),
+            "api_key": os.getenv("DEEPSEEK_API_KEY", ""),
+            "model": os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
+            "timeout": 60,
+        },
+    },
+    "fallbacks": [name.strip() for name in os.getenv("LLM_FALLBACKS", "").split(",") if name.strip()],  # 如 "deepseek,openai"
+    "hedge": os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true",
+    "hedge_percentile": 0.95,  # 主后端超过该分位延迟仍未返回时发出对冲请求
+    "hedge_min_samples": 20,  # 样本不足时不对冲
+    "hedge_min_delay": 1.0,  # 对冲等待的下限（秒）
+    "latency_window": 200,  # 每个后端保留最近N次成功调用的延迟
+    "breaker_failures": 3,  # 连续失败N次后熔断
+    "breaker_cooldown": 30,  # 熔断后等待多久（秒）放行一次试探请求
+}
+
+# Agent生命周期配置：定期回收已结束和闲置的Agent，释放会话、临时目录和WebSocket连接
+LIFECYCLE_CONFIG = {
+    "finished_ttl": 300,  # 运行结束（成功/失败）的Agent保留时长（秒），之后回收
+    "idle_ttl": 1800,  # 创建后未运行或长时间无活动的Agent回收时长（秒）
+    "reap_interval": 30,  # 检查间隔（秒）
+    "cancel_grace": 10,  # /cancel 等待任务完成清理的最长时间（秒）
+}
+
+# LLM响应缓存配置（默认关闭；适合反复运行的相同任务，命中后直接跳过推理）
+LLM_CACHE_CONFIG = {
+    "enabled": os.getenv("LLM_CACHE_ENABLED", "false").lower() == "true",
+    "cache_dir": os.getenv("LLM_CACHE_DIR", ".llm_cache"),
+    "max_bytes": 200 * 1024 * 1024,  # 缓存目录大小上限，超出后按最近访问时间淘汰
+}
+
+# /metrics 指标配置
+METRICS_CONFIG = {
+    "loop_lag_interval": 0.5,  # 事件循环延迟采样间隔（秒）
+    "latency_buckets": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),  # 秒
+    "lag_buckets": (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),  # 秒
+    "bytes_buckets": (1024, 16 * 1024, 128 * 1024, 1024 * 1024, 8 * 1024 * 1024, 64 * 1024 * 1024),
+}
+
+# 日志管道：热路径上只入队，后台线程格式化后写滚动日志文件并转发给WebSocket订阅者
+LOGGING_CONFIG = {
+    "level": os.getenv("LOG_LEVEL", "INFO"),
+    "log_format": '%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+    "log_file": os.getenv("LOG_FILE", "browser_use.log"),  # 留空则不写文件
+    "max_bytes": 20 * 1024 * 1024,  # 单个日志文件上限，超出后滚动
+    "backup_count": 5,
+    "queue_size": 10000,  # 队列满时直接丢弃并计数，不阻塞事件循环
+    "logger_levels": {  # 按logger名前缀设置级别，最长前缀优先
+        "httpx": "WARNING",
+        "httpcore": "WARNING",
+        "websockets": "WARNING",
+        "asyncio": "WARNING",
+        "browser_use.dom": "INFO",
+    },
+    "rate_limits": {  # 按前缀匹配上限：每个logger在每个agent下每秒最多N条，超出丢弃并计数
+        "browser_use": 200,
+        "httpx": 20,
+    },
+    "rate_limit_default": 500,
+}
+
+# 设置日志
+logging.basicConfig(level=LOGGING_CONFIG["level"])
+logger = logging.getLogger(__name__)
+
+# 加载环境变量
+load_dotenv()
+
+# 应用启动时拉起托管Chrome，退出时关闭它们
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    chrome_supervisor.ensure_started()
+    try:
+        yield
+    finally:
+        await chrome_supervisor.stop_all()
+        await agent_manager.browser_pool.close_all()
+        await task_registry.flush()
+
+# 创建FastAPI应用
+app = FastAPI(title="Browser-Use Multi-Agent HTTP API", version="1.0.0", lifespan=lifespan)
+
+# 记录每个接口的耗时（按路由模板聚合，避免agent_id撑爆标签），顺带在HTTP事件循环上启动延迟采样
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    metrics.ensure_loop_lag_sampler("http")
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.http_latency.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            path=getattr(route, "path", "unmatched"),
+            status=status
+        )
+
+# 广播统计（在uvicorn事件循环上更新）
+broadcast_stats = {
+    "enqueued": 0,  # 成功入队的消息数（按客户端计）
+    "dropped": 0,  # 因客户端过慢被丢弃的消息数
+    "send_errors": 0,  # 发送失败次数
+}
+
+# 请求模型
+class AgentRequest(BaseModel):
+    cdp_url: Optional[str] = None  # 留空时由Chrome节点注册表分配负载最低的健康节点
+    model: str = "qwen2.5:7b"
+    host: str = "http://127.0.0.1:11434"
+    task: str
+    max_steps: int = 40
+    headless: bool = False
+    verbose: bool = True
+    priority: int = 0  # 排队优先级，数值越大越先调度；相同优先级先到先得
+    timeout: Optional[float] = None  # 任务总超时（秒），留空由模型路由按档位决定
+    tier: Optional[str] = None  # 指定路由档位（short/default/long），留空时自动分类
+    backend: str = "ollama"  # 主LLM后端：ollama（使用host）或 LLM_BACKENDS_CONFIG 中启用的后端名
+
+    @field_validator("tier")
+    @classmethod
+    def check_tier(cls, tier: Optional[str]) -> Optional[str]:
+        if tier is not None and tier not in MODEL_ROUTER_CONFIG["tiers"]:
+            raise ValueError(f"未知的路由档位: {tier}（可选 {', '.join(MODEL_ROUTER_CONFIG['tiers'])}）")
+        return tier
+
+    @field_validator("backend")
+    @classmethod
+    def check_backend(cls, backend: str) -> str:
+        if backend != "ollama" and backend not in LLM_BACKENDS_CONFIG["backends"]:
+            raise ValueError(f"未知的LLM后端: {backend}（可选 ollama, {', '.join(LLM_BACKENDS_CONFIG['backends'])}）")
+        return backend
+
+# 响应模型
+class AgentResponse(BaseModel):
+    success: bool
+    message: str
+    result: Any = None
+    error: str = None
+
+# 提交任务的响应模型
+class TaskSubmitResponse(AgentResponse):
+    task_id: str = None
+
+# 注册Chrome节点的请求模型
+class ChromeNodeRequest(BaseModel):
+    cdp_url: str
+    capacity: Optional[int] = None  # 留空使用 CHROME_NODES_CONFIG["default_capacity"]
+
+# 安全的调试输出
+def debug(msg):
+    sys.__stdout__.write(f"{msg}\n")
+    sys.__stdout__.flush()
+    logger.debug(msg)
+
+# 消息只编码一次，所有连接复用同一份帧；装了orjson就用orjson
+def encode_message(message_data) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(message_data).decode("utf-8")
+        except TypeError:
+            # orjson不支持的类型（如自定义对象）回退到标准库
+            pass
+    return json.dumps(message_data, ensure_ascii=False, default=str)
+
+# 协商批量参数，返回 (batch_ms, batch_size)；(0, 1) 表示不批量
+def negotiate_batching(batch_ms=0, batch_size=0):
+    try:
+        batch_ms = max(0, int(batch_ms or 0))
+        batch_size = max(0, int(batch_size or 0))
+    except (TypeError, ValueError):
+        return 0, 1
+    if not batch_ms and batch_size <= 1:
+        return 0, 1
+    batch_ms = min(batch_ms or BATCH_CONFIG["default_batch_ms"], BATCH_CONFIG["max_batch_ms"])
+    batch_size = min(batch_size or BATCH_CONFIG["default_batch_size"], BATCH_CONFIG["max_batch_size"])
+    return batch_ms, batch_size
+
+# 把已编码的消息拼成一个批量帧，不重新编码：{"type": "batch", "count": n, "messages": [...]}
+def build_batch_frame(frames: List[str]) -> str:
+    return f'{{"type": "batch", "count": {len(frames)}, "timestamp": {time.time()!r}, "messages": [{", ".join(frames)}]}}'
+
+# ========== Prometheus文本格式指标 ==========
+# 观测可能来自事件循环之外的线程（如日志后台线程），每个指标各持一把锁
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.series: Dict[tuple, list] = {}  # labels -> [各桶计数..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self.series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self, loop_lag_interval: float, latency_buckets, lag_buckets, bytes_buckets):
+        self.loop_lag_interval = loop_lag_interval
+        self._lag_samplers: Dict[str, asyncio.Task] = {}
+        self.loop_lag = Histogram("event_loop_lag_seconds", "事件循环调度延迟", lag_buckets)
+        self.http_latency = Histogram("http_request_duration_seconds", "HTTP接口耗时（按路由模板）", latency_buckets)
+        self.watchdog_actions = Counter("watchdog_actions_total", "看门狗处理结果（step_retry/model_downgrade/fail_fast/stalled）")
+        self.step_duration = Histogram("agent_step_duration_seconds", "Agent单步总耗时", latency_buckets)
+        self.step_llm = Histogram("agent_step_llm_seconds", "Agent单步中LLM推理耗时", latency_buckets)
+        self.step_browser = Histogram("agent_step_browser_seconds", "Agent单步中浏览器状态采集与动作执行耗时", latency_buckets)
+        self.queue_wait = Histogram("task_queue_wait_seconds", "任务在调度队列中的等待时间", latency_buckets)
+        self.tasks = Counter("tasks_total", "已结束的任务数（按最终状态）")
+        self.llm_backend_calls = Counter("llm_backend_calls_total", "各LLM后端的调用结果（success/failure/timeout/error）")
+        self.routes = Counter("model_routes_total", "模型路由决策（按档位和依据）")
+        self.ws_bytes = Counter("websocket_sent_bytes_total", "WebSocket发送的字节数")
+        self.ws_connection_bytes = Histogram("websocket_connection_sent_bytes", "每个WebSocket连接在断开前发送的字节数", bytes_buckets)
+        self.broadcast_queue = Gauge("broadcast_queue_depth", "全局WebSocket广播待发送消息数")
+
+    def ensure_loop_lag_sampler(self, loop_name: str):
+        # 在调用方所在的事件循环上懒启动采样协程
+        task = self._lag_samplers.get(loop_name)
+        if task is None or task.done():
+            self._lag_samplers[loop_name] = asyncio.create_task(self._sample_loop_lag(loop_name))
+
+    async def _sample_loop_lag(self, loop_name: str):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.loop_lag_interval
+            await asyncio.sleep(self.loop_lag_interval)
+            self.loop_lag.observe(max(0.0, loop.time() - expected), loop=loop_name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.loop_lag, self.http_latency, self.step_duration, self.step_llm, self.step_browser,
+                       self.queue_wait, self.tasks, self.watchdog_actions, self.routes, self.llm_backend_calls, self.ws_bytes,
+                       self.ws_connection_bytes, self.broadcast_queue):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry(**METRICS_CONFIG)
+
+def encoded_size(frame: str) -> int:
+    return len(frame) if frame.isascii() else len(frame.encode("utf-8"))
+
+# 全局WebSocket客户端：有界发送队列 + 独立发送协程，慢客户端不会阻塞广播方
+class GlobalWebSocketClient:
+    def __init__(self, websocket, max_queue=None, drop_policy=None, batch_ms=0, batch_size=1):
+        self.websocket = websocket
+        self.batch_ms = batch_ms  # 大于0时开启批量推送
+        self.batch_size = batch_size
+        self.agent_ids = set()  # 已订阅的agent_id，为空表示接收全部
+        self.message_types = None  # 消息类型过滤（log/step/status/error...），None表示不过滤
+        self.max_queue = max_queue or BROADCAST_CONFIG["client_queue_size"]
+        self.drop_policy = drop_policy or BROADCAST_CONFIG["drop_policy"]
+        self.queue = deque()
+        self.dropped = 0
+        self.bytes_sent = 0
+        self._pending_dropped = 0  # 自上次发送以来丢弃的条数，合并成一条提示发出
+        self._wakeup = asyncio.Event()
+        self._closed = False
+
+    def enqueue(self, frame: str) -> bool:
+        # 只能在事件循环线程上调用
+        if self._closed:
+            return False
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            self._pending_dropped += 1
+            broadcast_stats["dropped"] += 1
+            if self.drop_policy == "drop_newest":
+                return False
+            self.queue.popleft()
+        self.queue.append(frame)
+        broadcast_stats["enqueued"] += 1
+        self._wakeup.set()
+        return True
+
+    async def sender(self):
+        while not self._closed:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            try:
+                if self._pending_dropped:
+                    notice = encode_message({
+                        "type": "warning",
+                        "message": f"客户端处理过慢，已丢弃 {self._pending_dropped} 条消息",
+                        "dropped": self._pending_dropped,
+                        "timestamp": time.time()
+                    })
+                    self._pending_dropped = 0
+                    await self.websocket.send_text(notice)
+                if self.batch_ms:
+                    await self._wait_for_batch()
+                    count = min(self.batch_size, len(self.queue))
+                    if not count:
+                        continue
+                    frame = build_batch_frame([self.queue.popleft() for _ in range(count)])
+                else:
+                    frame = self.queue.popleft()
+                await self.websocket.send_text(frame)
+                self._count_bytes(encoded_size(frame))
+            except Exception as e:
+                broadcast_stats["send_errors"] += 1
+                debug(f"[WS] 发送消息失败，停止向该客户端发送: {e}")
+                self.close()
+
+    def _count_bytes(self, size: int):
+        self.bytes_sent += size
+        metrics.ws_bytes.inc(size, endpoint="global")
+
+    async def _wait_for_batch(self):
+        # 等到攒够batch_size条或时间窗口结束
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_ms / 1000
+        while len(self.queue) < self.batch_size and not self._closed:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+
+    def close(self):
+        if not self._closed:
+            metrics.ws_connection_bytes.observe(self.bytes_sent, endpoint="global")
+        self._closed = True
+        self.queue.clear()
+        self._wakeup.set()
+
+# 订阅索引：agent_id -> 客户端集合；未订阅任何agent的客户端接收全部消息
+class GlobalSubscriptionIndex:
+    def __init__(self):
+        self.by_agent: Dict[str, set] = {}
+        self.firehose: set = set()
+
+    def add_client(self, client: GlobalWebSocketClient):
+        self.firehose.add(client)
+
+    def subscribe(self, client: GlobalWebSocketClient, agent_ids, message_types=None):
+        if message_types is not None:
+            client.message_types = set(message_types) or None
+        for agent_id in agent_ids:
+            self.by_agent.setdefault(agent_id, set()).add(client)
+            client.agent_ids.add(agent_id)
+        if client.agent_ids:
+            self.firehose.discard(client)
+
+    def unsubscribe(self, client: GlobalWebSocketClient, agent_ids=None):
+        # agent_ids为空时取消全部订阅，客户端重新接收全部消息
+        for agent_id in list(agent_ids or client.agent_ids):
+            subscribers = self.by_agent.get(agent_id)
+            if subscribers is not None:
+                subscribers.discard(client)
+                if not subscribers:
+                    del self.by_agent[agent_id]
+            client.agent_ids.discard(agent_id)
+        if not client.agent_ids:
+            self.firehose.add(client)
+
+    def remove_client(self, client: GlobalWebSocketClient):
+        self.unsubscribe(client)
+        self.firehose.discard(client)
+
+    def route(self, agent_id, message_type):
+        # 代价只与该agent的订阅者数量（加上未订阅客户端数量）有关
+        subscribers = self.by_agent.get(agent_id, ()) if agent_id is not None else ()
+        for group in (subscribers, self.firehose):
+            for client in group:
+                if client.message_types is None or message_type in client.message_types:
+                    yield client
+
+# 进程内事件总线：Agent的step/log/status/error事件按agent_id分发给订阅者（如SSE流），
+# 全量订阅者（全局WebSocket）收到所有事件；SSE和全局WebSocket都由这里统一供给
+class AgentEventBus:
+    def __init__(self, max_queue: int = 1000):
+        self.max_queue = max_queue
+        self.subscribers: Dict[str, set] = {}
+        self.firehose: List[Any] = []  # 全量订阅回调，在事件循环上同步调用
+        self.loop = None  # 订阅者所在的事件循环（uvicorn）
+        self.stats = {"published": 0, "delivered": 0, "dropped": 0}
+
+    def subscribe(self, agent_id: str) -> asyncio.Queue:
+        self.loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.max_queue)
+        self.subscribers.setdefault(agent_id, set()).add(queue)
+        return queue
+
+    def subscribe_all(self, callback):
+        self.loop = asyncio.get_running_loop()
+        if callback not in self.firehose:
+            self.firehose.append(callback)
+
+    def unsubscribe_all(self, callback):
+        if callback in self.firehose:
+            self.firehose.remove(callback)
+
+    def unsubscribe(self, agent_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(agent_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[agent_id]
+
+    def publish(self, message_data: Dict[str, Any]):
+        # 可以在任意线程调用；在事件循环上调用时直接分发，没有订阅者时只是一次字典查找
+        if self.loop is None or (not self.firehose and message_data.get("agent_id") not in self.subscribers):
+            return
+        self.stats["published"] += 1
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            self._deliver(message_data)
+        else:
+            try:
+                self.loop.call_soon_threadsafe(self._deliver, message_data)
+            except RuntimeError:
+                pass
+
+    def _deliver(self, message_data: Dict[str, Any]):
+        for queue in list(self.subscribers.get(message_data.get("agent_id"), ())):
+            if queue.full():
+                # 订阅者跟不上时丢弃最旧的事件
+                queue.get_nowait()
+                self.stats["dropped"] += 1
+            queue.put_nowait(message_data)
+            self.stats["delivered"] += 1
+        for callback in self.firehose:
+            callback(message_data)
+
+    def get_stats(self):
+        return {**self.stats, "subscribed_agents": len(self.subscribers)}
+
+event_bus = AgentEventBus()
+
+# 广播日志消息（支持agent_id区分）；交给事件总线，不等待任何客户端
+def broadcast_log_message(message, message_type="log", agent_id=None, **extra):
+    event_bus.publish({
+        "type": message_type,
+        "message": message,
+        "agent_id": agent_id,  # 添加 agent_id 字段用于区分
+        "timestamp": time.time(),
+        **extra
+    })
+
+def get_broadcast_stats():
+    clients = list(websocket_manager.global_clients)
+    return {
+        **broadcast_stats,
+        "queued": sum(len(c.queue) for c in clients),
+        "max_client_queue": max((len(c.queue) for c in clients), default=0),
+        "subscribed_agents": len(websocket_manager.subscriptions.by_agent),
+        "drop_policy": BROADCAST_CONFIG["drop_policy"],
+    }
+
+# 当前运行的agent_id：WebSocketAgent.run 在自己的任务上下文里设置，子任务自动继承，
+# 并发Agent之间互不影响（进程级的stdout重定向会互相覆盖，导致日志串到别的agent上）
+current_agent_id: contextvars.ContextVar = contextvars.ContextVar("current_agent_id", default=None)
+
+@contextlib.contextmanager
+def agent_log_context(agent_id: str):
+    token = current_agent_id.set(agent_id)
+    try:
+        yield
+    finally:
+        current_agent_id.reset(token)
+
+# 给日志记录打上当前agent_id（已显式传入extra={"agent_id": ...}的不覆盖）
+class AgentContextFilter(logging.Filter):
+    def filter(self, record):
+        if getattr(record, "agent_id", None) is None:
+            record.agent_id = current_agent_id.get()
+        return True
+
+# 标准输出流拦截：只在入口处安装一次，按当前上下文的agent_id归属；
+# 不逐次flush，未写完的行按agent分别缓冲，避免并发输出拼接到同一行
+class TeeLoggerStream:
+    def __init__(self, original_stream, agent_id=None):
+        self.original_stream = original_stream
+        self.agent_id = agent_id
+        self._pending: Dict[Optional[str], List[str]] = {}
+
+    def write(self, message):
+        self.original_stream.write(message)
+        agent_id = self.agent_id or current_agent_id.get()
+        if "\n" not in message:
+            if message:
+                self._pending.setdefault(agent_id, []).append(message)
+            return len(message)
+        pending = self._pending.pop(agent_id, None)
+        lines = ("".join(pending) + message if pending else message).split("\n")
+        for line in lines[:-1]:
+            line = line.strip()
+            if line:
+                broadcast_log_message(line, agent_id=agent_id)
+        if lines[-1]:
+            self._pending[agent_id] = [lines[-1]]
+        return len(message)
+
+    def flush(self):
+        self.original_stream.flush()
+
+    def isatty(self):
+        return self.original_stream.isatty()
+
+    def close(self):
+        pass
+
+# logging handler → 广播
+class BroadcastingHandler(logging.Handler):
+    def __init__(self, agent_id=None):
+        super().__init__()
+        self.agent_id = agent_id
+        self.addFilter(AgentContextFilter())
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            broadcast_log_message(msg, message_type="log", agent_id=self.agent_id or record.agent_id)
+        except Exception as e:
+            debug(f"[WS] 广播 handler 异常: {e}")
+
+# 清除所有已有handler并附加广播handler
+def attach_handler_to_all_loggers(*handlers, level=logging.INFO):
+    for name in logging.root.manager.loggerDict:
+        logging.getLogger(name).handlers.clear()
+    logging.getLogger().handlers.clear()
+
+    loggers = [logging.getLogger(name) for name in logging.root.manager.loggerDict]
+    loggers.append(logging.getLogger())
+    for logger in loggers:
+        for handler in handlers:
+            if handler not in logger.handlers:
+                logger.addHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = False
+
+# 按logger名前缀匹配配置项（最长前缀优先），结果按logger名缓存。
+# browser_use每个Agent/BrowserSession都有自己的logger名，缓存满了整体清空重建
+class LoggerPrefixMap:
+    def __init__(self, mapping: Dict[str, Any], default=None, max_cache: int = 1024):
+        self.prefixes = sorted(mapping.items(), key=lambda item: len(item[0]), reverse=True)
+        self.default = default
+        self.max_cache = max_cache
+        self.cache: Dict[str, Any] = {}
+
+    def lookup(self, name: str):
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+        match = (None, self.default)
+        for prefix, value in self.prefixes:
+            if name == prefix or name.startswith(prefix + "."):
+                match = (prefix, value)
+                break
+        if len(self.cache) >= self.max_cache:
+            self.cache.clear()
+        self.cache[name] = match
+        return match
+
+# 按logger设置的级别过滤（attach_handler_to_all_loggers会把所有logger统一设成同一级别）
+class LoggerLevelFilter(logging.Filter):
+    def __init__(self, logger_levels: Dict[str, str]):
+        super().__init__()
+        self.levels = LoggerPrefixMap({name: logging.getLevelName(level) for name, level in logger_levels.items()})
+        self.filtered = 0
+
+    def filter(self, record):
+        level = self.levels.lookup(record.name)[1]
+        if level is not None and record.levelno < level:
+            self.filtered += 1
+            return False
+        return True
+
+# 噪声logger限流：按logger和agent分别按秒计数，超出的记录直接丢弃（WARNING及以上不限流）。
+# 过期的计数窗口每秒清理一次，丢弃数按匹配到的配置前缀汇总，不随Agent数增长
+class LogRateLimiter(logging.Filter):
+    def __init__(self, rate_limits: Dict[str, int], default_limit: int):
+        super().__init__()
+        self.limits = LoggerPrefixMap(rate_limits, default_limit)
+        self.windows: Dict[tuple, List[float]] = {}
+        self.dropped: Dict[str, int] = {}
+        self._last_sweep = time.monotonic()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        prefix, limit = self.limits.lookup(record.name)
+        if not limit:
+            return True
+        key = (record.name, getattr(record, "agent_id", None))
+        now = time.monotonic()
+        if now - self._last_sweep >= 1:
+            self._last_sweep = now
+            self.windows = {k: w for k, w in self.windows.items() if now - w[0] < 1}
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= 1:
+            self.windows[key] = [now, 1]
+            return True
+        if window[1] < limit:
+            window[1] += 1
+            return True
+        group = prefix or "default"
+        self.dropped[group] = self.dropped.get(group, 0) + 1
+        return False
+
+# 入队前只合并消息参数、展开异常堆栈（traceback会持有栈帧），时间戳和格式化留给后台线程
+class AgentQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.enqueued = 0
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+# 日志管道：AgentQueueHandler挂到所有logger上，QueueListener在后台线程把记录交给文件/广播handler
+class LoggingPipeline:
+    def __init__(self, level: str, log_format: str, log_file: str, max_bytes: int, backup_count: int,
+                 queue_size: int, logger_levels: Dict[str, str], rate_limits: Dict[str, int], rate_limit_default: int):
+        self.level = logging.getLevelName(level)
+        self.log_format = log_format
+        self.log_file = log_file
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.level_filter = LoggerLevelFilter(logger_levels)
+        self.rate_limiter = LogRateLimiter(rate_limits, rate_limit_default)
+        self.handler = AgentQueueHandler(queue.Queue(maxsize=queue_size))
+        # agent_id要在产生日志的上下文里取，所以在入队前打标
+        for log_filter in (AgentContextFilter(), self.level_filter, self.rate_limiter):
+            self.handler.addFilter(log_filter)
+        self.listener = None
+
+    def build_handlers(self) -> List[logging.Handler]:
+        handlers: List[logging.Handler] = [BroadcastingHandler()]
+        if self.log_file:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                self.log_file, maxBytes=self.max_bytes, backupCount=self.backup_count, encoding="utf-8"))
+        formatter = logging.Formatter(self.log_format)
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        return handlers
+
+    def start(self, *handlers: logging.Handler):
+        if self.listener is not None:
+            return
+        self.listener = logging.handlers.QueueListener(
+            self.handler.queue, *(handlers or self.build_handlers()), respect_handler_level=True)
+        self.listener.start()
+        attach_handler_to_all_loggers(self.handler, level=self.level)
+
+    def stop(self):
+        # 停止前会把队列里剩余的记录处理完
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+
+    def get_stats(self):
+        return {
+            "running": self.listener is not None,
+            "queued": self.handler.queue.qsize(),
+            "enqueued": self.handler.enqueued,
+            "dropped_queue_full": self.handler.dropped,
+            "filtered_by_level": self.level_filter.filtered,
+            "rate_limited": dict(self.rate_limiter.dropped),
+        }
+
+logging_pipeline = LoggingPipeline(**LOGGING_CONFIG)
+
+# FastAPI WebSocket 的批量发送器：攒够batch_size条或batch_ms到期后合并成一帧发送
+class MessageBatcher:
+    def __init__(self, websocket: WebSocket, batch_ms: int, batch_size: int):
+        self.websocket = websocket
+        self.batch_ms = batch_ms
+        self.batch_size = batch_size
+        self.frames: List[str] = []
+        self.failed = False
+        self._timer = None
+        self._lock = asyncio.Lock()  # 保证批次按顺序发出
+        self._tasks = set()
+
+    def add(self, frame: str):
+        self.frames.append(frame)
+        if len(self.frames) >= self.batch_size:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.batch_ms / 1000, self._schedule_flush)
+
+    def _schedule_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.frames:
+            return
+        frames, self.frames = self.frames, []
+        task = asyncio.create_task(self._flush(frames))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, frames: List[str]):
+        async with self._lock:
+            if self.failed:
+                return
+            try:
+                await self.websocket.send_text(build_batch_frame(frames))
+            except Exception as e:
+                self.failed = True
+                debug(f"[FastAPI WS] 批量发送失败: {e}")
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.frames = []
+
+# WebSocket连接管理器：/ws/{agent_id} 按agent_id隔离的连接，以及全局WebSocket（原7789协议）的客户端。
+# 两者都由事件总线供给：每个有连接的agent_id订阅一个队列，由该agent的发送协程编码一次后推给所有连接
+class WebSocketManager:
+    def __init__(self):
+        self.active_connections: Dict[str, List[WebSocket]] = {}
+        self.agent_streams: Dict[str, tuple] = {}  # agent_id -> (事件总线队列, 发送协程)
+        self.batchers: Dict[WebSocket, MessageBatcher] = {}
+        self.bytes_sent: Dict[WebSocket, int] = {}
+        self.last_activity: Dict[str, float] = {}  # agent_id -> 最近一次连接或发送的时间
+        self.global_clients: set = set()
+        self.subscriptions = GlobalSubscriptionIndex()
+
+    async def connect_global(self, websocket: WebSocket, batch_ms: int = 0, batch_size: int = 1) -> GlobalWebSocketClient:
+        await websocket.accept()
+        client = GlobalWebSocketClient(websocket, batch_ms=batch_ms, batch_size=batch_size)
+        self.global_clients.add(client)
+        self.subscriptions.add_client(client)
+        # 有全局客户端时才向事件总线订阅全部事件
+        event_bus.subscribe_all(self.dispatch_global)
+        debug(f"[WS] 客户端已连接，当前连接数: {len(self.global_clients)}")
+        return client
+
+    def disconnect_global(self, client: GlobalWebSocketClient):
+        client.close()
+        self.subscriptions.remove_client(client)
+        self.global_clients.discard(client)
+        if not self.global_clients:
+            event_bus.unsubscribe_all(self.dispatch_global)
+        debug(f"[WS] 客户端断开连接，剩余连接数: {len(self.global_clients)}")
+
+    # 事件总线回调：消息只编码一次，放入订阅了该agent_id的客户端或未订阅客户端的发送队列
+    def dispatch_global(self, message_data: Dict[str, Any]):
+        frame = None
+        for client in self.subscriptions.route(message_data.get("agent_id"), message_data.get("type")):
+            try:
+                if frame is None:
+                    frame = encode_message(message_data)
+                client.enqueue(frame)
+            except Exception as e:
+                broadcast_stats["send_errors"] += 1
+                debug(f"[WS] 分发消息失败: {e}")
+    
+    async def connect(self, websocket: WebSocket, agent_id: str, batch_ms: int = 0, batch_size: int = 1,
+                      greeting: List[Dict[str, Any]] = ()):
+        await websocket.accept()
+        # 欢迎消息先于该agent的事件发出
+        for message_data in greeting:
+            await websocket.send_text(encode_message(message_data))
+        if agent_id not in self.active_connections:
+            self.active_connections[agent_id] = []
+        self.active_connections[agent_id].append(websocket)
+        if batch_ms:
+            self.batchers[websocket] = MessageBatcher(websocket, batch_ms, batch_size)
+        self.bytes_sent[websocket] = 0
+        self.last_activity[agent_id] = time.monotonic()
+        if agent_id not in self.agent_streams:
+            queue = event_bus.subscribe(agent_id)
+            self.agent_streams[agent_id] = (queue, asyncio.create_task(self._stream_agent(agent_id, queue)))
+        debug(f"[FastAPI WS] WebSocket已连接到Agent: {agent_id}")
+    
+    def disconnect(self, websocket: WebSocket, agent_id: str):
+        if agent_id in self.active_connections:
+            if websocket in self.active_connections[agent_id]:
+                self.active_connections[agent_id].remove(websocket)
+            if not self.active_connections[agent_id]:
+                del self.active_connections[agent_id]
+                self.last_activity.pop(agent_id, None)
+                # 最后一个连接断开后退订
+                stream = self.agent_streams.pop(agent_id, None)
+                if stream is not None:
+                    event_bus.unsubscribe(agent_id, stream[0])
+                    if stream[1] is not asyncio.current_task():
+                        stream[1].cancel()
+        batcher = self.batchers.pop(websocket, None)
+        if batcher is not None:
+            batcher.close()
+        sent = self.bytes_sent.pop(websocket, None)
+        if sent is not None:
+            metrics.ws_connection_bytes.observe(sent, endpoint="agent", **agent_metric_labels(agent_id))
+        debug(f"[FastAPI WS] WebSocket已断开连接Agent: {agent_id}")
+
+    async def _stream_agent(self, agent_id: str, queue: asyncio.Queue):
+        while True:
+            message_data = await queue.get()
+            await self._send_frame(agent_id, encode_message(message_data))
+            # 发送失败时disconnect可能就在本任务里退订（无法cancel自己），队列不再登记就退出
+            if self.agent_streams.get(agent_id, (None,))[0] is not queue:
+                return
+    
+    async def _send_frame(self, agent_id: str, frame: str):
+        connections = self.active_connections.get(agent_id)
+        if not connections:
+            return
+        self.last_activity[agent_id] = time.monotonic()
+        size = encoded_size(frame)
+        disconnected = []
+        for connection in list(connections):
+            try:
+                batcher = self.batchers.get(connection)
+                if batcher is None:
+                    await connection.send_text(frame)
+                elif batcher.failed:
+                    disconnected.append(connection)
+                    continue
+                else:
+                    batcher.add(frame)
+                self.bytes_sent[connection] = self.bytes_sent.get(connection, 0) + size
+                metrics.ws_bytes.inc(size, endpoint="agent", **agent_metric_labels(agent_id))
+            except Exception as e:
+                debug(f"[FastAPI WS] 发送消息失败: {e}")
+                disconnected.append(connection)
+        
+        for connection in disconnected:
+            self.disconnect(connection, agent_id)
+
+    def stale_agents(self, ttl: float, live_agent_ids) -> List[str]:
+        # Agent已不存在且超过ttl没有任何消息的连接
+        now = time.monotonic()
+        return [
+            agent_id for agent_id in self.active_connections
+            if agent_id not in live_agent_ids and now - self.last_activity.get(agent_id, 0) > ttl
+        ]
+    
+    async def close_agent(self, agent_id: str, reason: str) -> int:
+        connections = list(self.active_connections.get(agent_id, []))
+        await self._send_frame(agent_id, encode_message({
+            "type": "status", "message": reason, "agent_id": agent_id, "timestamp": time.time()
+        }))
+        for connection in connections:
+            try:
+                await connection.close(code=1000)
+            except Exception as e:
+                debug(f"[FastAPI WS] 关闭连接失败: {e}")
+            self.disconnect(connection, agent_id)
+        return len(connections)
+
+class SchedulerQueueFull(Exception):
+    pass
+
+# 调度器的LLM限流键：Ollama按host，OpenAI兼容后端按后端名，不占用本地Ollama的槽位
+def llm_limit_key(backend: str, host: str) -> str:
+    return host if backend == "ollama" else backend
+
+# Agent并发调度器：全局/每个cdp_url/每个LLM后端三级并发上限，超出部分按优先级+FIFO排队
+class AgentScheduler:
+    def __init__(self, max_concurrency: int, per_cdp_url_limit: int, per_llm_host_limit: int, max_queue_size: int):
+        self.max_concurrency = max_concurrency
+        self.per_cdp_url_limit = per_cdp_url_limit
+        self.cdp_url_limits: Dict[str, int] = {}  # 单独设置上限的cdp_url（Chrome节点容量）
+        self.per_llm_host_limit = per_llm_host_limit
+        self.max_queue_size = max_queue_size
+        self.running = 0
+        self.running_by_cdp_url: Dict[str, int] = {}
+        self.running_by_host: Dict[str, int] = {}
+        self._waiters = []  # 堆：(-priority, 序号, waiter)
+        self._seq = itertools.count()
+        self.wait_times = deque(maxlen=500)  # 最近的排队等待时间（秒）
+        self.stats = {"admitted": 0, "rejected": 0, "released": 0}
+
+    def _can_admit(self, cdp_url: str, host: str) -> bool:
+        return (self.running < self.max_concurrency
+                and self.running_by_cdp_url.get(cdp_url, 0) < self.cdp_url_limits.get(cdp_url, self.per_cdp_url_limit)
+                and self.running_by_host.get(host, 0) < self.per_llm_host_limit)
+
+    def _admit(self, cdp_url: str, host: str, enqueued_at: float):
+        self.running += 1
+        self.running_by_cdp_url[cdp_url] = self.running_by_cdp_url.get(cdp_url, 0) + 1
+        self.running_by_host[host] = self.running_by_host.get(host, 0) + 1
+        self.stats["admitted"] += 1
+        self.wait_times.append(time.monotonic() - enqueued_at)
+
+    def is_full(self) -> bool:
+        return len(self._waiters) >= self.max_queue_size
+
+    def would_wait(self, cdp_url: str, host: str) -> bool:
+        return not self._can_admit(cdp_url, host)
+
+    async def acquire(self, cdp_url: str, host: str, priority: int = 0):
+        enqueued_at = time.monotonic()
+        # 能立即运行说明排队中的任务都被各自的cdp_url/host上限卡住，不会插队
+        if self._can_admit(cdp_url, host):
+            self._admit(cdp_url, host, enqueued_at)
+            return
+        if self.is_full():
+            self.stats["rejected"] += 1
+            raise SchedulerQueueFull(f"任务队列已满（{self.max_queue_size}）")
+        waiter = {
+            "future": asyncio.get_running_loop().create_future(),
+            "cdp_url": cdp_url,
+            "host": host,
+            "enqueued_at": enqueued_at,
+        }
+        entry = (-priority, next(self._seq), waiter)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await waiter["future"]
+        except asyncio.CancelledError:
+            if waiter["future"].done() and not waiter["future"].cancelled():
+                # 已分配到槽位但调用方被取消，归还槽位
+                self.release(cdp_url, host)
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+    def release(self, cdp_url: str, host: str):
+        self.running -= 1
+        self.running_by_cdp_url[cdp_url] -= 1
+        if not self.running_by_cdp_url[cdp_url]:
+            del self.running_by_cdp_url[cdp_url]
+        self.running_by_host[host] -= 1
+        if not self.running_by_host[host]:
+            del self.running_by_host[host]
+        self.stats["released"] += 1
+        self._dispatch()
+
+    def _dispatch(self):
+        # 按优先级顺序唤醒可以运行的任务；被自身cdp_url/host上限卡住的任务不阻塞后面的任务
+        remaining = []
+        for entry in sorted(self._waiters):
+            waiter = entry[2]
+            if waiter["future"].done():
+                continue
+            if self._can_admit(waiter["cdp_url"], waiter["host"]):
+                self._admit(waiter["cdp_url"], waiter["host"], waiter["enqueued_at"])
+                waiter["future"].set_result(None)
+            else:
+                remaining.append(entry)
+        heapq.heapify(remaining)
+        self._waiters = remaining
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cdp_url: str, host: str, priority: int = 0):
+        await self.acquire(cdp_url, host, priority)
+        try:
+            yield
+        finally:
+            self.release(cdp_url, host)
+
+    def get_stats(self):
+        waits = sorted(self.wait_times)
+        now = time.monotonic()
+        return {
+            **self.stats,
+            "running": self.running,
+            "queued": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "running_by_cdp_url": dict(self.running_by_cdp_url),
+            "running_by_host": dict(self.running_by_host),
+            "oldest_queued_seconds": round(max((now - e[2]["enqueued_at"] for e in self._waiters), default=0.0), 3),
+            "wait_seconds": {
+                "avg": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                "p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+                "max": round(waits[-1], 3) if waits else 0.0,
+            },
+        }
+
+TASK_TERMINAL_STATES = ("completed", "failed", "timeout", "cancelled", "stalled")
+
+# 提取AgentHistoryList的摘要，只保留可序列化的关键信息
+def summarize_history(history) -> Dict[str, Any]:
+    if history is None:
+        return None
+    try:
+        summary = {
+            "final_result": history.final_result(),
+            "is_done": history.is_done(),
+            "is_successful": history.is_successful(),
+            "steps": history.number_of_steps(),
+            "duration_seconds": round(history.total_duration_seconds(), 3),
+            "errors": [error for error in history.errors() if error],
+            "urls": [url for url in history.urls() if url],
+        }
+        if getattr(history, "usage", None) is not None:
+            summary["usage"] = history.usage.model_dump()
+        return summary
+    except Exception as e:
+        debug(f"提取任务结果摘要失败: {e}")
+        return {"final_result": str(history)}
+
+# 任务没有正常完成时（超时/卡死/取消/失败）也保留已执行步骤的耗时和看门狗记录，慢任务和卡死任务最需要这些信息
+def agent_diagnostics(agent) -> Optional[Dict[str, Any]]:
+    if agent is None:
+        return None
+    return {"timings": agent.step_timings, "watchdog": agent.watchdog_events}
+
+# 任务记录：状态流转 pending -> queued -> running -> completed/failed/timeout/cancelled/stalled
+class TaskRegistry:
+    def __init__(self, max_records: int, retention_seconds: int, persist_path: str = None):
+        self.max_records = max_records
+        self.retention_seconds = retention_seconds
+        self.persist_path = persist_path
+        self.tasks: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # 持久化文件是追加写的JSONL，每次任务结束只追加这一条记录；行数超过上限后在后台线程整体压缩
+        self.compact_after = max_records * 2
+        self._file_lines = 0
+        self._pending_lines: List[str] = []
+        self._compact_requested = False
+        self._writer_task: Optional[asyncio.Task] = None
+        self._load()
+
+    def create(self, task_id: str, request: AgentRequest, route: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        now = time.time()
+        record = {
+            "task_id": task_id,
+            "agent_id": task_id,
+            "task": request.task,
+            "model": request.model,
+            "host": request.host,
+            "cdp_url": request.cdp_url,
+            "max_steps": request.max_steps,
+            "timeout": request.timeout,
+            "route": route,
+            "status": "pending",
+            "message": "任务已提交",
+            "progress": 0.0,
+            "steps": 0,
+            "created_at": now,
+            "start_time": None,
+            "end_time": None,
+            "queue_wait_seconds": None,
+            "duration_seconds": None,
+            "result": None,
+            "error": None,
+            "transitions": [{"status": "pending", "time": now}],
+        }
+        self.tasks[task_id] = record
+        self._evict()
+        return record
+
+    def get(self, task_id: str) -> Dict[str, Any]:
+        return self.tasks.get(task_id)
+
+    def update(self, task_id: str, status: str = None, message: str = None, **fields):
+        record = self.tasks.get(task_id)
+        if record is None:
+            return None
+        now = time.time()
+        record.update(fields)
+        if message is not None:
+            record["message"] = message
+        if status is not None and status != record["status"]:
+            record["status"] = status
+            record["transitions"].append({"status": status, "time": now})
+            if status == "running":
+                record["start_time"] = now
+                record["queue_wait_seconds"] = round(now - record["created_at"], 3)
+            elif status in TASK_TERMINAL_STATES:
+                record["end_time"] = now
+                if record["start_time"] is not None:
+                    record["duration_seconds"] = round(now - record["start_time"], 3)
+                if status == "completed":
+                    record["progress"] = 1.0
+                self._evict()
+                self._persist(record)
+        return record
+
+    def record_step(self, task_id: str, steps: int):
+        record = self.tasks.get(task_id)
+        if record is None:
+            return
+        record["steps"] = steps
+        if record["max_steps"]:
+            record["progress"] = min(1.0, steps / record["max_steps"])
+
+    def summary(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for record in self.tasks.values():
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+        return counts
+
+    def clear_finished(self) -> int:
+        finished = [task_id for task_id, record in self.tasks.items() if record["status"] in TASK_TERMINAL_STATES]
+        for task_id in finished:
+            del self.tasks[task_id]
+        if finished:
+            self._compact_requested = True
+            self._ensure_writer()
+        return len(finished)
+
+    def _evict(self):
+        # 先淘汰超过保留时长的已结束任务，再按提交顺序淘汰超出数量上限的已结束任务
+        now = time.time()
+        finished = [
+            task_id for task_id, record in self.tasks.items()
+            if record["status"] in TASK_TERMINAL_STATES
+        ]
+        expired = [task_id for task_id in finished if now - self.tasks[task_id]["end_time"] > self.retention_seconds]
+        overflow = max(0, len(self.tasks) - len(expired) - self.max_records)
+        for task_id in expired + [t for t in finished if t not in expired][:overflow]:
+            del self.tasks[task_id]
+
+    def _persist(self, record: Dict[str, Any]):
+        if not self.persist_path:
+            return
+        try:
+            self._pending_lines.append(json.dumps(record, ensure_ascii=False, default=str))
+        except Exception as e:
+            debug(f"序列化任务记录失败: {e}")
+            return
+        self._ensure_writer()
+
+    def _ensure_writer(self):
+        if not self.persist_path:
+            return
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.create_task(self._write_loop())
+
+    async def _write_loop(self):
+        # 文件读写都放到线程里，事件循环上只做单条记录的序列化
+        while self._pending_lines or self._compact_requested:
+            try:
+                if self._compact_requested or self._file_lines + len(self._pending_lines) > self.compact_after:
+                    self._compact_requested = False
+                    self._pending_lines.clear()  # 压缩后的快照已经包含这些记录
+                    snapshot = [record for record in self.tasks.values() if record["status"] in TASK_TERMINAL_STATES]
+                    self._file_lines = await asyncio.to_thread(self._rewrite, snapshot)
+                else:
+                    lines, self._pending_lines = self._pending_lines, []
+                    await asyncio.to_thread(self._append, lines)
+                    self._file_lines += len(lines)
+            except Exception as e:
+                debug(f"保存任务记录失败: {e}")
+
+    def _append(self, lines: List[str]):
+        with open(self.persist_path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def _rewrite(self, records: List[Dict[str, Any]]) -> int:
+        tmp_path = f"{self.persist_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        os.replace(tmp_path, self.persist_path)
+        return len(records)
+
+    async def flush(self):
+        if self._writer_task is not None and not self._writer_task.done():
+            await self._writer_task
+
+    def _load(self):
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        records = []
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        debug("跳过损坏的任务记录行")  # 进程在追加写时退出，最后一行可能不完整
+        except Exception as e:
+            debug(f"加载任务记录失败: {e}")
+            return
+        self._file_lines = len(records)
+        now = time.time()
+        # 同一任务可能追加过多次，后写入的覆盖先写入的
+        for record in records:
+            self.tasks.pop(record["task_id"], None)
+            # 服务重启前未结束的任务已经无法继续
+            if record.get("status") not in TASK_TERMINAL_STATES:
+                record["status"] = "failed"
+                record["error"] = "服务重启，任务中断"
+                record["end_time"] = now
+                record.setdefault("transitions", []).append({"status": "failed", "time": now})
+            self.tasks[record["task_id"]] = record
+        self._evict()
+        debug(f"已加载 {len(self.tasks)} 条任务记录")
+
+# 模型路由：按任务文本分到short/default/long档位，为请求补上未显式指定的model、max_steps和timeout。
+# 模板是把网址、引号内容和数字替换掉后的任务文本，同模板任务完成后的步数用于之后的分档
+class ModelRouter:
+    def __init__(self, enabled: bool, tiers: Dict[str, Dict[str, Any]], templates: List[tuple],
+                 short_keywords: List[str], long_keywords: List[str], short_max_chars: int, long_min_chars: int,
+                 long_min_clauses: int, history_min_samples: int, history_window: int,
+                 short_max_history_steps: float, long_min_history_steps: float, max_templates: int):
+        self.enabled = enabled
+        self.tiers = tiers
+        self.templates = [(re.compile(pattern, re.IGNORECASE), tier) for pattern, tier in templates]
+        self.short_keywords = [self._keyword_pattern(keyword) for keyword in short_keywords]
+        self.long_keywords = [self._keyword_pattern(keyword) for keyword in long_keywords]
+        self.short_max_chars = short_max_chars
+        self.long_min_chars = long_min_chars
+        self.long_min_clauses = long_min_clauses
+        self.history_min_samples = history_min_samples
+        self.history_window = history_window
+        self.short_max_history_steps = short_max_history_steps
+        self.long_min_history_steps = long_min_history_steps
+        self.max_templates = max_templates
+        self.history: "OrderedDict[str, deque]" = OrderedDict()  # 模板 -> 最近完成任务的步数
+        self.stats = {"routed": 0, "by_tier": {}, "by_source": {}}
+
+    @staticmethod
+    def _keyword_pattern(keyword: str):
+        # 英文关键词按整词匹配，避免 "then" 命中 "authentication"
+        if keyword.isascii():
+            return keyword, re.compile(rf"\b{re.escape(keyword)}\b", re.IGNORECASE)
+        return keyword, re.compile(re.escape(keyword))
+
+    @staticmethod
+    def template_of(task: str) -> str:
+        text = re.sub(r"https?://\S+", "<url>", task.strip().lower())
+        text = re.sub(r"[\"“”‘’「」《》][^\"“”‘’「」《》]*[\"“”‘’「」《》]", "<str>", text)
+        text = re.sub(r"\d+(\.\d+)?", "<num>", text)
+        return re.sub(r"\s+", " ", text)[:200]
+
+    def _history(self, template: str) -> Optional[Dict[str, Any]]:
+        steps = self.history.get(template)
+        if not steps:
+            return None
+        return {"samples": len(steps), "avg_steps": round(sum(steps) / len(steps), 1)}
+
+    def classify(self, task: str, tier: Optional[str] = None) -> Dict[str, Any]:
+        template = self.template_of(task)
+        history = self._history(template)
+        decision = {"tier": "default", "source": "heuristic", "reasons": [], "template": template, "history": history}
+        if tier is not None:
+            if tier not in self.tiers:
+                raise ValueError(f"未知的路由档位: {tier}（可选 {', '.join(self.tiers)}）")
+            decision.update(tier=tier, source="request", reasons=["请求指定档位"])
+            return decision
+        for pattern, template_tier in self.templates:
+            if pattern.search(task):
+                decision.update(tier=template_tier, source="template", reasons=[f"匹配模板 {pattern.pattern}"])
+                return decision
+        if history is not None and history["samples"] >= self.history_min_samples:
+            avg_steps = history["avg_steps"]
+            if avg_steps <= self.short_max_history_steps:
+                decision["tier"] = "short"
+            elif avg_steps >= self.long_min_history_steps:
+                decision["tier"] = "long"
+            decision.update(source="history", reasons=[f"同模板 {history['samples']} 次完成平均 {avg_steps} 步"])
+            return decision
+        chars = len(task.strip())
+        clauses = len([part for part in re.split(r"[,，;；。\n]|\band\b|\bthen\b|然后|并且|接着|并", task, flags=re.IGNORECASE) if part.strip()])
+        long_hits = [keyword for keyword, pattern in self.long_keywords if pattern.search(task)]
+        short_hits = [keyword for keyword, pattern in self.short_keywords if pattern.search(task)]
+        reasons = decision["reasons"]
+        if long_hits:
+            reasons.append(f"多步关键词: {', '.join(long_hits)}")
+        if chars > self.long_min_chars:
+            reasons.append(f"任务长度 {chars} 字符")
+        if clauses >= self.long_min_clauses:
+            reasons.append(f"{clauses} 个子句")
+        if reasons:
+            decision["tier"] = "long"
+        elif short_hits and chars <= self.short_max_chars and clauses <= 1:
+            decision["tier"] = "short"
+            reasons.append(f"简单关键词: {', '.join(short_hits)}，长度 {chars} 字符")
+        else:
+            reasons.append(f"长度 {chars} 字符，{clauses} 个子句")
+        return decision
+
+    def route(self, request: AgentRequest) -> Optional[Dict[str, Any]]:
+        # 只填请求中没有显式给出的字段，显式字段记录在explicit中
+        if not self.enabled:
+            return None
+        decision = self.classify(request.task, request.tier)
+        explicit = [field for field in ("model", "max_steps", "timeout") if field in request.model_fields_set]
+        for field, value in self.tiers[decision["tier"]].items():
+            # 档位里的模型是Ollama模型，其它后端使用自己的默认模型
+            if field not in explicit and not (field == "model" and request.backend != "ollama"):
+                setattr(request, field, value)
+        decision.update(model=request.model, max_steps=request.max_steps, timeout=request.timeout, explicit=explicit)
+        self.stats["routed"] += 1
+        for key, value in (("by_tier", decision["tier"]), ("by_source", decision["source"])):
+            self.stats[key][value] = self.stats[key].get(value, 0) + 1
+        metrics.routes.inc(tier=decision["tier"], source=decision["source"])
+        return decision
+
+    def observe(self, task: str, steps: int):
+        # 记录完成任务的实际步数，供同模板的后续任务分档
+        template = self.template_of(task)
+        history = self.history.pop(template, None) or deque(maxlen=self.history_window)
+        history.append(steps)
+        self.history[template] = history
+        while len(self.history) > self.max_templates:
+            self.history.popitem(last=False)
+
+    def learn(self, records):
+        for record in records:
+            if record.get("status") == "completed" and record.get("steps"):
+                self.observe(record["task"], record["steps"])
+
+    def get_stats(self):
+        return {"enabled": self.enabled, **self.stats, "templates": len(self.history)}
+
+# BrowserSession池：每个cdp_url共享一条CDP连接，每个Agent在上面新建独立的浏览器上下文（隐身窗口式，
+# 标签页、Cookie、缓存互不可见），归还时直接销毁上下文；没有Agent使用的连接保留idle_ttl秒供后续复用
+class BrowserSessionPool:
+    def __init__(self, idle_ttl: int, close_timeout: float):
+        self.idle_ttl = idle_ttl
+        self.close_timeout = close_timeout
+        self.connections: Dict[str, BrowserSession] = {}  # cdp_url -> 持有共享连接的会话
+        self.in_use: Dict[str, int] = {}  # cdp_url -> 借出的上下文数
+        self.idle_since: Dict[str, float] = {}  # cdp_url -> 最后一个上下文归还的时间
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._checked_out: Dict[int, str] = {}  # id(session) -> cdp_url
+        self._reaper_task = None
+        self.stats = {"connects": 0, "reconnects": 0, "contexts_created": 0, "contexts_closed": 0,
+                      "close_failures": 0, "expired": 0}
+        self.checkout_ms = deque(maxlen=200)
+
+    async def _connection(self, cdp_url: str) -> BrowserSession:
+        async with self._locks.setdefault(cdp_url, asyncio.Lock()):
+            connection = self.connections.get(cdp_url)
+            if connection is not None and not (connection.browser is not None and connection.browser.is_connected()):
+                self.stats["reconnects"] += 1
+                await self._disconnect(cdp_url)
+                connection = None
+            if connection is None:
+                # keep_alive=True：只连接远端Chrome，任何stop()都不会关闭它
+                connection = BrowserSession(cdp_url=cdp_url, keep_alive=True)
+                await connection.start()
+                self.connections[cdp_url] = connection
+                self.stats["connects"] += 1
+            return connection
+
+    async def _disconnect(self, cdp_url: str):
+        # 断开共享连接（连带关闭其上残留的上下文），不关闭远端Chrome
+        connection = self.connections.pop(cdp_url, None)
+        self.idle_since.pop(cdp_url, None)
+        if connection is None:
+            return
+        try:
+            if connection.browser is not None and connection.browser.is_connected():
+                await connection.browser.close()
+        except Exception as e:
+            debug(f"[BrowserPool] 断开连接时出错 {cdp_url}: {e}")
+
+    async def _close_context(self, session: BrowserSession):
+        context = session.browser_context
+        session.browser_context = None
+        session.agent_current_page = None
+        session.human_current_page = None
+        if context is None:
+            return
+        try:
+            await asyncio.wait_for(context.close(), self.close_timeout)
+            self.stats["contexts_closed"] += 1
+        except Exception as e:
+            self.stats["close_failures"] += 1
+            debug(f"[BrowserPool] 销毁浏览器上下文失败: {e}")
+
+    async def checkout(self, cdp_url: str) -> BrowserSession:
+        self._ensure_reaper()
+        started = time.perf_counter()
+        # 先占位，避免等待连接/新建上下文期间连接被当作空闲回收
+        self.in_use[cdp_url] = self.in_use.get(cdp_url, 0) + 1
+        self.idle_since.pop(cdp_url, None)
+        try:
+            connection = await self._connection(cdp_url)
+            context = await connection.browser.new_context(
+                **connection.browser_profile.kwargs_for_new_context().model_dump(mode="json"))
+            session = BrowserSession(cdp_url=cdp_url, keep_alive=True)
+            session.playwright = connection.playwright
+            session.browser = connection.browser
+            session.browser_context = context
+            try:
+                await self._attach(session)
+            except BaseException:
+                await self._close_context(session)
+                raise
+        except BaseException:
+            self._checkin(cdp_url)
+            raise
+        self.stats["contexts_created"] += 1
+        self._checked_out[id(session)] = cdp_url
+        self.checkout_ms.append((time.perf_counter() - started) * 1000)
+        return session
+
+    @staticmethod
+    async def _attach(session: BrowserSession):
+        # 不调用start()：它每次都会经过setup_playwright注册一个持有会话的atexit回调，每个Agent泄漏一个BrowserSession。
+        # 这里只做start()连上浏览器之后的初始化；标记为已初始化后，Agent.run里的start()会直接返回
+        await session._setup_viewports()
+        await session._setup_current_page_change_listeners()
+        session.initialized = True
+
+    def _checkin(self, cdp_url: str):
+        self.in_use[cdp_url] -= 1
+        if not self.in_use[cdp_url]:
+            del self.in_use[cdp_url]
+            self.idle_since[cdp_url] = time.monotonic()
+
+    async def release(self, session: BrowserSession):
+        cdp_url = self._checked_out.pop(id(session), None)
+        await self._close_context(session)
+        if cdp_url is not None:
+            self._checkin(cdp_url)
+
+    async def discard_idle(self, cdp_url: str):
+        # Chrome节点被摘除时，没有上下文在用的共享连接立即断开，其余的等最后一个上下文归还后按idle_ttl回收
+        if not self.in_use.get(cdp_url):
+            await self._disconnect(cdp_url)
+
+    def _ensure_reaper(self):
+        if self._reaper_task is None or self._reaper_task.done():
+            self._reaper_task = asyncio.create_task(self._reap_loop())
+
+    async def _reap_loop(self):
+        interval = max(1.0, self.idle_ttl / 4)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                debug(f"[BrowserPool] 清理空闲连接出错: {e}")
+
+    async def reap(self):
+        now = time.monotonic()
+        for cdp_url, since in list(self.idle_since.items()):
+            if now - since > self.idle_ttl:
+                self.stats["expired"] += 1
+                await self._disconnect(cdp_url)
+
+    async def close_all(self):
+        if self._reaper_task is not None:
+            self._reaper_task.cancel()
+        for cdp_url in list(self.connections):
+            await self._disconnect(cdp_url)
+
+    def get_stats(self):
+        checkout_ms = sorted(self.checkout_ms)
+        return {
+            **self.stats,
+            "connections": {
+                cdp_url: {"contexts": self.in_use.get(cdp_url, 0), "connected": connection.browser is not None and connection.browser.is_connected()}
+                for cdp_url, connection in self.connections.items()
+            },
+            "checkout_ms": {
+                "avg": round(sum(checkout_ms) / len(checkout_ms), 2) if checkout_ms else 0.0,
+                "max": round(checkout_ms[-1], 2) if checkout_ms else 0.0,
+            },
+        }
+
+# 没有可用的Chrome节点时，和队列已满一样直接拒绝
+class NoChromeNodeAvailable(SchedulerQueueFull):
+    pass
+
+# Chrome节点注册表：每个CDP端点的容量、已分配的会话数和健康状态。
+# 节点状态：active 可分配 / unhealthy 健康检查连续失败被自动摘除（恢复后重新加入）/ draining 手动摘除，会话归零后删除
+class ChromeNodeRegistry:
+    def __init__(self, nodes: str, default_capacity: int, health_interval: float, health_timeout: float,
+                 drain_after: int, scheduler: AgentScheduler):
+        self.default_capacity = default_capacity
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.drain_after = drain_after
+        self.scheduler = scheduler
+        self.nodes: Dict[str, Dict[str, Any]] = {}
+        self.assignments: Dict[str, str] = {}  # agent_id -> cdp_url
+        self.stats = {"routed": 0, "drained": 0, "recovered": 0}
+        self._health_task = None
+        self._client = None
+        for spec in filter(None, (item.strip() for item in nodes.split(","))):
+            cdp_url, _, capacity = spec.partition("=")
+            self.register(cdp_url, int(capacity) if capacity else None)
+
+    def register(self, cdp_url: str, capacity: Optional[int] = None, headless: bool = False) -> Dict[str, Any]:
+        cdp_url = cdp_url.rstrip("/")
+        capacity = capacity or self.default_capacity
+        node = self.nodes.get(cdp_url)
+        if node is None:
+            node = self.nodes[cdp_url] = {
+                "cdp_url": cdp_url, "capacity": capacity, "sessions": 0, "assigned_total": 0, "state": "active",
+                "headless": headless, "failures": 0, "error": None, "browser": None, "latency_ms": None, "last_check": None,
+            }
+        else:
+            node["capacity"] = capacity
+            if node["state"] == "draining":
+                node["state"] = "active"
+        # 节点容量就是调度器对该cdp_url的并发上限
+        self.scheduler.cdp_url_limits[cdp_url] = capacity
+        return node
+
+    def remove(self, cdp_url: str) -> bool:
+        node = self.nodes.get(cdp_url.rstrip("/"))
+        if node is None:
+            return False
+        node["state"] = "draining"
+        self._forget_if_drained(node)
+        return True
+
+    def _forget_if_drained(self, node: Dict[str, Any]):
+        if node["state"] == "draining" and node["sessions"] <= 0:
+            self.nodes.pop(node["cdp_url"], None)
+            self.scheduler.cdp_url_limits.pop(node["cdp_url"], None)
+
+    # 为Agent分配节点：指定了cdp_url就用指定的（注册过的节点同样计数），否则选负载（会话数/容量）最低的可用节点；
+    # headless请求优先分配到无头节点（托管Chrome）
+    def assign(self, agent_id: str, cdp_url: Optional[str] = None, headless: bool = False) -> str:
+        if agent_id in self.assignments:
+            return self.assignments[agent_id]
+        self.ensure_health_checker()
+        if cdp_url:
+            node = self.nodes.get(cdp_url.rstrip("/"))
+        else:
+            candidates = [node for node in self.nodes.values() if node["state"] == "active"]
+            if headless:
+                candidates = [node for node in candidates if node["headless"]] or candidates
+            if not candidates:
+                raise NoChromeNodeAvailable("没有可用的Chrome节点，请稍后重试")
+            node = min(candidates, key=lambda node: (node["sessions"] / node["capacity"], node["sessions"]))
+            cdp_url = node["cdp_url"]
+            self.stats["routed"] += 1
+        if node is not None:
+            node["sessions"] += 1
+            node["assigned_total"] += 1
+        self.assignments[agent_id] = cdp_url
+        return cdp_url
+
+    def unassign(self, agent_id: str):
+        cdp_url = self.assignments.pop(agent_id, None)
+        node = self.nodes.get(cdp_url.rstrip("/")) if cdp_url else None
+        if node is not None:
+            node["sessions"] -= 1
+            self._forget_if_drained(node)
+
+    def ensure_health_checker(self):
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _health_loop(self):
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                debug(f"[ChromeNodes] 健康检查出错: {e}")
+            await asyncio.sleep(self.health_interval)
+
+    async def check_all(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.health_timeout)
+        await asyncio.gather(*(self._check(node) for node in list(self.nodes.values())))
+
+    async def _check(self, node: Dict[str, Any]):
+        started = time.perf_counter()
+        node["last_check"] = time.time()
+        try:
+            response = await self._client.get(f"{node['cdp_url']}/json/version")
+            response.raise_for_status()
+            node["browser"] = response.json().get("Browser")
+        except Exception as e:
+            node["failures"] += 1
+            node["error"] = str(e) or type(e).__name__
+            if node["state"] == "active" and node["failures"] >= self.drain_after:
+                node["state"] = "unhealthy"
+                self.stats["drained"] += 1
+                debug(f"[ChromeNodes] 节点 {node['cdp_url']} 连续 {node['failures']} 次健康检查失败，已摘除: {node['error']}")
+                await agent_manager.browser_pool.discard_idle(node["cdp_url"])
+            return
+        node["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        node["failures"] = 0
+        node["error"] = None
+        if node["state"] == "unhealthy":
+            node["state"] = "active"
+            self.stats["recovered"] += 1
+            debug(f"[ChromeNodes] 节点 {node['cdp_url']} 已恢复")
+
+    def list_nodes(self) -> List[Dict[str, Any]]:
+        return [dict(node) for node in self.nodes.values()]
+
+    def get_stats(self):
+        nodes = list(self.nodes.values())
+        return {
+            **self.stats,
+            "nodes": len(nodes),
+            "active": sum(1 for node in nodes if node["state"] == "active"),
+            "sessions": sum(node["sessions"] for node in nodes),
+            "capacity": sum(node["capacity"] for node in nodes if node["state"] == "active"),
+        }
+
+# 进程（树）的常驻内存（字节）和累计CPU时间（秒）；没有psutil时读/proc，只统计主进程
+def process_tree_usage(pid: int):
+    if psutil is not None:
+        try:
+            root = psutil.Process(pid)
+            processes = [root, *root.children(recursive=True)]
+        except psutil.Error:
+            return None, None
+        rss, cpu_seconds = 0, 0.0
+        for process in processes:
+            try:
+                rss += process.memory_info().rss
+                times = process.cpu_times()
+                cpu_seconds += times.user + times.system
+            except psutil.Error:
+                continue
+        return rss, cpu_seconds
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return rss, (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+# 一个托管的无头Chrome进程
+class ManagedChrome:
+    def __init__(self, port: int, user_data_dir: str, restarts: int = 0):
+        self.port = port
+        self.cdp_url = f"http://127.0.0.1:{port}"
+        self.user_data_dir = user_data_dir
+        self.restarts = restarts
+        self.process = None
+        self.state = "starting"  # starting -> running -> recycling -> stopped
+        self.started_at = time.monotonic()
+        self.idle_since = time.monotonic()
+        self.rss_mb = None
+        self.cpu_percent = None
+        self._cpu_sample = None  # (采样时间, 累计CPU秒)
+
+    def sample(self):
+        rss, cpu_seconds = process_tree_usage(self.process.pid)
+        if rss is None:
+            return
+        now = time.monotonic()
+        self.rss_mb = round(rss / 1024 / 1024, 1)
+        if self._cpu_sample is not None and now > self._cpu_sample[0]:
+            self.cpu_percent = round((cpu_seconds - self._cpu_sample[1]) / (now - self._cpu_sample[0]) * 100, 1)
+        self._cpu_sample = (now, cpu_seconds)
+
+    def to_dict(self, node: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        return {
+            "port": self.port,
+            "cdp_url": self.cdp_url,
+            "pid": self.process.pid if self.process is not None else None,
+            "state": self.state,
+            "sessions": node["sessions"] if node else 0,
+            "tasks": node["assigned_total"] if node else 0,
+            "restarts": self.restarts,
+            "rss_mb": self.rss_mb,
+            "cpu_percent": self.cpu_percent,
+            "uptime_seconds": round(time.monotonic() - self.started_at, 1),
+        }
+
+# 托管Chrome监督器：按调度器的运行+排队数伸缩进程数，每个进程独立端口和用户目录，注册为无头Chrome节点；
+# 崩溃后在原端口重启，分配过recycle_after_tasks个任务或内存超限后先摘除节点、会话结束后关闭
+class ChromeSupervisor:
+    def __init__(self, enabled: bool, chrome_path: str, base_port: int, min_processes: int, max_processes: int,
+                 capacity: int, recycle_after_tasks: int, max_rss_mb: float, idle_shutdown: float,
+                 check_interval: float, startup_timeout: float, extra_args: List[str],
+                 registry: ChromeNodeRegistry, scheduler: AgentScheduler):
+        self.enabled = enabled
+        self.chrome_path = chrome_path
+        self.base_port = base_port
+        self.min_processes = min_processes
+        self.max_processes = max_processes
+        self.capacity = capacity
+        self.recycle_after_tasks = recycle_after_tasks
+        self.max_rss_mb = max_rss_mb
+        self.idle_shutdown = idle_shutdown
+        self.check_interval = check_interval
+        self.startup_timeout = startup_timeout
+        self.extra_args = extra_args
+        self.registry = registry
+        self.scheduler = scheduler
+        self.processes: Dict[int, ManagedChrome] = {}  # port -> 进程
+        self.stats = {"spawned": 0, "spawn_failures": 0, "crashed": 0, "recycled": 0, "scaled_down": 0}
+        self._task = None
+        self._wakeup = None
+
+    def resolve_chrome(self) -> Optional[str]:
+        if self.chrome_path:
+            return self.chrome_path
+        for name in CHROME_EXECUTABLES:
+            path = shutil.which(name)
+            if path:
+                return path
+        return None
+
+    def ensure_started(self):
+        if not self.enabled:
+            return
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._supervise_loop())
+
+    def wake(self):
+        # 有新任务提交时提前巡检，尽快扩容
+        self.ensure_started()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _supervise_loop(self):
+        while True:
+            try:
+                await self.supervise()
+            except Exception as e:
+                debug(f"[ChromeSupervisor] 巡检出错: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def supervise(self):
+        for chrome in list(self.processes.values()):
+            await self._check(chrome)
+        await self._scale()
+
+    async def _check(self, chrome: ManagedChrome):
+        if chrome.state == "starting":
+            return
+        if chrome.process.returncode is not None:
+            # 崩溃：摘除节点，在原端口用新的用户目录重启（回收中的进程不再重启）
+            self.stats["crashed"] += 1
+            debug(f"[ChromeSupervisor] Chrome :{chrome.port} 已退出（返回码 {chrome.process.returncode}）")
+            self.registry.remove(chrome.cdp_url)
+            await self._stop(chrome)
+            if chrome.state != "recycling":
+                await self._spawn(chrome.port, chrome.restarts + 1)
+            return
+        chrome.sample()
+        node = self.registry.nodes.get(chrome.cdp_url)
+        if node is not None and node["sessions"]:
+            chrome.idle_since = time.monotonic()
+        if chrome.state == "running":
+            reason = None
+            if node is not None and node["assigned_total"] >= self.recycle_after_tasks:
+                reason = f"已分配 {node['assigned_total']} 个任务"
+            elif chrome.rss_mb is not None and chrome.rss_mb > self.max_rss_mb:
+                reason = f"内存 {chrome.rss_mb}MB 超过上限 {self.max_rss_mb}MB"
+            if reason:
+                chrome.state = "recycling"
+                self.registry.remove(chrome.cdp_url)
+                debug(f"[ChromeSupervisor] 回收 Chrome :{chrome.port}：{reason}")
+        # 节点在最后一个会话结束后才会从注册表删除，此时再关闭进程
+        if chrome.state == "recycling" and chrome.cdp_url not in self.registry.nodes:
+            self.stats["recycled"] += 1
+            await self._stop(chrome)
+
+    async def _scale(self):
+        demand = self.scheduler.running + len(self.scheduler._waiters)
+        desired = min(self.max_processes, max(self.min_processes, math.ceil(demand / self.capacity)))
+        live = [chrome for chrome in self.processes.values() if chrome.state in ("starting", "running")]
+        for _ in range(desired - len(live)):
+            if not await self._spawn(self._free_port()):
+                break
+        now = time.monotonic()
+        for chrome in live[desired:]:
+            node = self.registry.nodes.get(chrome.cdp_url)
+            if node is not None and not node["sessions"] and now - chrome.idle_since > self.idle_shutdown:
+                self.registry.remove(chrome.cdp_url)
+                self.stats["scaled_down"] += 1
+                debug(f"[ChromeSupervisor] 空闲缩容，关闭 Chrome :{chrome.port}")
+                await self._stop(chrome)
+
+    def _free_port(self) -> int:
+        port = self.base_port
+        while True:
+            if port not in self.processes:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+                    if probe.connect_ex(("127.0.0.1", port)) != 0:
+                        return port
+            port += 1
+
+    async def _spawn(self, port: int, restarts: int = 0) -> bool:
+        chrome_path = self.resolve_chrome()
+        if chrome_path is None:
+            self.stats["spawn_failures"] += 1
+            debug("[ChromeSupervisor] 找不到Chrome可执行文件，请设置 CHROME_PATH")
+            return False
+        chrome = ManagedChrome(port, tempfile.mkdtemp(prefix=f"managed_chrome_{port}_"), restarts)
+        self.processes[port] = chrome
+        args = [
+            chrome_path, "--headless=new", f"--remote-debugging-port={port}", "--remote-debugging-address=127.0.0.1",
+            f"--user-data-dir={chrome.user_data_dir}", "--no-first-run", "--no-default-browser-check",
+            "--disable-dev-shm-usage", "--disable-background-networking", *self.extra_args, "about:blank",
+        ]
+        if hasattr(os, "geteuid") and os.geteuid() == 0:
+            args.insert(1, "--no-sandbox")
+        try:
+            chrome.process = await asyncio.create_subprocess_exec(
+                *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            await self._wait_ready(chrome)
+        except Exception as e:
+            self.stats["spawn_failures"] += 1
+            debug(f"[ChromeSupervisor] 启动 Chrome :{port} 失败: {e}")
+            await self._stop(chrome)
+            return False
+        chrome.state = "running"
+        # 崩溃重启复用原端口，新进程的任务计数从零开始
+        node = self.registry.register(chrome.cdp_url, self.capacity, headless=True)
+        node["assigned_total"] = 0
+        self.stats["spawned"] += 1
+        debug(f"[ChromeSupervisor] 已启动 Chrome :{port}（pid {chrome.process.pid}）")
+        return True
+
+    async def _wait_ready(self, chrome: ManagedChrome):
+        deadline = time.monotonic() + self.startup_timeout
+        async with httpx.AsyncClient(timeout=1) as client:
+            while True:
+                if chrome.process.returncode is not None:
+                    raise RuntimeError(f"进程已退出（返回码 {chrome.process.returncode}）")
+                try:
+                    response = await client.get(f"{chrome.cdp_url}/json/version")
+                    if response.status_code == 200:
+                        return
+                except httpx.HTTPError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"{self.startup_timeout} 秒内 /json/version 不可用")
+                await asyncio.sleep(0.2)
+
+    async def _stop(self, chrome: ManagedChrome):
+        if self.processes.get(chrome.port) is chrome:
+            del self.processes[chrome.port]
+        process = chrome.process
+        if process is not None and process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        if chrome.state != "recycling":
+            chrome.state = "stopped"
+        await agent_manager.browser_pool.discard_idle(chrome.cdp_url)
+        await asyncio.to_thread(shutil.rmtree, chrome.user_data_dir, True)
+
+    async def stop_all(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for chrome in list(self.processes.values()):
+            self.registry.remove(chrome.cdp_url)
+            await self._stop(chrome)
+
+    def list_processes(self) -> List[Dict[str, Any]]:
+        return [chrome.to_dict(self.registry.nodes.get(chrome.cdp_url)) for chrome in self.processes.values()]
+
+    def get_stats(self):
+        processes = list(self.processes.values())
+        return {
+            "enabled": self.enabled,
+            **self.stats,
+            "processes": len(processes),
+            "rss_mb": round(sum(chrome.rss_mb or 0 for chrome in processes), 1),
+            "cpu_percent": round(sum(chrome.cpu_percent or 0 for chrome in processes), 1),
+        }
+
+# LLM响应磁盘缓存：key = 模型 + 输出格式 + 规范化后的消息内容的哈希
+class LLMResponseCache:
+    # 每步提示词里会变化但不影响决策的内容（如当前时间）在计算key前去掉
+    _VOLATILE_PATTERNS = [
+        re.compile(r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?"),
+    ]
+    _WHITESPACE = re.compile(r"\s+")
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, int]" = OrderedDict()  # 路径 -> 字节数，按访问时间排序
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evicted": 0, "errors": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    files.append((stat.st_atime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self.entries[path] = size
+            self.total_bytes += size
+
+    def normalize(self, text: str) -> str:
+        for pattern in self._VOLATILE_PATTERNS:
+            text = pattern.sub("<ts>", text)
+        return self._WHITESPACE.sub(" ", text).strip()
+
+    def make_key(self, model: str, messages, output_format=None) -> str:
+        digest = hashlib.sha256()
+        digest.update(model.encode("utf-8"))
+        if output_format is not None:
+            schema = json.dumps(output_format.model_json_schema(), sort_keys=True, ensure_ascii=False)
+            digest.update(schema.encode("utf-8"))
+        for message in messages:
+            digest.update(b"\x00" + message.role.encode("utf-8") + b"\x00")
+            digest.update(self.normalize(message.text).encode("utf-8"))
+            if isinstance(message.content, list):
+                for part in message.content:
+                    image_url = getattr(part, "image_url", None)
+                    if image_url is not None:
+                        digest.update(hashlib.sha256(image_url.url.encode("utf-8")).digest())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _read(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        os.utime(path)  # 更新访问时间，供重启后按LRU顺序重建索引
+        return data
+
+    def _write(self, path: str, data: Dict[str, Any]) -> int:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+    async def get(self, key: str):
+        path = self._path(key)
+        if path not in self.entries:
+            self.stats["misses"] += 1
+            return None
+        try:
+            data = await asyncio.to_thread(self._read, path)
+        except Exception as e:
+            self.stats["errors"] += 1
+            self.stats["misses"] += 1
+            self.total_bytes -= self.entries.pop(path, 0)
+            debug(f"[LLMCache] 读取缓存失败: {e}")
+            return None
+        self.entries.move_to_end(path)
+        self.stats["hits"] += 1
+        return data
+
+    async def put(self, key: str, data: Dict[str, Any]):
+        path = self._path(key)
+        try:
+            size = await asyncio.to_thread(self._write, path, data)
+        except Exception as e:
+            self.stats["errors"] += 1
+            debug(f"[LLMCache] 写入缓存失败: {e}")
+            return
+        self.total_bytes += size - self.entries.pop(path, 0)
+        self.entries[path] = size
+        self.stats["writes"] += 1
+        await self._evict()
+
+    async def _evict(self):
+        victims = []
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            path, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            victims.append(path)
+        if victims:
+            self.stats["evicted"] += len(victims)
+            await asyncio.to_thread(self._remove, victims)
+
+    @staticmethod
+    def _remove(paths: List[str]):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get_stats(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+llm_response_cache = LLMResponseCache(LLM_CACHE_CONFIG["cache_dir"], LLM_CACHE_CONFIG["max_bytes"]) \
+    if LLM_CACHE_CONFIG["enabled"] else None
+
+# 复用共享HTTP客户端的ChatOllama（原版每次调用都会新建一个客户端和连接），可选响应缓存
+# 当前Agent步骤的LLM调用统计：WebSocketAgent.step 设置，PooledChatOllama 累加调用次数和token数
+llm_step_stats: contextvars.ContextVar = contextvars.ContextVar("llm_step_stats", default=None)
+
+class PooledChatOllama(ChatOllama):
+    shared_client = None
+    response_cache = None
+    keep_alive = None  # 每次请求都带上，否则Ollama会把模型常驻时长重置为默认的5分钟
+
+    def get_client(self) -> OllamaAsyncClient:
+        if self.shared_client is not None:
+            return self.shared_client
+        return super().get_client()
+
+    # 与ChatOllama.ainvoke相同，但保留Ollama返回的token数（prompt_eval_count/eval_count）
+    async def _chat(self, messages, output_format=None):
+        stats = llm_step_stats.get()
+        if stats is not None:
+            stats["llm_calls"] += 1
+        try:
+            response = await self.get_client().chat(
+                model=self.model,
+                messages=OllamaMessageSerializer.serialize_messages(messages),
+                format=output_format.model_json_schema() if output_format is not None else None,
+                keep_alive=self.keep_alive,
+            )
+        except Exception as e:
+            raise ModelProviderError(message=str(e), model=self.name) from e
+        prompt_tokens = response.prompt_eval_count or 0
+        completion_tokens = response.eval_count or 0
+        if stats is not None:
+            stats["tokens_in"] += prompt_tokens
+            stats["tokens_out"] += completion_tokens
+        completion = response.message.content or ""
+        if output_format is not None:
+            try:
+                completion = output_format.model_validate_json(completion)
+            except Exception as e:
+                raise ModelProviderError(message=str(e), model=self.name) from e
+        usage = ChatInvokeUsage(
+            prompt_tokens=prompt_tokens,
+            prompt_cached_tokens=None,
+            prompt_cache_creation_tokens=None,
+            prompt_image_tokens=None,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
+        return ChatInvokeCompletion(completion=completion, usage=usage)
+
+    async def ainvoke(self, messages, output_format=None):
+        if self.response_cache is None:
+            return await self._chat(messages, output_format)
+        key = self.response_cache.make_key(self.model, messages, output_format)
+        cached = await self.response_cache.get(key)
+        if cached is not None:
+            try:
+                completion = cached["completion"]
+                if output_format is not None:
+                    completion = output_format.model_validate_json(completion)
+                stats = llm_step_stats.get()
+                if stats is not None:
+                    stats["cache_hits"] += 1
+                return ChatInvokeCompletion(completion=completion, usage=None)
+            except Exception as e:
+                # 输出格式变化导致旧缓存不可用时重新推理
+                debug(f"[LLMCache] 缓存内容无效，重新推理: {e}")
+        response = await self._chat(messages, output_format)
+        completion = response.completion
+        await self.response_cache.put(key, {
+            "model": self.model,
+            "completion": completion.model_dump_json() if output_format is not None else completion,
+            "created_at": time.time(),
+        })
+        return response
+
+# LLM实例注册表：按 host+model 缓存，LRU + 闲置TTL淘汰，每个host共享一个连接池，首次使用时预热模型。
+# 运行中的Agent通过hold/release持有实例，被持有的实例不淘汰，其host的连接池也不会被关闭
+class LLMClientRegistry:
+    def __init__(self, max_instances: int, idle_ttl: int, max_connections_per_host: int,
+                 request_timeout: float, keep_alive: str, warmup_timeout: float):
+        self.max_instances = max_instances
+        self.idle_ttl = idle_ttl
+        self.max_connections_per_host = max_connections_per_host
+        self.request_timeout = request_timeout
+        self.keep_alive = keep_alive
+        self.warmup_timeout = warmup_timeout
+        self.instances: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.clients: Dict[str, OllamaAsyncClient] = {}
+        self._warmups: Dict[str, asyncio.Task] = {}
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0, "warmups": 0, "warmup_failures": 0}
+
+    @staticmethod
+    def _key(host: str, model: str) -> str:
+        return f"{host}_{model}"
+
+    def _get_client(self, host: str) -> OllamaAsyncClient:
+        client = self.clients.get(host)
+        if client is None:
+            client = OllamaAsyncClient(
+                host=host,
+                timeout=self.request_timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections_per_host,
+                    max_keepalive_connections=self.max_connections_per_host
+                )
+            )
+            self.clients[host] = client
+        return client
+
+    def get(self, host: str, model: str) -> ChatOllama:
+        key = self._key(host, model)
+        entry = self.instances.get(key)
+        if entry is not None:
+            self.stats["hits"] += 1
+            entry["last_used"] = time.monotonic()
+            self.instances.move_to_end(key)
+            return entry["llm"]
+        self.stats["misses"] += 1
+        llm = PooledChatOllama(host=host, model=model, timeout=self.request_timeout)
+        llm.response_cache = llm_response_cache
+        llm.keep_alive = self.keep_alive
+        self._register(key, llm)
+        self._evict()
+        return llm
+
+    def _register(self, key: str, llm: PooledChatOllama) -> Dict[str, Any]:
+        llm.shared_client = self._get_client(llm.host)
+        entry = self.instances[key] = {
+            "llm": llm,
+            "host": llm.host,
+            "model": llm.model,
+            "last_used": time.monotonic(),
+            "refs": 0,
+            "warm": False,
+            "warmup_ms": None,
+            "last_error": None,
+        }
+        return entry
+
+    def hold(self, llm: PooledChatOllama):
+        key = self._key(llm.host, llm.model)
+        entry = self.instances.get(key)
+        if entry is None or entry["llm"] is not llm:
+            # 在借出和持有之间被淘汰了：重新登记（连接池已关闭时换用新的）
+            entry = self._register(key, llm)
+        entry["refs"] += 1
+
+    def release(self, llm: PooledChatOllama):
+        entry = self.instances.get(self._key(llm.host, llm.model))
+        if entry is not None and entry["llm"] is llm and entry["refs"] > 0:
+            entry["refs"] -= 1
+            entry["last_used"] = time.monotonic()
+
+    def _evict(self):
+        now = time.monotonic()
+        idle = [key for key, entry in self.instances.items() if not entry["refs"]]
+        expired = [key for key in idle if now - self.instances[key]["last_used"] > self.idle_ttl]
+        overflow = max(0, len(self.instances) - len(expired) - self.max_instances)
+        victims = expired + [key for key in idle if key not in expired][:overflow]
+        for key in victims:
+            entry = self.instances.pop(key)
+            self._warmups.pop(key, None)
+            self.stats["evicted"] += 1
+            debug(f"[LLM] 淘汰LLM实例: {key}")
+            # 该host没有实例了就关闭其连接池
+            if not any(e["host"] == entry["host"] for e in self.instances.values()):
+                client = self.clients.pop(entry["host"], None)
+                close = getattr(client, "close", None)
+                if close is not None:
+                    asyncio.get_running_loop().create_task(close())
+
+    async def warm_up(self, host: str, model: str):
+        # 同一模型只预热一次，并发请求共享同一个预热任务
+        key = self._key(host, model)
+        entry = self.instances.get(key)
+        if entry is None or entry["warm"]:
+            return
+        task = self._warmups.get(key)
+        if task is None:
+            task = asyncio.create_task(self._warm_up(key, entry))
+            self._warmups[key] = task
+        await asyncio.shield(task)
+
+    async def _warm_up(self, key: str, entry: Dict[str, Any]):
+        started = time.perf_counter()
+        try:
+            # 空prompt的generate只加载模型，不做推理
+            await asyncio.wait_for(
+                self._get_client(entry["host"]).generate(model=entry["model"], prompt="", keep_alive=self.keep_alive),
+                timeout=self.warmup_timeout
+            )
+            entry["warm"] = True
+            entry["warmup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            entry["last_error"] = None
+            self.stats["warmups"] += 1
+            debug(f"[LLM] 模型已预热: {key}，耗时 {entry['warmup_ms']}ms")
+        except Exception as e:
+            # 预热失败不影响任务，下次再试
+            entry["last_error"] = str(e) or type(e).__name__
+            self.stats["warmup_failures"] += 1
+            debug(f"[LLM] 模型预热失败 {key}: {entry['last_error']}")
+        finally:
+            self._warmups.pop(key, None)
+
+    async def has_model(self, host: str, model: str) -> bool:
+        # 查询该Ollama已安装的模型（/api/tags），查询失败按未安装处理
+        try:
+            response = await asyncio.wait_for(self._get_client(host).list(), timeout=self.warmup_timeout)
+        except Exception as e:
+            debug(f"[LLM] 查询已安装模型失败 {host}: {e}")
+            return False
+        names = {item.model for item in response.models}
+        return model in names or f"{model}:latest" in names
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "instances": len(self.instances),
+            "hosts": len(self.clients),
+            "models": {
+                key: {"warm": entry["warm"], "warmup_ms": entry["warmup_ms"], "last_error": entry["last_error"],
+                      "refs": entry["refs"]}
+                for key, entry in self.instances.items()
+            },
+        }
+
+# 判断异常是否说明后端本身不可用：连接失败、超时、限流和5xx才计入熔断；
+# 模型输出无法解析、4xx等问题换个后端可能有用，但与后端健康无关
+def is_backend_failure(error: BaseException) -> bool:
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, (OSError, httpx.TransportError)):  # 含ConnectionError、TimeoutError
+            return True
+        # browser_use的ModelProviderError默认带502，只看被包装的原始异常（ollama.ResponseError / openai.APIStatusError）
+        status = getattr(error, "status_code", None)
+        if not isinstance(error, ModelProviderError) and isinstance(status, int) and (status == 429 or status >= 500):
+            return True
+        error = error.__cause__
+    return False
+
+# 一个LLM后端：独立的超时、熔断状态和延迟窗口（用于对冲时机）
+class LLMBackend:
+    def __init__(self, name: str, kind: str, timeout: float, breaker_failures: int, breaker_cooldown: float,
+                 latency_window: int, base_url: str = None, api_key: str = None, model: str = None):
+        self.name = name
+        self.kind = kind  # ollama / openai / deepseek
+        self.timeout = timeout
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.state = "closed"  # closed -> open -> half_open -> closed/open
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.latencies = deque(maxlen=latency_window)
+        self.llms: Dict[str, Any] = {}
+        self._http_client = None
+        self.stats = {"calls": 0, "successes": 0, "failures": 0, "timeouts": 0, "errors": 0, "rejected": 0,
+                      "hedged": 0, "hedge_wins": 0, "opened": 0}
+
+    def available(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.breaker_cooldown:
+                self.stats["rejected"] += 1
+                return False
+            # 冷却结束，放行一次试探请求
+            self.state = "half_open"
+            return True
+        if self.state == "half_open":
+            self.stats["rejected"] += 1
+            return False
+        return True
+
+    def record_success(self, seconds: float):
+        self.stats["successes"] += 1
+        self.latencies.append(seconds)
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            debug(f"[LLMBackend] {self.name} 恢复")
+        self.state = "closed"
+
+    def record_error(self):
+        # 后端有响应但结果不可用（如输出不是合法JSON）：说明后端可达，不计入熔断
+        self.stats["errors"] += 1
+        self.consecutive_failures = 0
+        if self.state == "half_open":
+            self.state = "closed"
+
+    def record_failure(self, timed_out: bool = False, trip: bool = True):
+        self.stats["timeouts" if timed_out else "failures"] += 1
+        if not trip:
+            return
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.breaker_failures:
+            if self.state != "open":
+                self.stats["opened"] += 1
+                debug(f"[LLMBackend] {self.name} 连续失败 {self.consecutive_failures} 次，熔断 {self.breaker_cooldown} 秒")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        # 试探请求被取消时没有结论，下一次调用重新试探
+        if self.state == "half_open":
+            self.state = "open"
+            self.opened_at = time.monotonic() - self.breaker_cooldown
+
+    def latency_percentile(self, percentile: float, min_samples: int) -> Optional[float]:
+        if len(self.latencies) < min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
+
+    def create_llm(self, model: str):
+        # OpenAI兼容后端：同一模型复用实例，所有实例共享一个HTTP连接池；重试交给熔断和备用后端
+        llm = self.llms.get(model)
+        if llm is None:
+            if self._http_client is None:
+                self._http_client = httpx.AsyncClient(timeout=self.timeout)
+            if self.kind == "deepseek":
+                llm = ChatDeepSeek(model=model, api_key=self.api_key, base_url=self.base_url, timeout=self.timeout,
+                                   client_params={"max_retries": 0, "http_client": self._http_client})
+            else:
+                llm = ChatOpenAI(model=model, api_key=self.api_key, base_url=self.base_url, timeout=self.timeout,
+                                 max_retries=0, http_client=self._http_client)
+            self.llms[model] = llm
+        return llm
+
+    def get_stats(self):
+        p95 = self.latency_percentile(0.95, 1)
+        return {
+            "kind": self.kind,
+            "state": self.state,
+            "timeout": self.timeout,
+            **self.stats,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+        }
 
-# 设置日志
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+# 给Agent用的LLM：按顺序尝试主后端和备用后端（跳过熔断中的），单个后端失败或超时就换下一个；
+# 开启对冲时，主后端超过其p95延迟仍未返回，就把同一步发给下一个后端，先返回的结果生效，另一个请求取消
+class ResilientChatModel(BaseChatModel):
+    _verified_api_keys = False
 
-# 加载环境变量
-load_dotenv()
+    def __init__(self, chain: List[tuple], hedge: bool, hedge_percentile: float, hedge_min_samples: int,
+                 hedge_min_delay: float):
+        self.chain = chain  # [(LLMBackend, llm)]，第一个是主后端
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.model = chain[0][1].model
 
-# 创建FastAPI应用
-app = FastAPI(title="Browser-Use Multi-Agent HTTP API", version="1.0.0")
+    @property
+    def provider(self) -> str:
+        return self.chain[0][1].provider
 
-# WebSocket客户端集合（全局WebSocket）
-websocket_clients = set()
-websocket_loop = None  # 全局事件循环引用
+    @property
+    def name(self) -> str:
+        return self.chain[0][1].name
 
-# 请求模型
-class AgentRequest(BaseModel):
-    cdp_url: str = "http://127.0.0.1:9222"
-    model: str = "qwen2.5:7b"
-    host: str = "http://127.0.0.1:11434"
-    task: str
-    max_steps: int = 40
-    headless: bool = False
-    verbose: bool = True
+    @property
+    def model_name(self) -> str:
+        return self.model
 
-# 响应模型
-class AgentResponse(BaseModel):
-    success: bool
-    message: str
-    result: Any = None
-    error: str = None
+    def pooled_llms(self) -> List[PooledChatOllama]:
+        return [llm for _, llm in self.chain if isinstance(llm, PooledChatOllama)]
 
-# 安全的调试输出
-def debug(msg):
-    sys.__stdout__.write(f"{msg}\n")
-    sys.__stdout__.flush()
-    logger.debug(msg)
+    def _hedge_delay(self, backend: LLMBackend) -> Optional[float]:
+        if not self.hedge:
+            return None
+        percentile = backend.latency_percentile(self.hedge_percentile, self.hedge_min_samples)
+        return max(self.hedge_min_delay, percentile) if percentile is not None else None
 
-# WebSocket客户端处理器（全局WebSocket，支持订阅agent_id）
-async def websocket_handler(websocket):
-    subscribed_agent_id = None
-    websocket_clients.add(websocket)
-    debug(f"[WS] 客户端已连接，当前连接数: {len(websocket_clients)}")
-    try:
-        async for message in websocket:
-            try:
-                data = json.loads(message)
-                if data.get("type") == "subscribe":
-                    subscribed_agent_id = data.get("agent_id")
-                    debug(f"[WS] 客户端订阅 Agent: {subscribed_agent_id}")
-            except json.JSONDecodeError:
-                debug("[WS] 无效的订阅消息")
-    except Exception as e:
-        debug(f"[WS] 接收消息异常: {e}")
-    finally:
-        websocket_clients.remove(websocket)
-        debug(f"[WS] 客户端断开连接，剩余连接数: {len(websocket_clients)}")
-
-# WebSocket服务主循环
-async def websocket_server():
-    global websocket_loop
-    websocket_loop = asyncio.get_running_loop()
-    debug("[WS] 启动 WebSocket 服务：ws://0.0.0.0:7789")
-    async with websockets.serve(websocket_handler, "0.0.0.0", 7789, ping_interval=None):
-        await asyncio.Future()
-
-def start_websocket_server():
-    asyncio.run(websocket_server())
-
-# 广播日志消息（支持agent_id区分）
-def broadcast_log_message(message, message_type="log", agent_id=None):
-    if not websocket_clients:
-        debug(f"[WS] 无客户端连接，跳过广播：{message}")
-        return
-
-    debug(f"[WS] 广播消息：{message}，连接数: {len(websocket_clients)}")
-    message_data = {
-        "type": message_type,
-        "message": message,
-        "agent_id": agent_id,  # 添加 agent_id 字段用于区分
-        "timestamp": asyncio.get_event_loop().time()
-    }
-    send_tasks = []
-    for ws in websocket_clients.copy():
+    async def _call(self, backend: LLMBackend, llm, messages, output_format):
+        backend.stats["calls"] += 1
+        started = time.perf_counter()
+        # 只有一个后端时熔断没有意义（没有可切换的后端），失败只计数
+        trip = len(self.chain) > 1
         try:
-            # 只发送给订阅了该agent_id的客户端，或未订阅的客户端
-            if getattr(ws, "subscribed_agent_id", None) in (None, agent_id):
-                send_tasks.append(ws.send(json.dumps(message_data, ensure_ascii=False)))
+            response = await asyncio.wait_for(llm.ainvoke(messages, output_format), backend.timeout)
+        except asyncio.CancelledError:
+            # 对冲落败被取消，不算失败
+            backend.release_trial()
+            raise
+        except asyncio.TimeoutError:
+            backend.record_failure(timed_out=True, trip=trip)
+            metrics.llm_backend_calls.inc(backend=backend.name, outcome="timeout")
+            raise ModelProviderError(message=f"{backend.name} 超时（{backend.timeout}秒）", model=llm.name)
         except Exception as e:
-            debug(f"[WS] 过滤 ws 失败: {e}")
+            if is_backend_failure(e):
+                backend.record_failure(trip=trip)
+                metrics.llm_backend_calls.inc(backend=backend.name, outcome="failure")
+            else:
+                backend.record_error()
+                metrics.llm_backend_calls.inc(backend=backend.name, outcome="error")
+            raise
+        backend.record_success(time.perf_counter() - started)
+        metrics.llm_backend_calls.inc(backend=backend.name, outcome="success")
+        # PooledChatOllama自己累计步骤统计，其它后端在这里补上
+        stats = llm_step_stats.get()
+        if stats is not None and backend.kind != "ollama":
+            stats["llm_calls"] += 1
+            if response.usage is not None:
+                stats["tokens_in"] += response.usage.prompt_tokens
+                stats["tokens_out"] += response.usage.completion_tokens
+        return response
+
+    async def ainvoke(self, messages, output_format=None):
+        pending: Dict[asyncio.Task, LLMBackend] = {}
+        errors = []
+        remaining = iter(self.chain)
 
-    if send_tasks and websocket_loop:
+        def launch() -> bool:
+            # 启动下一个没有熔断的后端
+            for backend, llm in remaining:
+                if len(self.chain) == 1 or backend.available():
+                    pending[asyncio.create_task(self._call(backend, llm, messages, output_format))] = backend
+                    return True
+            return False
+
+        if not launch():
+            raise ModelProviderError(message="所有LLM后端都处于熔断状态", model=self.name)
+        primary = next(iter(pending.values()))
+        hedged = False
         try:
-            future = asyncio.run_coroutine_threadsafe(
-                asyncio.gather(*send_tasks, return_exceptions=True),
-                websocket_loop
-            )
-            future.result()
-        except Exception as e:
-            debug(f"[WS] 广播 handler 异常: {e}")
+            while pending:
+                # 每步最多对冲一次：只在主后端单独在途时计时
+                delay = self._hedge_delay(primary) if not hedged and len(pending) == 1 else None
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    if launch():
+                        primary.stats["hedged"] += 1
+                    continue
+                for task in done:
+                    backend = pending.pop(task)
+                    try:
+                        response = task.result()
+                    except Exception as e:
+                        errors.append(f"{backend.name}: {e}")
+                        continue
+                    if hedged and backend is not primary:
+                        backend.stats["hedge_wins"] += 1
+                    return response
+                # 在途请求都失败了，换下一个后端
+                if not pending and not launch():
+                    break
+            raise ModelProviderError(message="；".join(errors), model=self.name)
+        finally:
+            for task in pending:
+                task.cancel()
 
-# 标准输出流拦截（支持agent_id）
-class TeeLoggerStream:
-    def __init__(self, original_stream, agent_id=None):
-        self.original_stream = original_stream
-        self.agent_id = agent_id
-        self._buffer = ""
+# LLM后端注册表：Ollama按host建后端（实例仍由LLMClientRegistry缓存），OpenAI兼容后端来自配置
+class LLMBackendRegistry:
+    def __init__(self, llm_registry: LLMClientRegistry, ollama_timeout: float, backends: Dict[str, Dict[str, Any]],
+                 fallbacks: List[str], hedge: bool, hedge_percentile: float, hedge_min_samples: int,
+                 hedge_min_delay: float, latency_window: int, breaker_failures: int, breaker_cooldown: float):
+        self.llm_registry = llm_registry
+        self.ollama_timeout = ollama_timeout
+        self.fallbacks = fallbacks
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.latency_window = latency_window
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.backends: Dict[str, LLMBackend] = {}
+        for name, spec in backends.items():
+            if spec.get("api_key"):
+                self.backends[name] = self._new_backend(name, spec["type"], spec["timeout"], base_url=spec["base_url"],
+                                                        api_key=spec["api_key"], model=spec["model"])
 
-    def write(self, message):
-        self.original_stream.write(message)
-        self.original_stream.flush()
-        self._buffer += message
-        if "\n" in self._buffer:
-            lines = self._buffer.split("\n")
-            for line in lines[:-1]:
-                if line.strip():
-                    broadcast_log_message(line.strip(), agent_id=self.agent_id)
-            self._buffer = lines[-1]
+    def _new_backend(self, name: str, kind: str, timeout: float, **kwargs) -> LLMBackend:
+        return LLMBackend(name, kind, timeout, self.breaker_failures, self.breaker_cooldown, self.latency_window, **kwargs)
 
-    def flush(self):
-        self.original_stream.flush()
+    def _ollama(self, host: str) -> LLMBackend:
+        name = f"ollama@{host}"
+        backend = self.backends.get(name)
+        if backend is None:
+            backend = self.backends[name] = self._new_backend(name, "ollama", self.ollama_timeout, base_url=host)
+        return backend
 
-    def isatty(self):
-        return self.original_stream.isatty()
+    def _llm(self, backend: LLMBackend, model: Optional[str]):
+        if backend.kind == "ollama":
+            return self.llm_registry.get(backend.base_url, model)
+        return backend.create_llm(model or backend.model)
 
-    def close(self):
-        pass
+    def _primary(self, backend_name: str, host: str) -> LLMBackend:
+        if backend_name == "ollama":
+            return self._ollama(host)
+        backend = self.backends.get(backend_name)
+        if backend is None:
+            raise ValueError(f"LLM后端 {backend_name} 未配置api_key")
+        return backend
 
-# logging handler → 广播
-class BroadcastingHandler(logging.Handler):
-    def __init__(self, agent_id=None):
-        super().__init__()
+    def resolve_model(self, request: AgentRequest):
+        # 提交时确定主后端可用，非Ollama后端没有显式指定模型时换成该后端的默认模型
+        primary = self._primary(request.backend, request.host)
+        if primary.kind != "ollama" and "model" not in request.model_fields_set:
+            request.model = primary.model
+
+    def build(self, backend_name: str, host: str, model: str) -> ResilientChatModel:
+        # 主后端用请求的模型，备用后端用各自的默认模型
+        primary = self._primary(backend_name, host)
+        chain = [(primary, self._llm(primary, model))]
+        for name in self.fallbacks:
+            backend = self.backends.get(name)
+            if backend is not None and backend is not primary:
+                chain.append((backend, self._llm(backend, None)))
+        return ResilientChatModel(chain, self.hedge, self.hedge_percentile, self.hedge_min_samples, self.hedge_min_delay)
+
+    def get_stats(self):
+        return {
+            "hedge": self.hedge,
+            "fallbacks": self.fallbacks,
+            "backends": {name: backend.get_stats() for name, backend in self.backends.items()},
+        }
+
+# 看门狗判定任务卡死或连续超时，直接失败
+class AgentStalled(Exception):
+    def __init__(self, message: str, events: List[Dict[str, Any]]):
+        super().__init__(message)
+        self.events = events
+
+# 带事件推送和计时的Agent：模块级定义，agent_id和调度信息都是实例属性，事件统一发到事件总线
+class WebSocketAgent(Agent):
+    def __init__(self, *args, agent_id: str, cdp_url: str, llm_host: str,
+                 llm_model: str, llm_backend: str = "ollama", priority: int = 0, timeout: float = None,
+                 max_steps: int = None, **kwargs):
+        super().__init__(*args, **kwargs)
         self.agent_id = agent_id
+        self.cdp_url = cdp_url
+        self.llm_host = llm_host
+        self.llm_model = llm_model
+        self.llm_backend = llm_backend
+        self.priority = priority
+        self.timeout = timeout or TASK_CONFIG["task_timeout"]
+        self.max_steps = max_steps or AGENT_CONFIG["max_steps"]
+        self.step_timings: List[Dict[str, Any]] = []  # 每步的耗时记录，任务结束后写入结果
+        self.lifecycle_state = "created"  # created -> running -> finished/failed/cancelled
+        self.last_active = time.monotonic()
+        self.last_progress = time.monotonic()
+        self.watchdog_events: List[Dict[str, Any]] = []  # 看门狗的处理记录，任务结束后写入结果
+        self.consecutive_timeouts = 0
+        self._aborting = False  # 看门狗或总超时主动取消运行时置位，区别于单步超时
+        debug(f"创建WebSocketAgent: {agent_id}, 任务: {self.task}")
 
-    def emit(self, record):
+    async def _log(self, message: str, level: str = "INFO"):
+        logger.debug(f"捕获日志: [{level}] {message}")
+        broadcast_log_message(f"[{level}] {message}", "log", self.agent_id, level=level)
+        await super()._log(message, level)
+
+    async def _step(self, step_number: int, action: str, result: str = ""):
+        step_data = {
+            "step": step_number,
+            "action": action,
+            "result": result
+        }
+        logger.debug(f"捕获步骤: {step_data}")
+        broadcast_log_message(encode_message(step_data), "step", self.agent_id)
+        await super()._step(step_number, action, result)
+
+    # 按阶段累计单步耗时：state=页面状态/DOM采集，llm=推理（含重试），actions=动作执行
+    async def _timed(self, phase: str, coro):
+        started = time.perf_counter()
         try:
-            msg = self.format(record)
-            broadcast_log_message(msg, message_type="log", agent_id=self.agent_id)
-        except Exception as e:
-            debug(f"[WS] 广播 handler 异常: {e}")
+            return await coro
+        except (TimeoutError, asyncio.TimeoutError):
+            # browser_use的llm_timeout到期会在这里抛出
+            self.step_timing["timed_out"] = phase
+            raise
+        finally:
+            self.step_timing[f"{phase}_seconds"] += time.perf_counter() - started
+            self.last_progress = time.monotonic()
 
-# 清除所有已有handler并附加广播handler
-def attach_handler_to_all_loggers(*handlers):
-    for name in logging.root.manager.loggerDict:
-        logging.getLogger(name).handlers.clear()
-    logging.getLogger().handlers.clear()
+    async def _prepare_context(self, step_info=None):
+        return await self._timed("state", super()._prepare_context(step_info))
 
-    loggers = [logging.getLogger(name) for name in logging.root.manager.loggerDict]
-    loggers.append(logging.getLogger())
-    for logger in loggers:
-        for handler in handlers:
-            if handler not in logger.handlers:
-                logger.addHandler(handler)
-        logger.setLevel(logging.INFO)
-        logger.propagate = False
+    async def _get_next_action(self, browser_state_summary):
+        return await self._timed("llm", super()._get_next_action(browser_state_summary))
 
-# WebSocket连接管理器（FastAPI WebSocket，按agent_id隔离）
-class WebSocketManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+    async def _execute_actions(self):
+        return await self._timed("actions", super()._execute_actions())
+
+    async def step(self, step_info=None):
+        self.step_timing = {
+            "step": self.state.n_steps,
+            "state_seconds": 0.0,
+            "llm_seconds": 0.0,
+            "actions_seconds": 0.0,
+        }
+        stats = {"llm_calls": 0, "tokens_in": 0, "tokens_out": 0, "cache_hits": 0}
+        stats_token = llm_step_stats.set(stats)
+        started = time.perf_counter()
+        self.last_progress = time.monotonic()
+        try:
+            return await super().step(step_info)
+        except asyncio.CancelledError:
+            # 不是 /cancel（会先stop）也不是看门狗主动取消，就是browser_use的step_timeout到期
+            if not self.state.stopped and not self._aborting:
+                self.step_timing.setdefault("timed_out", "step")
+            raise
+        finally:
+            llm_step_stats.reset(stats_token)
+            await self._record_step_timing(time.perf_counter() - started, stats)
+
+    async def _record_step_timing(self, total: float, stats: Dict[str, int]):
+        timing = self.step_timing
+        timing["total_seconds"] = total
+        for key in ("state_seconds", "llm_seconds", "actions_seconds", "total_seconds"):
+            timing[key] = round(timing[key], 4)
+        timing.update(stats)
+        # 空动作时browser_use会再请求一次LLM；步骤出错时下一步会重试
+        timing["retries"] = max(0, stats["llm_calls"] - 1)
+        timing["consecutive_failures"] = self.state.consecutive_failures
+        timing["model"] = self.llm_model
+        self.step_timings.append(timing)
+
+        labels = {"model": self.llm_model, "cdp_url": self.cdp_url}
+        metrics.step_duration.observe(total, **labels)
+        metrics.step_llm.observe(timing["llm_seconds"], **labels)
+        metrics.step_browser.observe(timing["state_seconds"] + timing["actions_seconds"], **labels)
+
+        broadcast_log_message(encode_message(timing), "timing", self.agent_id)
+
+    async def _watchdog_event(self, action: str, message: str, **detail):
+        event = {"action": action, "step": self.state.n_steps, "model": self.llm_model, "message": message,
+                 "time": time.time(), **detail}
+        self.watchdog_events.append(event)
+        metrics.watchdog_actions.inc(action=action, model=self.llm_model, cdp_url=self.cdp_url)
+        debug(f"[Watchdog] Agent {self.agent_id}: {message}")
+        broadcast_log_message(encode_message(event), "watchdog", self.agent_id)
+
+    async def _downgrade_model(self):
+        fallback = WATCHDOG_CONFIG["fallback_models"].get(self.llm_model)
+        if not fallback or self.llm_backend != "ollama":
+            return None
+        if not await agent_manager.llm_registry.has_model(self.llm_host, fallback):
+            debug(f"[Watchdog] Agent {self.agent_id}: 降级模型 {fallback} 未安装，继续使用 {self.llm_model}")
+            return None
+        llm = agent_manager.get_or_create_llm(self.llm_host, fallback, self.llm_backend)
+        agent_manager.hold_llm(self.agent_id, llm)
+        self.token_cost_service.register_llm(llm)
+        self.llm = llm
+        self.llm_model = fallback
+        return fallback
+
+    # 每步结束后根据该步是否超时决定：正常 / 重试（browser_use下一步自动重试）/ 降级模型 / 直接失败
+    async def _check_step_timeout(self):
+        timing = self.step_timings[-1] if self.step_timings else {}
+        timed_out = timing.get("timed_out")
+        if not timed_out:
+            self.consecutive_timeouts = 0
+            return
+        self.consecutive_timeouts += 1
+        count = self.consecutive_timeouts
+        if count >= WATCHDOG_CONFIG["fail_after"]:
+            await self._watchdog_event("fail_fast", f"连续 {count} 步超时，直接失败", consecutive_timeouts=count)
+            raise AgentStalled(f"Agent {self.agent_id} 连续 {count} 步超时", self.watchdog_events)
+        llm_bound = timed_out == "llm" or timing.get("llm_seconds", 0) >= timing.get("total_seconds", 0) / 2
+        if count >= WATCHDOG_CONFIG["downgrade_after"] and llm_bound:
+            previous = self.llm_model
+            fallback = await self._downgrade_model()
+            if fallback:
+                # 换模型后重新计数，browser_use的连续失败数也一并清零
+                self.consecutive_timeouts = 0
+                self.state.consecutive_failures = 0
+                await self._watchdog_event("model_downgrade", f"连续 {count} 步LLM超时，模型 {previous} 降级为 {fallback}",
+                                           from_model=previous, to_model=fallback)
+                return
+        await self._watchdog_event("step_retry", f"第 {timing.get('step')} 步超时（{timed_out}），重试",
+                                   phase=timed_out, consecutive_timeouts=count)
+
+    # 卡死检测：超过stall_timeout没有任何进度就返回（单步超时无法打断的情况，如不响应取消的调用）
+    async def _watch_for_stall(self):
+        stall_timeout = WATCHDOG_CONFIG["stall_timeout"]
+        while True:
+            await asyncio.sleep(WATCHDOG_CONFIG["check_interval"])
+            idle = time.monotonic() - self.last_progress
+            if idle > stall_timeout:
+                await self._watchdog_event("stalled", f"{int(idle)} 秒没有任何进度，判定为卡死", idle_seconds=round(idle, 1))
+                return
+
+    async def run(self):
+        logger.debug(f"开始运行Agent {self.agent_id}")
+        self.lifecycle_state = "running"
+        self.last_active = time.monotonic()
+        succeeded = False
+        # 日志和输出按上下文归属到当前agent，不再重定向进程级的stdout/stderr
+        with agent_log_context(self.agent_id):
+            try:
+                # 获取超时时间，优先使用请求中的timeout，否则使用配置文件中的默认值
+                timeout = getattr(self, 'timeout', TASK_CONFIG["task_timeout"])
+                logger.debug(f"Agent {self.agent_id} 使用超时时间: {timeout}秒")
+
+                async def on_step_start(agent):
+                    agent.last_progress = time.monotonic()
+
+                async def on_step_end(agent):
+                    agent.last_active = agent.last_progress = time.monotonic()
+                    task_registry.record_step(agent.agent_id, agent.history.number_of_steps())
+                    await agent._check_step_timeout()
+
+                # 总超时和卡死检测一起看：单步超时由browser_use按step_timeout控制
+                self.last_progress = time.monotonic()
+                run_task = asyncio.create_task(
+                    super().run(max_steps=self.max_steps, on_step_start=on_step_start, on_step_end=on_step_end)
+                )
+                watch_task = asyncio.create_task(self._watch_for_stall())
+                try:
+                    done, _ = await asyncio.wait({run_task, watch_task}, timeout=timeout,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    watch_task.cancel()
+                    if not run_task.done():
+                        self._aborting = True
+                        run_task.cancel()
+                        await asyncio.wait({run_task}, timeout=WATCHDOG_CONFIG["check_interval"])
+                if run_task in done:
+                    result = run_task.result()
+                elif watch_task in done:
+                    raise AgentStalled(f"Agent {self.agent_id} 长时间没有进度，已中止", self.watchdog_events)
+                else:
+                    raise asyncio.TimeoutError()
+
+                logger.debug(f"Agent {self.agent_id} 运行完成，结果: {result}")
+                broadcast_log_message(f"Agent {self.agent_id} 运行完成: {result}", "status", self.agent_id)
+                succeeded = True
+                return result
+            except asyncio.TimeoutError:
+                error_msg = f"Agent {self.agent_id} 推理超时（{timeout}秒）"
+                logger.error(error_msg)
+                broadcast_log_message(error_msg, "error", self.agent_id)
+                raise
+            except asyncio.CancelledError:
+                self.lifecycle_state = "cancelled"
+                broadcast_log_message(f"Agent {self.agent_id} 已取消", "status", self.agent_id)
+                raise
+            except AgentStalled as e:
+                logger.error(str(e))
+                broadcast_log_message(str(e), "error", self.agent_id)
+                raise
+            except Exception as e:
+                logger.error(f"Agent {self.agent_id} 运行失败: {e}")
+                broadcast_log_message(f"Agent {self.agent_id} 运行失败: {str(e)}", "error", self.agent_id)
+                raise
+            finally:
+                if self.lifecycle_state == "running":
+                    self.lifecycle_state = "finished" if succeeded else "failed"
+                self.last_active = time.monotonic()
+
+# browser_use按task_id和会话id生成具名logger，logging模块会永久持有；Agent移除时一并清理
+def release_agent_loggers(agent: Agent):
+    prefix = f"browser_use.Agent🅰 {agent.task_id[-4:]} on "
+    logger_dict = logging.Logger.manager.loggerDict
+    for name in [name for name in list(logger_dict) if name.startswith(prefix)]:
+        logger_dict.pop(name, None)
+    logger_dict.pop(f"browser_use.Agent[{agent.task_id[-3:]}]", None)
+
+# 每个Agent用一个新的BrowserSession，其logger名带会话id。浏览器上下文关闭后browser_use每次访问logger都会
+# 按名字重新注册（析构时也会），所以清理所有不属于在用会话的BrowserSession logger，上一个会话析构时注册的下次清理
+def release_session_loggers(live_sessions):
+    live = tuple(f"browser_use.BrowserSession🆂 {session.id[-4:]}:" for session in live_sessions)
+    logger_dict = logging.Logger.manager.loggerDict
+    for name in list(logger_dict):
+        if name.startswith("browser_use.BrowserSession🆂 ") and not name.startswith(live):
+            logger_dict.pop(name, None)
+
+# Agent生命周期管理：定期回收运行结束超过finished_ttl、或闲置超过idle_ttl的Agent，
+# 以及Agent已不存在的残留WebSocket连接；运行中的Agent不回收
+class AgentLifecycleManager:
+    def __init__(self, manager: "MultiAgentManager", finished_ttl: float, idle_ttl: float, reap_interval: float,
+                 cancel_grace: float):
+        self.manager = manager
+        self.finished_ttl = finished_ttl
+        self.idle_ttl = idle_ttl
+        self.reap_interval = reap_interval
+        self.cancel_grace = cancel_grace
+        self._reaper_task = None
+        self.running_tasks: Dict[str, asyncio.Task] = {}  # agent_id -> 正在执行该Agent（或排队中任务）的asyncio任务
+        self.cancel_requested = set()
+        self.stats = {"agents_finished": 0, "agents_failed": 0, "agents_cancelled": 0, "agents_idle": 0,
+                      "websocket_connections": 0, "cancelled": 0}
+
+    def ensure_reaper(self):
+        if self._reaper_task is None or self._reaper_task.done():
+            self._reaper_task = asyncio.create_task(self._reap_loop())
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                debug(f"[Lifecycle] 回收Agent出错: {e}")
+
+    def _reap_reason(self, agent, now: float):
+        state = getattr(agent, "lifecycle_state", "created")
+        idle = now - getattr(agent, "last_active", now)
+        if state == "running":
+            return None
+        if state in ("finished", "failed", "cancelled") and idle > self.finished_ttl:
+            return state
+        if idle > self.idle_ttl:
+            return "idle"
+        return None
+
+    async def reap(self) -> Dict[str, int]:
+        now = time.monotonic()
+        reaped = {"agents_finished": 0, "agents_failed": 0, "agents_cancelled": 0, "agents_idle": 0, "websocket_connections": 0}
+        for agent_id, agent in list(self.manager.active_agents.items()):
+            # 还有执行任务的Agent不回收：排队等调度槽位时lifecycle_state仍是created，不能按空闲处理
+            if agent_id in self.running_tasks:
+                continue
+            reason = self._reap_reason(agent, now)
+            if reason is None:
+                continue
+            await self.manager.remove_agent(agent_id)
+            reaped[f"agents_{reason}"] += 1
+            debug(f"[Lifecycle] 回收Agent {agent_id}（{reason}）")
+        
+        # Agent已移除、任务也已结束的WebSocket连接
+        websocket_manager = self.manager.websocket_manager
+        for agent_id in websocket_manager.stale_agents(self.finished_ttl, self.manager.active_agents):
+            record = task_registry.get(agent_id)
+            if record is not None and record["status"] not in TASK_TERMINAL_STATES:
+                continue
+            reaped["websocket_connections"] += await websocket_manager.close_agent(agent_id, f"Agent {agent_id} 已回收，连接关闭")
+        
+        for key, count in reaped.items():
+            self.stats[key] += count
+        return reaped
+
+    def track(self, agent_id: str, task: asyncio.Task):
+        self.running_tasks[agent_id] = task
+        
+        def untrack(done_task):
+            if self.running_tasks.get(agent_id) is done_task:
+                del self.running_tasks[agent_id]
+        task.add_done_callback(untrack)
     
-    async def connect(self, websocket: WebSocket, agent_id: str):
-        await websocket.accept()
-        if agent_id not in self.active_connections:
-            self.active_connections[agent_id] = []
-        self.active_connections[agent_id].append(websocket)
-        debug(f"[FastAPI WS] WebSocket已连接到Agent: {agent_id}")
+    def consume_cancel(self, agent_id: str) -> bool:
+        # 区分 /cancel 发起的取消和服务关闭等其他原因的取消
+        if agent_id in self.cancel_requested:
+            self.cancel_requested.discard(agent_id)
+            return True
+        return False
     
-    def disconnect(self, websocket: WebSocket, agent_id: str):
-        if agent_id in self.active_connections:
-            if websocket in self.active_connections[agent_id]:
-                self.active_connections[agent_id].remove(websocket)
-            if not self.active_connections[agent_id]:
-                del self.active_connections[agent_id]
-        debug(f"[FastAPI WS] WebSocket已断开连接Agent: {agent_id}")
+    async def cancel(self, agent_id: str) -> bool:
+        # 先让browser_use停止调度下一步，再取消任务：取消会打断进行中的Ollama请求和CDP调用，
+        # 由任务自身的清理逻辑归还调度槽位和浏览器会话
+        task = self.running_tasks.get(agent_id)
+        if task is None or task.done():
+            return False
+        self.cancel_requested.add(agent_id)
+        agent = self.manager.get_agent(agent_id)
+        if agent is not None:
+            agent.stop()
+        task.cancel()
+        self.stats["cancelled"] += 1
+        done, _ = await asyncio.wait({task}, timeout=self.cancel_grace)
+        if not done:
+            debug(f"[Lifecycle] Agent {agent_id} 取消后 {self.cancel_grace} 秒内未完成清理")
+        return True
     
-    async def send_message(self, agent_id: str, message: str, message_type: str = "log"):
-        if agent_id in self.active_connections:
-            message_data = {
-                "type": message_type,
-                "message": message,
-                "timestamp": asyncio.get_event_loop().time()
-            }
-            disconnected = []
-            for connection in self.active_connections[agent_id]:
-                try:
-                    await connection.send_text(json.dumps(message_data, ensure_ascii=False))
-                    debug(f"[FastAPI WS] 发送消息到 {agent_id}: {message_data}")
-                except Exception as e:
-                    debug(f"[FastAPI WS] 发送消息失败: {e}")
-                    disconnected.append(connection)
-            
-            for connection in disconnected:
-                self.disconnect(connection, agent_id)
+    def get_stats(self):
+        states: Dict[str, int] = {}
+        for agent in self.manager.active_agents.values():
+            state = getattr(agent, "lifecycle_state", "created")
+            states[state] = states.get(state, 0) + 1
+        return {
+            "reaped": dict(self.stats),
+            "released": dict(self.manager.cleanup_stats),
+            "agents_by_state": states,
+            "running_tasks": len(self.running_tasks),
+        }
 
 # 多Agent管理器
 class MultiAgentManager:
     def __init__(self, websocket_manager: WebSocketManager):
         self.active_agents: Dict[str, Agent] = {}
         self.browser_sessions: Dict[str, BrowserSession] = {}
-        self.llm_instances: Dict[str, ChatOllama] = {}
+        self.agent_llms: Dict[str, List[ResilientChatModel]] = {}  # 每个Agent持有的LLM（含看门狗降级后换上的）
+        self.llm_registry = LLMClientRegistry(**LLM_REGISTRY_CONFIG)
+        self.llm_backends = LLMBackendRegistry(self.llm_registry, LLM_REGISTRY_CONFIG["request_timeout"], **LLM_BACKENDS_CONFIG)
         self.websocket_manager = websocket_manager
+        self.browser_pool = BrowserSessionPool(**BROWSER_POOL_CONFIG)
+        self.lifecycle = AgentLifecycleManager(self, **LIFECYCLE_CONFIG)
+        # remove_agent累计释放的资源（手动移除和自动回收都计入）
+        self.cleanup_stats = {"agents": 0, "browser_sessions": 0, "agent_dirs": 0}
     
-    def get_or_create_browser_session(self, cdp_url: str) -> BrowserSession:
-        # 为每个Agent创建独立的BrowserSession，避免共享问题
-        return BrowserSession(cdp_url=cdp_url)
+    async def get_or_create_browser_session(self, cdp_url: str) -> BrowserSession:
+        # 从会话池借出BrowserSession，每个Agent独占一个浏览器上下文，用完销毁
+        return await self.browser_pool.checkout(cdp_url)
     
-    def get_or_create_llm(self, host: str, model: str) -> ChatOllama:
-        key = f"{host}_{model}"
-        if key not in self.llm_instances:
-            self.llm_instances[key] = ChatOllama(host=host, model=model)
-        return self.llm_instances[key]
+    def get_or_create_llm(self, host: str, model: str, backend: str = "ollama") -> ResilientChatModel:
+        # 每次返回新的包装实例（browser_use的TokenCost会替换实例上的ainvoke），底层LLM实例各后端共享
+        return self.llm_backends.build(backend, host, model)
+
+    def hold_llm(self, agent_id: str, llm: ResilientChatModel):
+        # Agent移除前一直持有，避免长任务运行中LLM实例因闲置TTL被淘汰、共享连接池被关闭
+        self.agent_llms.setdefault(agent_id, []).append(llm)
+        for pooled in llm.pooled_llms():
+            self.llm_registry.hold(pooled)
+
+    def release_llms(self, agent_id: str):
+        for llm in self.agent_llms.pop(agent_id, []):
+            for pooled in llm.pooled_llms():
+                self.llm_registry.release(pooled)
     
     async def create_agent(self, agent_id: str, request: AgentRequest) -> Agent:
-        # 为每个Agent创建独立的BrowserSession
-        browser_session = self.get_or_create_browser_session(request.cdp_url)
+        self.lifecycle.ensure_reaper()
+        # 未指定cdp_url时分配Chrome节点（/run_task 提交时已分配过的直接沿用）
+        chrome_supervisor.wake()
+        request.cdp_url = chrome_nodes.assign(agent_id, request.cdp_url, request.headless)
+        try:
+            return await self._create_agent(agent_id, request)
+        except BaseException:
+            chrome_nodes.unassign(agent_id)
+            self.release_llms(agent_id)
+            raise
+
+    async def _create_agent(self, agent_id: str, request: AgentRequest) -> Agent:
+        self.llm_backends.resolve_model(request)
+        llm = self.get_or_create_llm(request.host, request.model, request.backend)
+        self.hold_llm(agent_id, llm)
+        # 为每个Agent借出独立的BrowserSession，同时预热Ollama模型，避免模型加载时间算进第一步
+        warm_up = self.llm_registry.warm_up(request.host, request.model) if request.backend == "ollama" else asyncio.sleep(0)
+        browser_session, _ = await asyncio.gather(
+            self.get_or_create_browser_session(request.cdp_url),
+            warm_up
+        )
         # 将BrowserSession与Agent关联，以便后续清理
         self.browser_sessions[agent_id] = browser_session
-        llm = self.get_or_create_llm(request.host, request.model)
-        
-        class WebSocketAgent(Agent):
-            def __init__(self, *args, **kwargs):
-                super().__init__(*args, **kwargs)
-                self.agent_id = agent_id
-                self.websocket_manager = self.websocket_manager
-                debug(f"创建WebSocketAgent: {agent_id}, 任务: {request.task}")
-            
-            async def _log(self, message: str, level: str = "INFO"):
-                logger.debug(f"捕获日志: [{level}] {message}")
-                await self.websocket_manager.send_message(
-                    self.agent_id, 
-                    json.dumps({
-                        "level": level,
-                        "content": message,
-                        "context": "agent_log"
-                    }, ensure_ascii=False),
-                    "log"
-                )
-                broadcast_log_message(f"[{level}] {message}", "log", self.agent_id)
-                await super()._log(message, level)
-            
-            async def _step(self, step_number: int, action: str, result: str = ""):
-                step_data = {
-                    "step": step_number,
-                    "action": action,
-                    "result": result
-                }
-                logger.debug(f"捕获步骤: {step_data}")
-                await self.websocket_manager.send_message(
-                    self.agent_id,
-                    json.dumps(step_data, ensure_ascii=False),
-                    "step"
-                )
-                broadcast_log_message(json.dumps(step_data, ensure_ascii=False), "step", self.agent_id)
-                await super()._step(step_number, action, result)
-            
-            async def run(self):
-                logger.debug(f"开始运行Agent {self.agent_id}")
-                with contextlib.redirect_stdout(TeeLoggerStream(sys.stdout, self.agent_id)), \
-                     contextlib.redirect_stderr(TeeLoggerStream(sys.stderr, self.agent_id)):
-                    try:
-                        # 获取超时时间，优先使用请求中的timeout，否则使用配置文件中的默认值
-                        timeout = getattr(self, 'timeout', TASK_CONFIG["task_timeout"])
-                        logger.debug(f"Agent {self.agent_id} 使用超时时间: {timeout}秒")
-                        
-                        # 在agent推理过程中应用超时控制
-                        result = await asyncio.wait_for(super().run(), timeout=timeout)
-                        
-                        logger.debug(f"Agent {self.agent_id} 运行完成，结果: {result}")
-                        broadcast_log_message(f"Agent {self.agent_id} 运行完成: {result}", "status", self.agent_id)
-                        return result
-                    except asyncio.TimeoutError:
-                        error_msg = f"Agent {self.agent_id} 推理超时（{timeout}秒）"
-                        logger.error(error_msg)
-                        broadcast_log_message(error_msg, "error", self.agent_id)
-                        raise
-                    except Exception as e:
-                        logger.error(f"Agent {self.agent_id} 运行失败: {e}")
-                        broadcast_log_message(f"Agent {self.agent_id} 运行失败: {str(e)}", "error", self.agent_id)
-                        raise
-        
-        WebSocketAgent.websocket_manager = self.websocket_manager
         
+        # 设置agent的超时时间
+        timeout = request.timeout or TASK_CONFIG["task_timeout"]
         agent = WebSocketAgent(
             task=request.task,
             llm=llm,
             verbose=request.verbose,
             use_vision=False,
-            headless=request.headless,
-            max_steps=request.max_steps,
-            browser_session=browser_session
+            browser_session=browser_session,
+            step_timeout=AGENT_CONFIG["step_timeout"],
+            agent_id=agent_id,
+            # 记录调度所需的资源信息
+            cdp_url=request.cdp_url,
+            llm_host=request.host,
+            llm_model=request.model,
+            llm_backend=request.backend,
+            priority=request.priority,
+            timeout=timeout,
+            max_steps=request.max_steps
         )
-        
-        # 设置agent的超时时间
-        timeout = getattr(request, 'timeout', TASK_CONFIG["task_timeout"])
-        agent.timeout = timeout
         debug(f"Agent {agent_id} 超时时间设置为: {timeout}秒")
         
         self.active_agents[agent_id] = agent
@@ -331,49 +3219,130 @@ class MultiAgentManager:
         return self.active_agents.get(agent_id)
     
     async def remove_agent(self, agent_id: str):
-        if agent_id in self.active_agents:
-            del self.active_agents[agent_id]
+        chrome_nodes.unassign(agent_id)
+        self.release_llms(agent_id)
+        agent = self.active_agents.pop(agent_id, None)
+        if agent is not None:
+            release_agent_loggers(agent)
+            self.cleanup_stats["agents"] += 1
             debug(f"Agent {agent_id} 已移除")
         
-        # 关闭并清理对应的BrowserSession
-        if agent_id in self.browser_sessions:
+        # 把对应的BrowserSession归还会话池（销毁其浏览器上下文）
+        browser_session = self.browser_sessions.pop(agent_id, None)
+        if browser_session is not None:
             try:
-                await self.browser_sessions[agent_id].close()
-                del self.browser_sessions[agent_id]
-                debug(f"BrowserSession {agent_id} 已关闭并清理")
+                await self.browser_pool.release(browser_session)
+                self.cleanup_stats["browser_sessions"] += 1
+                debug(f"BrowserSession {agent_id} 已归还会话池")
             except Exception as e:
-                debug(f"关闭BrowserSession {agent_id} 时出错: {e}")
+                debug(f"归还BrowserSession {agent_id} 时出错: {e}")
+            release_session_loggers([*self.browser_sessions.values(), *self.browser_pool.connections.values()])
+        
+        # browser_use为每个Agent在临时目录下建的工作目录（文件系统、截图）
+        agent_directory = getattr(agent, "agent_directory", None)
+        if agent_directory is not None and os.path.isdir(agent_directory):
+            await asyncio.to_thread(shutil.rmtree, agent_directory, True)
+            self.cleanup_stats["agent_dirs"] += 1
 
 # 全局管理器实例
 websocket_manager = WebSocketManager()
 agent_manager = MultiAgentManager(websocket_manager)
+agent_scheduler = AgentScheduler(**SCHEDULER_CONFIG)
+chrome_nodes = ChromeNodeRegistry(scheduler=agent_scheduler, **CHROME_NODES_CONFIG)
+chrome_supervisor = ChromeSupervisor(registry=chrome_nodes, scheduler=agent_scheduler, **CHROME_SUPERVISOR_CONFIG)
+task_registry = TaskRegistry(**TASK_STORE_CONFIG)
+model_router = ModelRouter(**MODEL_ROUTER_CONFIG)
+# 用持久化的任务记录预热各模板的历史步数
+model_router.learn(task_registry.tasks.values())
+
+# 指标标签：Agent的模型和cdp_url（Agent已移除时为unknown）
+def agent_metric_labels(agent_id: str) -> Dict[str, str]:
+    agent = agent_manager.get_agent(agent_id)
+    if agent is None:
+        return {"model": "unknown", "cdp_url": "unknown"}
+    return {"model": getattr(agent, "llm_model", "unknown"), "cdp_url": getattr(agent, "cdp_url", "unknown")}
+
+# 全局WebSocket（原7789端口协议，支持订阅多个agent_id和按消息类型过滤），由同一个uvicorn进程提供：
+# 旧客户端仍连接 ws://host:7789/，也可以直接连接 ws://host:8000/ws
+# 订阅: {"type": "subscribe", "agent_ids": ["agent_1"], "message_types": ["step", "error"]}
+# 取消: {"type": "unsubscribe", "agent_ids": ["agent_1"]}（不带agent_ids表示全部取消）
+# 批量推送在连接时协商: ws://host:7789/?batch_ms=200&batch_size=50
+@app.websocket("/")
+@app.websocket("/ws")
+async def global_websocket_endpoint(websocket: WebSocket):
+    batch_ms, batch_size = negotiate_batching(
+        websocket.query_params.get("batch_ms", 0), websocket.query_params.get("batch_size", 0)
+    )
+    client = await websocket_manager.connect_global(websocket, batch_ms, batch_size)
+    sender_task = None
+    try:
+        if batch_ms:
+            await websocket.send_text(encode_message({
+                "type": "connection",
+                "message": f"已开启批量推送：每 {batch_ms}ms 或 {batch_size} 条",
+                "batch": {"batch_ms": batch_ms, "batch_size": batch_size},
+                "timestamp": time.time()
+            }))
+        sender_task = asyncio.create_task(client.sender())
+        subscriptions = websocket_manager.subscriptions
+        async for message in websocket.iter_text():
+            try:
+                data = json.loads(message)
+                action = data.get("type")
+                if action not in ("subscribe", "unsubscribe"):
+                    continue
+                agent_ids = data.get("agent_ids") or ([data["agent_id"]] if data.get("agent_id") else [])
+                if action == "subscribe":
+                    subscriptions.subscribe(client, agent_ids, data.get("message_types"))
+                    debug(f"[WS] 客户端订阅 Agent: {agent_ids}，消息类型: {client.message_types or '全部'}")
+                else:
+                    subscriptions.unsubscribe(client, agent_ids)
+                    debug(f"[WS] 客户端取消订阅 Agent: {agent_ids or '全部'}")
+                client.enqueue(encode_message({
+                    "type": "subscribed",
+                    "agent_ids": sorted(client.agent_ids),
+                    "message_types": sorted(client.message_types) if client.message_types else None,
+                    "timestamp": time.time()
+                }))
+            except (json.JSONDecodeError, AttributeError, TypeError):
+                debug("[WS] 无效的订阅消息")
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        debug(f"[WS] 接收消息异常: {e}")
+    finally:
+        websocket_manager.disconnect_global(client)
+        if sender_task is not None:
+            sender_task.cancel()
 
 @app.websocket("/ws/{agent_id}")
-async def websocket_endpoint(websocket: WebSocket, agent_id: str):
+async def websocket_endpoint(websocket: WebSocket, agent_id: str, batch_ms: int = 0, batch_size: int = 0):
     try:
-        await websocket_manager.connect(websocket, agent_id)
-        
-        await websocket.send_text(json.dumps({
+        # 批量推送通过查询参数协商: /ws/{agent_id}?batch_ms=200&batch_size=50
+        batch_ms, batch_size = negotiate_batching(batch_ms, batch_size)
+        greeting = [{
             "type": "connection",
             "message": f"已连接到Agent: {agent_id}",
             "agent_id": agent_id,
-            "timestamp": asyncio.get_event_loop().time()
-        }, ensure_ascii=False))
-        
+            "batch": {"batch_ms": batch_ms, "batch_size": batch_size} if batch_ms else None,
+            "timestamp": time.time()
+        }]
         if agent_id in agent_manager.active_agents:
-            await websocket.send_text(json.dumps({
+            greeting.append({
                 "type": "status",
                 "message": "Agent状态: 已创建",
                 "agent_id": agent_id,
-                "timestamp": asyncio.get_event_loop().time()
-            }, ensure_ascii=False))
+                "timestamp": time.time()
+            })
         else:
-            await websocket.send_text(json.dumps({
+            greeting.append({
                 "type": "warning",
                 "message": "Agent不存在，推理过程将无法监控",
                 "agent_id": agent_id,
-                "timestamp": asyncio.get_event_loop().time()
-            }, ensure_ascii=False))
+                "timestamp": time.time()
+            })
+        # 连接后该agent的事件由事件总线推送，这里只处理心跳
+        await websocket_manager.connect(websocket, agent_id, batch_ms, batch_size, greeting)
         
         while True:
             try:
@@ -381,13 +3350,13 @@ async def websocket_endpoint(websocket: WebSocket, agent_id: str):
                 await websocket.send_text(json.dumps({
                     "type": "pong",
                     "message": "心跳响应",
-                    "timestamp": asyncio.get_event_loop().time()
+                    "timestamp": time.time()
                 }, ensure_ascii=False))
             except asyncio.TimeoutError:
                 await websocket.send_text(json.dumps({
                     "type": "ping",
                     "message": "心跳检查",
-                    "timestamp": asyncio.get_event_loop().time()
+                    "timestamp": time.time()
                 }, ensure_ascii=False))
             except WebSocketDisconnect:
                 break
@@ -395,7 +3364,7 @@ async def websocket_endpoint(websocket: WebSocket, agent_id: str):
                 await websocket.send_text(json.dumps({
                     "type": "error",
                     "message": f"处理消息时出错: {str(e)}",
-                    "timestamp": asyncio.get_event_loop().time()
+                    "timestamp": time.time()
                 }, ensure_ascii=False))
                 
     except WebSocketDisconnect:
@@ -409,24 +3378,31 @@ async def websocket_endpoint(websocket: WebSocket, agent_id: str):
 async def create_agent(request: AgentRequest):
     try:
         agent_id = f"agent_{len(agent_manager.active_agents) + 1}_{int(asyncio.get_event_loop().time())}"
+        route = model_router.route(request)
+        agent_manager.llm_backends.resolve_model(request)
         agent = await agent_manager.create_agent(agent_id, request)
         
-        await websocket_manager.send_message(
-            agent_id,
-            f"Agent {agent_id} 创建成功，任务: {request.task}",
-            "status"
-        )
         broadcast_log_message(f"Agent {agent_id} 创建成功，任务: {request.task}", "status", agent_id)
         
         return AgentResponse(
             success=True,
             message=f"Agent {agent_id} 创建成功",
-            result={"agent_id": agent_id}
+            result={"agent_id": agent_id, "route": route}
         )
+    except NoChromeNodeAvailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         debug(f"创建Agent失败: {e}")
         raise HTTPException(status_code=500, detail=f"创建Agent失败: {str(e)}")
 
+# 在调度槽位内运行已创建的Agent
+async def agent_scheduler_run(agent, queued_at: float):
+    async with agent_scheduler.slot(agent.cdp_url, llm_limit_key(agent.llm_backend, agent.llm_host), agent.priority):
+        metrics.queue_wait.observe(time.perf_counter() - queued_at, **agent_metric_labels(agent.agent_id))
+        return await agent.run()
+
 @app.post("/run_agent/{agent_id}", response_model=AgentResponse)
 async def run_agent(agent_id: str):
     try:
@@ -434,23 +3410,28 @@ async def run_agent(agent_id: str):
         if not agent:
             raise HTTPException(status_code=404, detail=f"Agent {agent_id} 不存在")
         
-        await websocket_manager.send_message(
-            agent_id,
-            f"开始运行Agent {agent_id}...",
-            "status"
-        )
         broadcast_log_message(f"开始运行Agent {agent_id}...", "status", agent_id)
         
         debug(f"开始运行Agent {agent_id}...")
-        # 使用配置文件中的超时时间，如果没有设置则使用默认值
-        timeout = getattr(request, 'timeout', TASK_CONFIG["task_timeout"])
-        result = await asyncio.wait_for(agent.run(), timeout=timeout)
+        queued_at = time.perf_counter()
+        # 超时由WebSocketAgent.run统一控制；运行任务登记到生命周期管理器，可通过 /cancel 取消
+        run_task = asyncio.create_task(agent_scheduler_run(agent, queued_at))
+        agent_manager.lifecycle.track(agent_id, run_task)
+        try:
+            result = await run_task
+        except asyncio.CancelledError:
+            if not agent_manager.lifecycle.consume_cancel(agent_id):
+                raise
+            error_msg = f"Agent {agent_id} 已取消"
+            broadcast_log_message(error_msg, "status", agent_id)
+            # 取消后立即归还浏览器上下文和Chrome节点，不等finished_ttl回收
+            await agent_manager.remove_agent(agent_id)
+            return AgentResponse(
+                success=False,
+                message=error_msg,
+                error="Cancelled"
+            )
         
-        await websocket_manager.send_message(
-            agent_id,
-            f"Agent {agent_id} 运行完成",
-            "status"
-        )
         broadcast_log_message(f"Agent {agent_id} 运行完成", "status", agent_id)
         
         return AgentResponse(
@@ -460,7 +3441,6 @@ async def run_agent(agent_id: str):
         )
     except asyncio.TimeoutError:
         error_msg = f"Agent {agent_id} 执行超时"
-        await websocket_manager.send_message(agent_id, error_msg, "error")
         broadcast_log_message(error_msg, "error", agent_id)
         debug(error_msg)
         return AgentResponse(
@@ -468,9 +3448,26 @@ async def run_agent(agent_id: str):
             message=error_msg,
             error="Timeout"
         )
+    except AgentStalled as e:
+        error_msg = f"Agent {agent_id} 被看门狗中止: {e}"
+        broadcast_log_message(error_msg, "error", agent_id)
+        debug(error_msg)
+        return AgentResponse(
+            success=False,
+            message=error_msg,
+            result={"watchdog": e.events},
+            error="Stalled"
+        )
+    except SchedulerQueueFull as e:
+        error_msg = f"Agent {agent_id} 无法调度: {e}"
+        debug(error_msg)
+        return AgentResponse(
+            success=False,
+            message=error_msg,
+            error="QueueFull"
+        )
     except Exception as e:
         error_msg = f"运行Agent {agent_id} 失败: {str(e)}"
-        await websocket_manager.send_message(agent_id, error_msg, "error")
         broadcast_log_message(error_msg, "error", agent_id)
         debug(error_msg)
         return AgentResponse(
@@ -499,20 +3496,10 @@ async def list_agents():
 @app.get("/remove_agent/{agent_id}", response_model=AgentResponse)
 async def remove_agent(agent_id: str):
     try:
-        await websocket_manager.send_message(
-            agent_id,
-            f"Agent {agent_id} 将被移除",
-            "status"
-        )
         broadcast_log_message(f"Agent {agent_id} 将被移除", "status", agent_id)
         
-        agent_manager.remove_agent(agent_id)
+        await agent_manager.remove_agent(agent_id)
         
-        await websocket_manager.send_message(
-            agent_id,
-            f"Agent {agent_id} 已移除",
-            "status"
-        )
         broadcast_log_message(f"Agent {agent_id} 已移除", "status", agent_id)
         
         return AgentResponse(
@@ -527,85 +3514,341 @@ async def remove_agent(agent_id: str):
             error=str(e)
         )
 
-@app.post("/run_task", response_model=AgentResponse)
-async def run_task(request: AgentRequest):
+# 取消运行中（或排队中）的Agent：打断进行中的Ollama请求和浏览器操作，立即归还调度槽位和浏览器会话
+@app.post("/cancel/{agent_id}", response_model=AgentResponse)
+async def cancel_agent(agent_id: str):
+    if not await agent_manager.lifecycle.cancel(agent_id):
+        raise HTTPException(status_code=404, detail=f"Agent {agent_id} 没有正在运行的任务")
+    return AgentResponse(
+        success=True,
+        message=f"Agent {agent_id} 已取消",
+        result={"agent_id": agent_id, "status": "cancelled"}
+    )
+
+# 后台任务引用，防止任务对象在运行中被回收
+background_tasks = set()
+
+def new_task_id() -> str:
+    return f"task_agent_{int(time.time())}_{uuid.uuid4().hex[:6]}"
+
+async def execute_task(agent_id: str, request: AgentRequest):
+    agent = None  # 排队中被取消或创建失败时还没有Agent
     try:
-        agent_id = f"task_agent_{int(asyncio.get_event_loop().time())}"
-        agent = await agent_manager.create_agent(agent_id, request)
+        llm_key = llm_limit_key(request.backend, request.host)
+        if agent_scheduler.would_wait(request.cdp_url, llm_key):
+            task_registry.update(agent_id, "queued", "等待调度")
+            broadcast_log_message(f"任务Agent {agent_id} 等待调度", "status", agent_id)
+        # 先拿到调度槽位再创建Agent，避免突发请求同时打开大量CDP会话和Ollama推理
+        queued_at = time.perf_counter()
+        async with agent_scheduler.slot(request.cdp_url, llm_key, request.priority):
+            metrics.queue_wait.observe(time.perf_counter() - queued_at, model=request.model, cdp_url=request.cdp_url)
+            task_registry.update(agent_id, "running", "任务运行中")
+            agent = await agent_manager.create_agent(agent_id, request)
+            
+            broadcast_log_message(f"开始运行任务Agent {agent_id}，任务: {request.task}", "status", agent_id)
+            
+            debug(f"开始运行任务Agent {agent_id}...")
+            # 超时由WebSocketAgent.run统一控制
+            result = await agent.run()
         
-        await websocket_manager.send_message(
-            agent_id,
-            f"开始运行任务Agent {agent_id}，任务: {request.task}",
-            "status"
+        summary = summarize_history(result)
+        if summary is not None:
+            summary.update(agent_diagnostics(agent))
+        # 先归还浏览器上下文和LLM再记为终态，客户端看到completed时资源已经释放
+        await agent_manager.remove_agent(agent_id)
+        task_registry.update(
+            agent_id, "completed", "任务执行完成",
+            result=summary,
+            steps=summary.get("steps", 0) if summary else 0
         )
-        broadcast_log_message(f"开始运行任务Agent {agent_id}，任务: {request.task}", "status", agent_id)
-        
-        async def execute_task():
-            try:
-                debug(f"开始运行任务Agent {agent_id}...")
-                # 使用agent的超时时间设置
-                timeout = getattr(agent, 'timeout', TASK_CONFIG["task_timeout"])
-                result = await asyncio.wait_for(agent.run(), timeout=timeout)
-                
-                await websocket_manager.send_message(
-                    agent_id,
-                    f"任务Agent {agent_id} 执行完成",
-                    "status"
-                )
-                broadcast_log_message(f"任务Agent {agent_id} 执行完成", "status", agent_id)
-                
-                agent_manager.remove_agent(agent_id)
-                debug(f"任务Agent {agent_id} 执行完成并已清理")
-            except asyncio.TimeoutError:
-                error_msg = f"任务Agent {agent_id} 执行超时"
-                await websocket_manager.send_message(agent_id, error_msg, "error")
-                broadcast_log_message(error_msg, "error", agent_id)
-                debug(error_msg)
-                agent_manager.remove_agent(agent_id)
-            except Exception as e:
-                error_msg = f"任务Agent {agent_id} 执行失败: {str(e)}"
-                await websocket_manager.send_message(agent_id, error_msg, "error")
-                broadcast_log_message(error_msg, "error", agent_id)
-                debug(error_msg)
-                agent_manager.remove_agent(agent_id)
-        
-        asyncio.create_task(execute_task())
+        broadcast_log_message(f"任务Agent {agent_id} 执行完成", "status", agent_id)
+        debug(f"任务Agent {agent_id} 执行完成并已清理")
+    except asyncio.TimeoutError:
+        error_msg = f"任务Agent {agent_id} 执行超时"
+        await agent_manager.remove_agent(agent_id)
+        task_registry.update(agent_id, "timeout", error_msg, error="Timeout", result=agent_diagnostics(agent))
+        broadcast_log_message(error_msg, "error", agent_id)
+        debug(error_msg)
+    except AgentStalled as e:
+        error_msg = f"任务Agent {agent_id} 被看门狗中止: {e}"
+        await agent_manager.remove_agent(agent_id)
+        task_registry.update(agent_id, "stalled", error_msg, error="Stalled",
+                             result={**(agent_diagnostics(agent) or {}), "watchdog": e.events})
+        broadcast_log_message(error_msg, "error", agent_id)
+        debug(error_msg)
+    except asyncio.CancelledError:
+        requested = agent_manager.lifecycle.consume_cancel(agent_id)
+        error_msg = f"任务Agent {agent_id} 已取消" if requested else f"任务Agent {agent_id} 因服务关闭中断"
+        await agent_manager.remove_agent(agent_id)
+        task_registry.update(agent_id, "cancelled", error_msg, error="Cancelled", result=agent_diagnostics(agent))
+        broadcast_log_message(error_msg, "status", agent_id)
+        debug(error_msg)
+        if not requested:
+            raise
+    except Exception as e:
+        error_msg = f"任务Agent {agent_id} 执行失败: {str(e)}"
+        await agent_manager.remove_agent(agent_id)
+        task_registry.update(agent_id, "failed", error_msg, error=str(e), result=agent_diagnostics(agent))
+        broadcast_log_message(error_msg, "error", agent_id)
+        debug(error_msg)
+    finally:
+        # 排队中被取消、或创建Agent前失败时，节点分配也要归还
+        chrome_nodes.unassign(agent_id)
+        # 最终结果事件，流式接口收到后结束
+        record = task_registry.get(agent_id)
+        if record is not None and record["status"] == "completed":
+            model_router.observe(request.task, record["steps"])
+        metrics.tasks.inc(status=record["status"] if record else "unknown", model=request.model, cdp_url=request.cdp_url)
+        broadcast_log_message(
+            record["message"] if record else "任务已结束", "result", agent_id,
+            status=record["status"] if record else None,
+            result=record["result"] if record else None,
+            error=record["error"] if record else None
+        )
+
+# 登记任务并在后台执行，返回初始状态（running/queued）；队列已满时抛出SchedulerQueueFull
+def submit_task(agent_id: str, request: AgentRequest) -> str:
+    if agent_scheduler.is_full():
+        raise SchedulerQueueFull("任务队列已满，请稍后重试")
+    # 先路由，模型和超时决定后再分配节点、登记任务
+    route = model_router.route(request)
+    agent_manager.llm_backends.resolve_model(request)
+    # 提交时就分配Chrome节点，排队中的任务也计入节点负载
+    chrome_supervisor.wake()
+    request.cdp_url = chrome_nodes.assign(agent_id, request.cdp_url, request.headless)
+    task_registry.create(agent_id, request, route)
+    status = "queued" if agent_scheduler.would_wait(request.cdp_url, llm_limit_key(request.backend, request.host)) else "running"
+    task = asyncio.create_task(execute_task(agent_id, request))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    # 排队阶段也可以通过 /cancel 取消
+    agent_manager.lifecycle.track(agent_id, task)
+    return status
+
+@app.post("/run_task", response_model=TaskSubmitResponse)
+async def run_task(request: AgentRequest):
+    try:
+        agent_id = new_task_id()
+        status = submit_task(agent_id, request)
         
-        return AgentResponse(
+        return TaskSubmitResponse(
             success=True,
-            message=f"任务已启动，Agent ID: {agent_id}",
-            result={"agent_id": agent_id, "status": "running"}
+            message=f"任务已{'排队' if status == 'queued' else '启动'}，Agent ID: {agent_id}",
+            result={"agent_id": agent_id, "task_id": agent_id, "status": status},
+            task_id=agent_id
+        )
+    except NoChromeNodeAvailable as e:
+        return TaskSubmitResponse(
+            success=False,
+            message=str(e),
+            error="NoChromeNode"
+        )
+    except SchedulerQueueFull as e:
+        return TaskSubmitResponse(
+            success=False,
+            message=str(e),
+            error="QueueFull"
         )
     except Exception as e:
         debug(f"启动任务失败: {e}")
-        return AgentResponse(
+        return TaskSubmitResponse(
             success=False,
             message="启动任务失败",
             error=str(e)
         )
 
+# 流式任务接口：一个连接内返回该任务的 status/log/step/error 事件，最后是 result 事件
+# 默认 Server-Sent Events；?format=ndjson 时返回按行分隔的JSON
+@app.post("/run_task/stream")
+async def run_task_stream(request: AgentRequest, format: str = "sse"):
+    agent_id = new_task_id()
+    # 先订阅再提交任务，保证不会漏掉最早的事件
+    queue = event_bus.subscribe(agent_id)
+    try:
+        status = submit_task(agent_id, request)
+    except SchedulerQueueFull as e:
+        event_bus.unsubscribe(agent_id, queue)
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        event_bus.unsubscribe(agent_id, queue)
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    ndjson = format == "ndjson"
+    
+    def render(message_data: Dict[str, Any]) -> str:
+        frame = encode_message(message_data)
+        if ndjson:
+            return f"{frame}\n"
+        return f"event: {message_data['type']}\ndata: {frame}\n\n"
+    
+    async def event_stream():
+        try:
+            yield render({
+                "type": "accepted",
+                "message": f"任务已{'排队' if status == 'queued' else '启动'}",
+                "agent_id": agent_id,
+                "task_id": agent_id,
+                "status": status,
+                "timestamp": time.time()
+            })
+            while True:
+                try:
+                    message_data = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # 心跳，防止代理/负载均衡断开空闲连接
+                    yield '{"type": "ping"}\n' if ndjson else ": keep-alive\n\n"
+                    continue
+                yield render(message_data)
+                if message_data["type"] == "result":
+                    break
+        finally:
+            event_bus.unsubscribe(agent_id, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson" if ndjson else "text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Task-Id": agent_id}
+    )
+
+@app.get("/task_status/{task_id}")
+async def task_status(task_id: str):
+    record = task_registry.get(task_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"任务 {task_id} 不存在")
+    # 轮询状态不带每步明细；任务完成后才返回结果摘要（与 /task_result 的 result 相同）
+    if record["status"] == "completed":
+        return record
+    return {key: value for key, value in record.items() if key != "result"}
+
+@app.get("/task_result/{task_id}")
+async def task_result(task_id: str):
+    record = task_registry.get(task_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"任务 {task_id} 不存在")
+    return {
+        "task_id": task_id,
+        "status": record["status"],
+        "finished": record["status"] in TASK_TERMINAL_STATES,
+        "steps": record["steps"],
+        "duration_seconds": record["duration_seconds"],
+        "result": record["result"],
+        "error": record["error"],
+    }
+
+@app.get("/list_tasks")
+async def list_tasks():
+    return {
+        "total": len(task_registry.tasks),
+        "status_summary": task_registry.summary(),
+        "tasks": [
+            {
+                "task_id": record["task_id"],
+                "status": record["status"],
+                "task": record["task"],
+                "progress": record["progress"],
+                "created_at": record["created_at"],
+            }
+            for record in task_registry.tasks.values()
+        ]
+    }
+
+@app.delete("/clear_completed_tasks")
+async def clear_completed_tasks():
+    cleared = task_registry.clear_finished()
+    return {
+        "success": True,
+        "message": f"已清理 {cleared} 个已结束的任务",
+        "cleared": cleared
+    }
+
+# Chrome节点注册表
+@app.get("/chrome_nodes")
+async def list_chrome_nodes():
+    return {
+        "success": True,
+        "nodes": chrome_nodes.list_nodes(),
+        **chrome_nodes.get_stats()
+    }
+
+@app.post("/chrome_nodes", response_model=AgentResponse)
+async def register_chrome_node(request: ChromeNodeRequest):
+    node = chrome_nodes.register(request.cdp_url, request.capacity)
+    chrome_nodes.ensure_health_checker()
+    return AgentResponse(
+        success=True,
+        message=f"Chrome节点 {node['cdp_url']} 已注册，容量 {node['capacity']}",
+        result=dict(node)
+    )
+
+# 手动摘除节点：不再分配新Agent，已分配的会话结束后从注册表删除
+@app.delete("/chrome_nodes", response_model=AgentResponse)
+async def remove_chrome_node(cdp_url: str):
+    if not chrome_nodes.remove(cdp_url):
+        raise HTTPException(status_code=404, detail=f"Chrome节点 {cdp_url} 不存在")
+    await agent_manager.browser_pool.discard_idle(cdp_url.rstrip("/"))
+    return AgentResponse(
+        success=True,
+        message=f"Chrome节点 {cdp_url} 已摘除"
+    )
+
+# 托管Chrome进程：每个进程的端口、会话数、已分配任务数、重启次数、内存和CPU
+@app.get("/chrome_processes")
+async def list_chrome_processes():
+    return {
+        "success": True,
+        **chrome_supervisor.get_stats(),
+        "processes": chrome_supervisor.list_processes()
+    }
+
 @app.get("/health")
 async def health_check():
     return {
         "status": "healthy",
         "active_agents": len(agent_manager.active_agents),
         "websocket_connections": sum(len(conns) for conns in websocket_manager.active_connections.values()),
-        "global_websocket_clients": len(websocket_clients)
+        "global_websocket_clients": len(websocket_manager.global_clients),
+        "broadcast": get_broadcast_stats(),
+        "scheduler": agent_scheduler.get_stats(),
+        "chrome_nodes": chrome_nodes.get_stats(),
+        "chrome_supervisor": chrome_supervisor.get_stats(),
+        "model_router": model_router.get_stats(),
+        "llm_backends": agent_manager.llm_backends.get_stats(),
+        "tasks": task_registry.summary(),
+        "browser_pool": agent_manager.browser_pool.get_stats(),
+        "llm_registry": agent_manager.llm_registry.get_stats(),
+        "llm_cache": llm_response_cache.get_stats() if llm_response_cache is not None else {"enabled": False},
+        "event_bus": event_bus.get_stats(),
+        "lifecycle": agent_manager.lifecycle.get_stats(),
+        "logging": logging_pipeline.get_stats()
     }
 
-if __name__ == "__main__":
-    # 启动WebSocket服务线程
-    debug("[MAIN] 启动 WebSocket 线程...")
-    threading.Thread(target=start_websocket_server, daemon=True).start()
+# Prometheus文本格式指标
+@app.get("/metrics")
+async def metrics_endpoint():
+    metrics.broadcast_queue.set(get_broadcast_stats()["queued"])
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# 监听套接字：HTTP端口和兼容旧客户端的7789端口由同一个uvicorn进程、同一个事件循环提供
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
 
+if __name__ == "__main__":
     # 设置标准输出拦截
     tee_stdout = TeeLoggerStream(sys.stdout)
     tee_stderr = TeeLoggerStream(sys.stderr)
-    broadcast_handler = BroadcastingHandler()
-    broadcast_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
-    attach_handler_to_all_loggers(broadcast_handler)
+    # 日志经队列交给后台线程写文件和广播
+    logging_pipeline.start()
 
     # 重定向标准输出和错误
     with contextlib.redirect_stdout(tee_stdout), contextlib.redirect_stderr(tee_stderr):
-        # 启动HTTP服务器
-        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+        # 启动HTTP服务器，同时在7789端口提供全局WebSocket
+        debug(f"[MAIN] 启动服务：http://0.0.0.0:8000，全局WebSocket ws://0.0.0.0:{BROADCAST_CONFIG['legacy_port']}")
+        sockets = [bind_socket("0.0.0.0", 8000), bind_socket("0.0.0.0", BROADCAST_CONFIG["legacy_port"])]
+        try:
+            uvicorn.Server(uvicorn.Config(app)).run(sockets=sockets)
+        finally:
+            logging_pipeline.stop()
\ No newline at end of file
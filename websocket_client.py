@@ -13,8 +13,10 @@ from typing import Dict, Any
 import requests
 
 class WebSocketClient:
-    def __init__(self, base_url: str = "ws://localhost:8000"):
+    def __init__(self, base_url: str = "ws://localhost:8000", batch_ms: int = 0, batch_size: int = 0):
         self.base_url = base_url
+        self.batch_ms = batch_ms  # 大于0时请求服务端批量推送
+        self.batch_size = batch_size
         self.http_base_url = base_url.replace("ws://", "http://").replace("wss://", "https://")
         self.websocket = None
         self.agent_id = None
@@ -23,6 +25,8 @@ class WebSocketClient:
         """连接到指定Agent的WebSocket"""
         try:
             uri = f"{self.base_url}/ws/{agent_id}"
+            if self.batch_ms or self.batch_size:
+                uri += f"?batch_ms={self.batch_ms}&batch_size={self.batch_size}"
             print(f"🔄 正在连接到: {uri}")
             
             self.websocket = await websockets.connect(uri)
@@ -54,6 +58,13 @@ class WebSocketClient:
     async def handle_message(self, data: Dict[str, Any]):
         """处理接收到的消息"""
         msg_type = data.get("type", "unknown")
+        
+        # 批量帧：逐条处理其中的消息
+        if msg_type == "batch":
+            for item in data.get("messages", []):
+                await self.handle_message(item)
+            return
+        
         message = data.get("message", "")
         timestamp = data.get("timestamp", 0)
         
@@ -69,6 +80,14 @@ class WebSocketClient:
             print(f"📝 [{time_str}] 日志: {message}")
         elif msg_type == "step":
             print(f"🚀 [{time_str}] 执行步骤: {message}")
+        elif msg_type == "timing":
+            try:
+                t = json.loads(message)
+                print(f"⏱️ [{time_str}] 第{t['step']}步耗时 {t['total_seconds']}s: 状态 {t['state_seconds']}s, "
+                      f"LLM {t['llm_seconds']}s ({t['tokens_in']}→{t['tokens_out']} tokens, 重试{t['retries']}次), "
+                      f"动作 {t['actions_seconds']}s")
+            except (ValueError, KeyError, TypeError):
+                print(f"⏱️ [{time_str}] 步骤耗时: {message}")
         elif msg_type == "error":
             print(f"❌ [{time_str}] 错误: {message}")
         elif msg_type == "warning":